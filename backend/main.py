@@ -1,19 +1,60 @@
-from fastapi import FastAPI, UploadFile, File, Form, APIRouter
-from fastapi.responses import JSONResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, UploadFile, File, APIRouter, HTTPException, Request
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from uuid import uuid4
-from datetime import datetime
+from fastapi.concurrency import run_in_threadpool
+import asyncio
 import json
-from utils.conversion import process_upload
-from models.study import StudyMetadata, save_metadata, load_all_metadata
+import time
+from utils.jobs import submit_mask, submit_upload
+from utils.storage import (
+    REGENERATION_RETRY_AFTER, UPLOAD_DIR, dicom_dir, ensure_derived, is_stored_path, segmentation_path, study_dir,
+)
+from utils.objects import release_objects, store_form, store_upload
+from utils.upload import MAX_BATCH_REQUEST_BYTES, MAX_REQUEST_BYTES
+from utils.batch import (
+    BATCH_MAX_CONCURRENCY, BATCH_MEDIA_TYPE, BatchRunner, discard_batch_files, ingest_archive, ingest_uploads,
+    open_archive, parse_manifest,
+)
+from models.study import get_segments, get_study, get_study_by_uid, search_studies
+from models.job import get_job
+from utils.instance_index import load_instance_index, frame_span
+from utils.frames import (
+    FileSpan, FRAME_MEDIA_TYPE, body_response, frames_response, multipart_body, parse_frame_list, part_boundary,
+)
+from utils.metrics import (
+    PROMETHEUS_CONTENT_TYPE, ProfiledRoute, configure_profiling, finish_request_profile,
+    http_request_duration, http_response_bytes, profiling_authorized, profiling_settings, register_lru_cache,
+    render_metrics, start_request_profile, upload_bytes,
+)
+from utils.qido import (
+    DESCRIPTION_KEYS, MODALITIES_KEYS, QIDO_MAX_LIMIT, SEGMENTATION_CLASS_KEYS, SEGMENTATION_MODALITY,
+    STUDY_DATE_KEYS, STUDY_MODALITY, STUDY_UID_KEYS, parse_date_range, parse_includefields, query_values,
+    study_json,
+)
+from utils.roi import (
+    ROI_COMPONENTS, ROI_FORMATS, ROI_HEADERS, ROI_MAX_MARGIN, find_segment, roi_filename, roi_payload,
+)
+from utils.series_volume import (
+    VOLUME_COMPONENTS, VOLUME_FORMATS, VOLUME_HEADERS, series_volume_geometry, volume_filename, volume_payload,
+)
+from utils.render import (
+    DEFAULT_QUALITY, RENDERED_MEDIA_TYPES, THUMBNAIL_SIZE, parse_viewport, parse_window,
+    render_frame, representative_frame, series_frames,
+)
+from utils.http_cache import (
+    IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL, ImmutableStaticFiles, cache_headers, encoded_response, immutable_file_response,
+    negotiate_encoding, not_modified, study_etag,
+)
+from utils.dicomweb import (
+    load_dicomweb_json, DICOMWEB_BASE_URL, SERIES_METADATA_FILENAME, INSTANCES_FILENAME,
+)
 import os
-from pydicom import dcmread
 from fastapi.responses import StreamingResponse
-from io import BytesIO
 
 
 app = FastAPI()
+# Every route handler can run under a per-request profiler (see utils.metrics)
+app.router.route_class = ProfiledRoute
 
 # Add CORS middleware
 app.add_middleware(
@@ -22,122 +63,504 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Content-Range", "Content-Disposition"] + ROI_HEADERS + VOLUME_HEADERS,
 )
 
-UPLOAD_DIR = "uploads"
 METADATA_FILE = "metadata.json"
 
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-# Mount static directories
-app.mount("/dicom", StaticFiles(directory=UPLOAD_DIR), name="dicom")
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    # Refuse oversized uploads from Content-Length before the body is read
+    if request.method == "POST" and request.url.path.startswith("/upload"):
+        limit = MAX_BATCH_REQUEST_BYTES if request.url.path.startswith("/upload/batch") else MAX_REQUEST_BYTES
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > limit:
+            return JSONResponse(
+                status_code=413,
+                content={"error": f"Upload rejected: request exceeds {limit} bytes"},
+            )
+    return await call_next(request)
+
+@app.middleware("http")
+async def observe_requests(request: Request, call_next):
+    """Latency, response size and optional profile of every request, labelled by route template."""
+    profile = start_request_profile(request)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        profile_path = finish_request_profile(profile, request)
+    elapsed = time.perf_counter() - start
+
+    route = request.scope.get("route")
+    route_path = route.path if route is not None else "unmatched"
+    http_request_duration.observe(elapsed, route=route_path, method=request.method, status=response.status_code)
+    content_length = response.headers.get("content-length")
+    if content_length and content_length.isdigit():
+        http_response_bytes.inc(int(content_length), route=route_path)
+
+    if profile_path is not None:
+        response.headers["X-Profile-File"] = profile_path
+    return response
+
+
 from starlette.responses import RedirectResponse
 
-@app.get("/dicomweb/studies/{study_uid}/series/{series_uid}/instances/{instance_uid}/frames/1")
-def get_frame(study_uid: str, series_uid: str, instance_uid: str):
-    studies = load_all_metadata()
-    study_id = next((s["study_id"] for s in studies if s["study_uid"] == study_uid), None)
-    if not study_id:
+def _ensure_derived(study):
+    # Lazy storage regenerates evicted series and SEG here (see utils.storage)
+    try:
+        ensure_derived(study)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Source volumes not found")
+    except TimeoutError:
+        raise HTTPException(
+            status_code=503,
+            detail="Study files are being regenerated",
+            headers={"Retry-After": str(REGENERATION_RETRY_AFTER)},
+        )
+
+
+def _load_series_index(study_uid: str):
+    study = get_study_by_uid(study_uid)
+    if not study:
         raise HTTPException(status_code=404, detail="Study not found")
 
-    dicom_dir = os.path.join(UPLOAD_DIR, study_id, "dicom_series")
+    _ensure_derived(study)
+    series_dir = dicom_dir(study["study_id"])
+    try:
+        return series_dir, load_instance_index(series_dir)
+    except OSError:
+        raise HTTPException(status_code=404, detail="Series not found")
+
 
-    for file in os.listdir(dicom_dir):
-        file_path = os.path.join(dicom_dir, file)
-        try:
-            ds = dcmread(file_path)
-            if ds.SOPInstanceUID == instance_uid:
-                # Return pixel data (1st frame)
-                pixel_data = ds.PixelData
-                return StreamingResponse(BytesIO(pixel_data), media_type="application/octet-stream")
-        except Exception:
-            continue
+def _frame_url(study_uid, series_uid, instance_uid, frame_number):
+    return (
+        f"{DICOMWEB_BASE_URL}/dicomweb/studies/{study_uid}/series/{series_uid}"
+        f"/instances/{instance_uid}/frames/{frame_number}"
+    )
 
-    raise HTTPException(status_code=404, detail="DICOM instance not found")
 
+@app.get("/dicomweb/studies/{study_uid}/series/{series_uid}/instances/{instance_uid}/frames/{frame_list}")
+def get_frame(request: Request, study_uid: str, series_uid: str, instance_uid: str, frame_list: str):
+    dicom_dir, index = _load_series_index(study_uid)
+    entry = index["by_uid"].get(instance_uid)
+    if not entry:
+        raise HTTPException(status_code=404, detail="DICOM instance not found")
 
-@app.get("/segmentation/{study_id}/")
-def get_segmentation_file(study_id: str, filename: str):
-    seg_path = os.path.join(UPLOAD_DIR, study_id, "segmentation.dcm")
-    if not os.path.exists(seg_path):
-        raise HTTPException(status_code=404, detail="SEG file not found")
-    return FileResponse(seg_path, media_type="application/dicom")
+    try:
+        frame_numbers = parse_frame_list(frame_list)
+        spans = [
+            FileSpan(os.path.join(dicom_dir, entry["file"]), *frame_span(entry, n))
+            for n in frame_numbers
+        ]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except IndexError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    locations = [_frame_url(study_uid, series_uid, instance_uid, n) for n in frame_numbers]
+    return frames_response(request, spans, locations)
+
+
+@app.get("/dicomweb/studies/{study_uid}/series/{series_uid}/frames")
+def get_series_frames(request: Request, study_uid: str, series_uid: str):
+    """Every frame of the series, in instance order, as one multipart/related response."""
+    dicom_dir, index = _load_series_index(study_uid)
+
+    spans, locations = [], []
+    for entry in index["instances"]:
+        path = os.path.join(dicom_dir, entry["file"])
+        for n in range(1, entry.get("number_of_frames", 1) + 1):
+            spans.append(FileSpan(path, *frame_span(entry, n)))
+            locations.append(_frame_url(study_uid, series_uid, entry["sop_instance_uid"], n))
+    if not spans:
+        raise HTTPException(status_code=404, detail="Series has no frames")
+
+    boundary = part_boundary(spans)
+    return body_response(
+        request,
+        multipart_body(spans, boundary, locations),
+        f'multipart/related; type="{FRAME_MEDIA_TYPE}"; boundary={boundary}',
+    )
+
+
+def _render_options(request: Request, thumbnail=False):
+    """window / viewport / quality query parameters and the image type from Accept (or ?accept=)."""
+    params = request.query_params
+    accept = params.get("accept") or request.headers.get("accept", "")
+    image_format = "png" if "image/png" in accept and "image/jpeg" not in accept else "jpeg"
+    try:
+        default_viewport = (THUMBNAIL_SIZE, THUMBNAIL_SIZE) if thumbnail else None
+        options = {
+            "window": parse_window(params.get("window")),
+            "viewport": parse_viewport(params.get("viewport"), default_viewport),
+            "image_format": image_format,
+            "quality": int(params.get("quality", DEFAULT_QUALITY)),
+        }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not 1 <= options["quality"] <= 100:
+        raise HTTPException(status_code=400, detail="quality must be between 1 and 100")
+    return options
 
 
-@app.get("/dicom/{study_id}/{filename}")
-def get_dicom_file(study_id: str, filename: str):
-    file_path = UPLOAD_DIR / study_id / "dicom_series" / filename
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="DICOM file not found")
-    return FileResponse(file_path, media_type="application/dicom")
+def _rendered_response(request, study_uid, select_frames, thumbnail=False):
+    """Render the selected (entry, frame) pairs: one image bare, several as multipart/related."""
+    study = get_study_by_uid(study_uid)
+    if not study:
+        raise HTTPException(status_code=404, detail="Study not found")
+    options = _render_options(request, thumbnail)
+    media_type = RENDERED_MEDIA_TYPES[options["image_format"]]
 
-# DICOM Web router
-dicomweb_router = APIRouter(prefix="/dicom")
-
-@app.post("/upload")
-async def upload_files(
-    image_file: UploadFile = File(...),
-    mask_file: UploadFile = File(...),
-    radiography_type: str = Form(...),
-):
+    etag = study_etag(study, f"{request.url.path}?{sorted(options.items())}")
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+
+    dicom_dir, index = _load_series_index(study_uid)
     try:
-        study_id = str(uuid4())
-        study_path = os.path.join(UPLOAD_DIR, study_id)
-        os.makedirs(study_path, exist_ok=True)
+        frames = select_frames(index)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except IndexError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    images = [render_frame(dicom_dir, entry, n, **options) for entry, n in frames]
+
+    if len(images) == 1:
+        return Response(content=images[0], media_type=media_type, headers=cache_headers(etag))
+    boundary = part_boundary(images)
+    return body_response(
+        request,
+        multipart_body(images, boundary, media_type=media_type),
+        f'multipart/related; type="{media_type}"; boundary={boundary}',
+        headers=cache_headers(etag),
+    )
+
+
+def _instance_frames(instance_uid, frame_list=None):
+    def select(index):
+        entry = index["by_uid"].get(instance_uid)
+        if not entry:
+            raise IndexError("DICOM instance not found")
+        if frame_list is None:
+            return [(entry, n) for n in range(1, entry.get("number_of_frames", 1) + 1)]
+        frames = []
+        for n in parse_frame_list(frame_list):
+            frame_span(entry, n)  # IndexError when out of range
+            frames.append((entry, n))
+        return frames
+    return select
+
+
+def _representative(index):
+    return [representative_frame(index)]
+
+
+@app.api_route("/dicomweb/studies/{study_uid}/rendered", methods=["GET", "HEAD"])
+@app.api_route("/dicomweb/studies/{study_uid}/series/{series_uid}/rendered", methods=["GET", "HEAD"])
+def get_series_rendered(request: Request, study_uid: str, series_uid: str = None):
+    return _rendered_response(request, study_uid, series_frames)
+
+
+@app.api_route("/dicomweb/studies/{study_uid}/thumbnail", methods=["GET", "HEAD"])
+@app.api_route("/dicomweb/studies/{study_uid}/series/{series_uid}/thumbnail", methods=["GET", "HEAD"])
+def get_series_thumbnail(request: Request, study_uid: str, series_uid: str = None):
+    return _rendered_response(request, study_uid, _representative, thumbnail=True)
+
+
+@app.api_route("/dicomweb/studies/{study_uid}/series/{series_uid}/instances/{instance_uid}/rendered",
+               methods=["GET", "HEAD"])
+def get_instance_rendered(request: Request, study_uid: str, series_uid: str, instance_uid: str):
+    return _rendered_response(request, study_uid, _instance_frames(instance_uid))
+
+
+@app.api_route("/dicomweb/studies/{study_uid}/series/{series_uid}/instances/{instance_uid}/thumbnail",
+               methods=["GET", "HEAD"])
+def get_instance_thumbnail(request: Request, study_uid: str, series_uid: str, instance_uid: str):
+    select = _instance_frames(instance_uid)
+    return _rendered_response(request, study_uid, lambda index: select(index)[:1], thumbnail=True)
+
+
+@app.api_route(
+    "/dicomweb/studies/{study_uid}/series/{series_uid}/instances/{instance_uid}/frames/{frame_list}/rendered",
+    methods=["GET", "HEAD"],
+)
+def get_frames_rendered(request: Request, study_uid: str, series_uid: str, instance_uid: str, frame_list: str):
+    return _rendered_response(request, study_uid, _instance_frames(instance_uid, frame_list))
 
-        image_path = os.path.join(study_path, image_file.filename)
-        mask_path = os.path.join(study_path, mask_file.filename)
 
-        with open(image_path, "wb") as f:
-            f.write(await image_file.read())
+@app.api_route(
+    "/dicomweb/studies/{study_uid}/series/{series_uid}/instances/{instance_uid}/frames/{frame_list}/thumbnail",
+    methods=["GET", "HEAD"],
+)
+def get_frame_thumbnail(request: Request, study_uid: str, series_uid: str, instance_uid: str, frame_list: str):
+    select = _instance_frames(instance_uid, frame_list)
+    return _rendered_response(request, study_uid, lambda index: select(index)[:1], thumbnail=True)
 
-        with open(mask_path, "wb") as f:
-            f.write(await mask_file.read())
 
-        study_uid, segmentation_classes = process_upload(
-            study_id, image_path, mask_path
-        )
+@app.api_route("/segmentation/{study_id}/", methods=["GET", "HEAD"])
+@app.api_route("/segmentation/{study_id}/{filename}", methods=["GET", "HEAD"])
+def get_segmentation_file(request: Request, study_id: str, filename: str = "segmentation.dcm"):
+    # The viewer addresses studies by StudyInstanceUID here, older clients by study_id
+    study = get_study(study_id) or get_study_by_uid(study_id)
+    if not study:
+        raise HTTPException(status_code=404, detail="SEG file not found")
 
-        metadata = StudyMetadata(
-            study_id=study_id,
-            study_uid=study_uid,
-            radiography_type=radiography_type,
-            segmentation_classes=segmentation_classes,
-        )
-        save_metadata(metadata)
+    etag = study_etag(study, "segmentation")
+    cached = not_modified(request, etag, REVALIDATE_CACHE_CONTROL)
+    if cached:
+        return cached
+
+    _ensure_derived(study)
+    seg_path = segmentation_path(study["study_id"])
+    if not os.path.exists(seg_path):
+        raise HTTPException(status_code=404, detail="SEG file not found")
+    return immutable_file_response(seg_path, etag, "application/dicom", REVALIDATE_CACHE_CONTROL)
+
+
+def _is_plain_name(name):
+    # Path parameters arrive URL-decoded, so %2E%2E and %2F must be refused here
+    return name not in ("", ".", "..") and "/" not in name and "\\" not in name
+
+
+def _study_file_response(request, study_id, filename, media_type=None, series_file=True):
+    """A file of a catalogued study's DICOM series, or of its source directory; None when there is none."""
+    if not (_is_plain_name(study_id) and _is_plain_name(filename)):
+        return None
+    study = get_study(study_id)
+    if not study:
+        return None
+
+    relative_path = os.path.join("dicom_series", filename) if series_file else filename
+    etag = study_etag(study, relative_path)
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+
+    if series_file:
+        _ensure_derived(study)
+        file_path = os.path.join(dicom_dir(study_id), filename)
+    else:
+        file_path = os.path.join(study_dir(study_id), filename)
+    if not (is_stored_path(file_path) and os.path.isfile(file_path)):
+        return None
+    return immutable_file_response(file_path, etag, media_type=media_type)
+
+
+@app.api_route("/dicom/{study_id}/{filename}", methods=["GET", "HEAD"])
+def get_dicom_file(request: Request, study_id: str, filename: str):
+    response = _study_file_response(request, study_id, filename, media_type="application/dicom")
+    # Other study files (source volumes) keep being served as before the route existed
+    response = response or _study_file_response(request, study_id, filename, series_file=False)
+    if response is None:
+        raise HTTPException(status_code=404, detail="DICOM file not found")
+    return response
+
+# DICOM Web router
+dicomweb_router = APIRouter(prefix="/dicom", route_class=ProfiledRoute)
+
+# The body is parsed here rather than through UploadFile parameters, which Starlette
+# spools in full before the handler runs: each volume is checked as its bytes arrive
+@app.post("/upload", openapi_extra={"requestBody": {"content": {"multipart/form-data": {"schema": {
+    "type": "object",
+    "required": ["image_file", "mask_file", "radiography_type"],
+    "properties": {
+        "image_file": {"type": "string", "format": "binary"},
+        "mask_file": {"type": "string", "format": "binary"},
+        "radiography_type": {"type": "string"},
+    },
+}}}, "required": True}})
+async def upload_files(request: Request):
+    try:
+        # Stored by content hash; a repeat upload reuses the study it produced
+        fields, files = await store_form(request, ("image_file", "mask_file"))
+        image_sha256, image_size, image_object, image_filename = files["image_file"]
+        mask_sha256, mask_size, mask_object, mask_filename = files["mask_file"]
+        upload_bytes.inc(image_size + mask_size)
+        try:
+            if "radiography_type" not in fields:
+                raise HTTPException(status_code=400, detail="missing form field 'radiography_type'")
+            result, future = submit_upload(
+                (image_sha256, image_object, image_filename),
+                (mask_sha256, mask_object, mask_filename),
+                fields["radiography_type"],
+            )
+        except Exception:
+            release_objects(image_object, mask_object)
+            raise
+        if future is None:
+            return JSONResponse(content={"message": "Identical upload already converted", **result})
 
         return JSONResponse(
-            content={
-                "message": "Upload successful",
-                "study_id": study_id,
-                "study_uid": study_uid,
-                "segmentation_classes": segmentation_classes,
-            }
+            status_code=202,
+            content={"message": "Upload accepted, conversion queued", **result, "status_url": f"/jobs/{result['job_id']}"},
         )
 
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"error": f"Upload rejected: {e.detail}"})
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": f"Upload rejected: {e}"})
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": f"Upload failed: {str(e)}"})
 
-@app.get("/studies")
-def get_studies():
-    studies = load_all_metadata()
-    result = []
-    for study in studies:
+# Parsed like /upload: volumes are checked and stored as they arrive, and an archive
+# is written to one temporary file instead of being spooled by Starlette first
+@app.post("/upload/batch", openapi_extra={"requestBody": {"content": {"multipart/form-data": {"schema": {
+    "type": "object",
+    "properties": {
+        "archive": {"type": "string", "format": "binary"},
+        "image_files": {"type": "array", "items": {"type": "string", "format": "binary"}},
+        "mask_files": {"type": "array", "items": {"type": "string", "format": "binary"}},
+        "manifest": {"type": "string"},
+        "radiography_type": {"type": "string", "default": "CBCT"},
+        "concurrency": {"type": "integer", "default": BATCH_MAX_CONCURRENCY},
+    },
+}}}, "required": True}})
+async def upload_batch(request: Request):
+    """Many image/mask pairs in one request, as a zip/tar archive or as parallel
+    image_files/mask_files lists. Pairs are converted concurrently and one NDJSON
+    line is streamed per pair as it finishes, then a summary line."""
+    try:
+        fields, files = await store_form(request, (), multiple=("image_files", "mask_files"), raw=("archive",))
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"error": f"Upload rejected: {e.detail}"})
+
+    archive = files.get("archive")
+    image_files, mask_files = files.get("image_files", []), files.get("mask_files", [])
+    radiography_type = fields.get("radiography_type", "CBCT")
+    archive_file = None
+    try:
+        if (archive is None) == (not image_files):
+            raise HTTPException(status_code=400, detail="send either an archive or image_files/mask_files")
+        if len(image_files) != len(mask_files):
+            raise HTTPException(status_code=400, detail="image_files and mask_files must pair up one to one")
+        try:
+            concurrency = int(fields.get("concurrency", BATCH_MAX_CONCURRENCY))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="concurrency must be an integer")
+        manifest = fields.get("manifest")
+        entries = parse_manifest(manifest, require_files=archive is not None) if manifest else None
+        if entries is not None and archive is None and len(entries) != len(image_files):
+            raise HTTPException(status_code=400, detail="manifest must have one entry per pair")
+        if archive is not None:
+            upload_bytes.inc(archive[3])
+            archive_file = open(archive[1], "rb")
+        opened = await run_in_threadpool(open_archive, archive_file) if archive_file is not None else None
+    except HTTPException as e:
+        if archive_file is not None:
+            archive_file.close()
+        discard_batch_files(files)
+        return JSONResponse(status_code=e.status_code, content={"error": f"Upload rejected: {e.detail}"})
+
+    async def results():
+        runner = BatchRunner(min(max(concurrency, 1), BATCH_MAX_CONCURRENCY))
+
+        async def ingest():
+            try:
+                if opened is not None:
+                    # Extraction blocks, so it runs in a thread while the first pairs convert
+                    try:
+                        await run_in_threadpool(ingest_archive, runner, opened, entries, radiography_type)
+                    finally:
+                        archive_file.close()
+                        os.remove(archive[1])
+                else:
+                    ingest_uploads(runner, image_files, mask_files, entries, radiography_type)
+            finally:
+                runner.close()
+
+        ingesting = asyncio.ensure_future(ingest())
+        async for result in runner.results():
+            yield json.dumps(result) + "\n"
         try:
-            dt = datetime.fromisoformat(study["study_datetime"])
-        except:
-            dt = datetime.now()
-
-        result.append({
-            "0020000D": {"vr": "UI", "Value": [study["study_uid"]]},
-            "00080020": {"vr": "DA", "Value": [dt.strftime("%Y%m%d")]},
-            "00080030": {"vr": "TM", "Value": [dt.strftime("%H%M%S")]},
-            "00100010": {"vr": "PN", "Value": [{"Alphabetic": "Anonymous"}]},
-            "00100020": {"vr": "LO", "Value": [study["study_uid"]]},
-            "00080060": {"vr": "CS", "Value": ["MR"]},
-            "00081030": {"vr": "LO", "Value": [study.get("radiography_type", "CBCT")]},
-        })
-    return JSONResponse(content=result)
+            await ingesting
+        except Exception as e:
+            yield json.dumps({"status": "error", "error": getattr(e, "detail", None) or str(e)}) + "\n"
+        yield json.dumps(runner.summary()) + "\n"
+
+    return StreamingResponse(results(), media_type=BATCH_MEDIA_TYPE)
+
+@app.post("/studies/{study_id}/segmentation")
+async def upload_segmentation(study_id: str, mask_file: UploadFile = File(...)):
+    """Replace a study's mask without re-uploading the image: a new SEG is written
+    against the stored series and the label statistics are updated in place."""
+    study = get_study(study_id) or get_study_by_uid(study_id)
+    if not study:
+        return JSONResponse(status_code=404, content={"error": "Study not found"})
+
+    try:
+        mask_sha256, mask_size, mask_object = await store_upload(mask_file)
+        upload_bytes.inc(mask_size)
+        try:
+            result, future = submit_mask(study, (mask_sha256, mask_object, mask_file.filename))
+        except Exception:
+            release_objects(mask_object)
+            raise
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"error": f"Mask rejected: {e.detail}"})
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": f"Mask rejected: {e}"})
+
+    if future is None:
+        return JSONResponse(content={"message": "Study already has this mask", **result})
+    return JSONResponse(
+        status_code=202,
+        content={"message": "Mask accepted, re-segmentation queued", **result, "status_url": f"/jobs/{result['job_id']}"},
+    )
+
+@app.get("/jobs/{job_id}")
+def get_job_status(job_id: str):
+    job = get_job(job_id)
+    if not job:
+        return JSONResponse(status_code=404, content={"error": "Job not found"})
+
+    if job["status"] == "done":
+        study = get_study(job["study_id"])
+        if study:
+            job["segmentation_classes"] = study["segmentation_classes"]
+    return JSONResponse(content=job)
+
+@app.get("/studies")
+def get_studies(request: Request):
+    """QIDO-RS study search: StudyDate ranges, ModalitiesInStudy, StudyDescription, limit/offset."""
+    params = request.query_params
+    try:
+        limit = min(int(params.get("limit", QIDO_MAX_LIMIT)), QIDO_MAX_LIMIT)
+        offset = int(params.get("offset", 0))
+        if limit < 0 or offset < 0:
+            raise ValueError("limit and offset must not be negative")
+        study_dates = query_values(params, STUDY_DATE_KEYS)
+        study_date = parse_date_range(study_dates[0]) if study_dates else None
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+
+    # Every study has a CT series, so only a SEG-only query narrows the search
+    modalities = query_values(params, MODALITIES_KEYS)
+    if modalities and not {STUDY_MODALITY, SEGMENTATION_MODALITY} & set(modalities):
+        return JSONResponse(content=[])
+    segmentation_only = bool(modalities) and STUDY_MODALITY not in modalities
+
+    descriptions = query_values(params, DESCRIPTION_KEYS)
+    # One extra row tells whether another page exists
+    studies = search_studies(
+        study_date=study_date,
+        radiography_type=descriptions[0] if descriptions else None,
+        segmentation_classes=query_values(params, SEGMENTATION_CLASS_KEYS),
+        study_uids=query_values(params, STUDY_UID_KEYS),
+        has_segmentation=segmentation_only,
+        limit=limit + 1,
+        offset=offset,
+    )
+
+    headers = {}
+    if len(studies) > limit:
+        studies = studies[:limit]
+        headers["Warning"] = "299 medi-image-pro: There are additional results that can be requested"
+    includefields = parse_includefields(params)
+    return JSONResponse(content=[study_json(study, includefields) for study in studies], headers=headers)
 
 @app.get("/studies/{study_uid}/series")
 def get_series(study_uid: str):
@@ -145,94 +568,184 @@ def get_series(study_uid: str):
         "0020000D": {"vr": "UI", "Value": [study_uid]},
         "0020000E": {"vr": "UI", "Value": [f"{study_uid}.1"]},
         "00200011": {"vr": "IS", "Value": [1]},
-        "00080060": {"vr": "CS", "Value": ["MR"]},
+        "00080060": {"vr": "CS", "Value": [STUDY_MODALITY]},
         "0008103E": {"vr": "LO", "Value": ["Segmented Radiograph"]},
         "00080021": {"vr": "DA", "Value": ["20250801"]},
         "00080031": {"vr": "TM", "Value": ["153000"]},
     }])
 
-@app.get("/studies/{study_uid}/series/{series_uid}/metadata")
-def get_instance_metadata(study_uid: str, series_uid: str):
-    studies = load_all_metadata()
-    study_id = next((s["study_id"] for s in studies if s["study_uid"] == study_uid), None)
-
-    if not study_id:
+@app.get("/studies/{study_uid}/segments")
+def get_study_segments(request: Request, study_uid: str):
+    """Per-label voxel counts, volumes, bounding boxes and slice ranges computed at upload."""
+    study = get_study_by_uid(study_uid)
+    if not study:
         return JSONResponse(status_code=404, content={"error": "Study not found"})
 
-    dicom_path = os.path.join(UPLOAD_DIR, study_id, "dicom_series")
-    files = sorted([f for f in os.listdir(dicom_path) if f.endswith(".dcm")])
+    etag = study_etag(study, "segments")
+    cached = not_modified(request, etag, REVALIDATE_CACHE_CONTROL)
+    if cached:
+        return cached
+
+    segments = get_segments(study["study_id"])
+    if not segments and study["segmentation_classes"]:
+        # Uploaded before statistics were recorded
+        return JSONResponse(status_code=404, content={"error": "Segment statistics not available"})
+    return JSONResponse(content=segments, headers=cache_headers(etag, REVALIDATE_CACHE_CONTROL))
+
+@app.api_route("/studies/{study_uid}/segments/{label}/roi", methods=["GET", "HEAD"])
+def get_segment_roi(request: Request, study_uid: str, label: str, margin: int = 0,
+                    format: str = "nifti", component: str = "image"):
+    """Image or mask sub-volume cropped to one label's bounding box (plus margin voxels)."""
+    if format not in ROI_FORMATS or component not in ROI_COMPONENTS:
+        return JSONResponse(
+            status_code=400,
+            content={"error": f"format must be one of {list(ROI_FORMATS)}, component one of {list(ROI_COMPONENTS)}"},
+        )
+    if not 0 <= margin <= ROI_MAX_MARGIN:
+        return JSONResponse(status_code=400, content={"error": f"margin must be between 0 and {ROI_MAX_MARGIN}"})
 
-    metadata = []
-    for file in files:
-        file_path = os.path.join(dicom_path, file)
-        ds = dcmread(file_path, stop_before_pixels=True)
+    study = get_study_by_uid(study_uid)
+    if not study:
+        return JSONResponse(status_code=404, content={"error": "Study not found"})
+    segment = find_segment(get_segments(study["study_id"]), label)
+    if not segment:
+        return JSONResponse(status_code=404, content={"error": f"Segment {label} not found"})
 
-        instance = {
-            "00080018": {"Value": [ds.SOPInstanceUID]},  # SOPInstanceUID
-            "0020000D": {"Value": [ds.StudyInstanceUID]},  # StudyInstanceUID
-            "0020000E": {"Value": [ds.SeriesInstanceUID]},  # SeriesInstanceUID
-            "00081190": {"Value": [f"http://localhost:9999/dicom/{study_id}/dicom_series/{file}"]},
-            # You can include more fields like InstanceNumber, ImagePositionPatient, etc., if needed
-        }
+    etag = study_etag(study, f"roi:{segment['label']}:{component}:{margin}:{format}")
+    cached = not_modified(request, etag, REVALIDATE_CACHE_CONTROL)
+    if cached:
+        return cached
+
+    try:
+        body, geometry = roi_payload(study, segment, component, margin, format)
+    except FileNotFoundError:
+        return JSONResponse(status_code=404, content={"error": "Source volumes not found"})
+    headers = {
+        **cache_headers(etag, REVALIDATE_CACHE_CONTROL),
+        **geometry,
+        "Content-Disposition": f'attachment; filename="{roi_filename(segment, component, format)}"',
+    }
+    return Response(content=body, media_type=ROI_FORMATS[format][1], headers=headers)
+
+@app.get("/studies/{study_uid}/volume")
+def get_study_volume(request: Request, study_uid: str, format: str = "raw", component: str = "image"):
+    """The whole series (or its label mask) as one typed array, streamed slab by slab; Range is honoured."""
+    if format not in VOLUME_FORMATS or component not in VOLUME_COMPONENTS:
+        return JSONResponse(
+            status_code=400,
+            content={"error": f"format must be one of {list(VOLUME_FORMATS)}, component one of {list(VOLUME_COMPONENTS)}"},
+        )
 
-        # Optional: Include Instance Number
-        if "00200013" in ds:
-            instance["00200013"] = {"Value": [int(ds.InstanceNumber)]}
+    study = get_study_by_uid(study_uid)
+    if not study:
+        return JSONResponse(status_code=404, content={"error": "Study not found"})
 
-        metadata.append(instance)
+    # The image never changes; the mask is replaced by re-segmentation
+    cache_control = REVALIDATE_CACHE_CONTROL if component == "mask" else IMMUTABLE_CACHE_CONTROL
+    etag = study_etag(study, f"volume:{component}:{format}")
+    cached = not_modified(request, etag, cache_control)
+    if cached:
+        return cached
 
-    return JSONResponse(content=metadata)
+    series_dir, index = _load_series_index(study_uid)
+    try:
+        parts, geometry = volume_payload(study, series_dir, index, component, format)
+    except FileNotFoundError:
+        return JSONResponse(status_code=404, content={"error": "Source volumes not found"})
+    except ValueError as e:
+        return JSONResponse(status_code=409, content={"error": str(e)})
+    headers = {
+        **cache_headers(etag, cache_control),
+        **geometry,
+        "Content-Disposition": f'attachment; filename="{volume_filename(study_uid, component, format)}"',
+    }
+    return body_response(request, parts, VOLUME_FORMATS[format][1], headers)
+
+def _series_json_response(request, study_uid, filename, not_found):
+    study = get_study_by_uid(study_uid)
+    if not study:
+        return not_found
+
+    etag = study_etag(study, filename)
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+
+    study_id = study["study_id"]
+    try:
+        _ensure_derived(study)
+    except HTTPException as e:
+        if e.status_code != 404:
+            raise
+        return not_found
+    dicom_path = dicom_dir(study_id)
+    if not os.path.isdir(dicom_path):
+        return not_found
+
+    encoding = negotiate_encoding(request)
+    return encoded_response(load_dicomweb_json(study_id, dicom_path, filename, encoding), encoding, etag)
+
+
+@app.api_route("/studies/{study_uid}/series/{series_uid}/metadata", methods=["GET", "HEAD"])
+def get_instance_metadata(request: Request, study_uid: str, series_uid: str):
+    return _series_json_response(
+        request, study_uid, SERIES_METADATA_FILENAME,
+        JSONResponse(status_code=404, content={"error": "Study not found"}),
+    )
 
 @dicomweb_router.get("/studies/{study_uid}/series")
 def dicomweb_get_series(study_uid: str):
     return get_series(study_uid)
 
-@dicomweb_router.get("/studies/{study_uid}/series/{series_uid}/metadata")
-def dicomweb_get_instance_metadata(study_uid: str, series_uid: str):
-    return get_instance_metadata(study_uid, series_uid)
-
-@dicomweb_router.get("/{study_id}/dicom_series/{file_name}")
-def serve_dicom_file(study_id: str, file_name: str):
-    file_path = os.path.join(UPLOAD_DIR, study_id, "dicom_series", file_name)
-    if os.path.exists(file_path):
-        return FileResponse(file_path, media_type="application/dicom")
-    return JSONResponse(status_code=404, content={"error": "File not found"})
-
-@dicomweb_router.get("/studies/{study_uid}/series/{series_uid}/instances")
-async def get_instances(study_uid: str, series_uid: str):
-    
-
-    for study in load_all_metadata():
-        if study["study_uid"] == study_uid:
-            study_id = study["study_id"]
-            dicom_dir = f"uploads/{study_id}/dicom_series"
-            if not os.path.exists(dicom_dir):
-                continue
-
-            instances = []
-            for file in sorted(os.listdir(dicom_dir)):
-                if file.endswith(".dcm"):
-                    file_path = os.path.join(dicom_dir, file)
-                    ds = dcmread(file_path, stop_before_pixels=True)
-                    sop_instance_uid = ds.SOPInstanceUID
-                    sop_class_uid = ds.SOPClassUID
-
-                    instance = {
-                        "00080018": {"vr": "UI", "Value": [sop_instance_uid]},
-                        "00080016": {"vr": "UI", "Value": [sop_class_uid]},
-                        "0020000D": {"vr": "UI", "Value": [study_uid]},
-                        "0020000E": {"vr": "UI", "Value": [series_uid]},
-                        "00081190": {
-                            "vr": "UR",
-                            "Value": [
-                                f"wadouri:http://localhost:9999/dicom/{study_id}/dicom_series/{file}"
-                            ]
-                        }
-                    }
-                    instances.append(instance)
-            return instances
-
-    return []
+@dicomweb_router.api_route("/studies/{study_uid}/series/{series_uid}/metadata", methods=["GET", "HEAD"])
+def dicomweb_get_instance_metadata(request: Request, study_uid: str, series_uid: str):
+    return get_instance_metadata(request, study_uid, series_uid)
+
+@dicomweb_router.api_route("/{study_id}/dicom_series/{file_name}", methods=["GET", "HEAD"])
+def serve_dicom_file(request: Request, study_id: str, file_name: str):
+    response = _study_file_response(request, study_id, file_name, media_type="application/dicom")
+    if response is None:
+        return JSONResponse(status_code=404, content={"error": "File not found"})
+    return response
+
+@dicomweb_router.api_route("/{study_id}/segmentation/{file_name}", methods=["GET", "HEAD"])
+def serve_segmentation_file(request: Request, study_id: str, file_name: str):
+    # Static files only cover eager storage; lazily stored SEGs live outside UPLOAD_DIR
+    return get_segmentation_file(request, study_id, file_name)
+
+@dicomweb_router.api_route("/studies/{study_uid}/series/{series_uid}/instances", methods=["GET", "HEAD"])
+def get_instances(request: Request, study_uid: str, series_uid: str):
+    return _series_json_response(request, study_uid, INSTANCES_FILENAME, JSONResponse(content=[]))
+
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus text exposition of request/stage latency, bytes, cache and conversion metrics."""
+    return Response(content=render_metrics(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+
+@app.get("/metrics/profiling")
+def get_profiling():
+    return JSONResponse(content=profiling_settings())
+
+
+@app.post("/metrics/profiling")
+def set_profiling(request: Request, enabled: bool = None, sample_rate: float = None):
+    """Switch per-request profiling at runtime; profiled requests (X-Profile header or sampled)
+    are written to PROFILE_DIR as .prof files, named in the X-Profile-File response header.
+
+    Needs PROFILING_TOKEN as a bearer token; refused outright when no token is configured.
+    """
+    if not profiling_authorized(request):
+        raise HTTPException(status_code=403, detail="Profiling control needs the PROFILING_TOKEN bearer token")
+    return JSONResponse(content=configure_profiling(enabled, sample_rate))
+
+
+register_lru_cache("dicomweb_json", load_dicomweb_json)
+register_lru_cache("instance_index", load_instance_index)
+register_lru_cache("series_volume_geometry", series_volume_geometry)
 
 # Include router
 app.include_router(dicomweb_router)
+
+# Mount static directories last so the /dicom DICOMweb routes above take precedence
+app.mount("/dicom", ImmutableStaticFiles(directory=UPLOAD_DIR), name="dicom")
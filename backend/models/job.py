@@ -0,0 +1,76 @@
+from datetime import datetime
+from typing import Optional
+
+from models.study import _connect
+
+# Conversion stages in pipeline order, as reported by process_upload
+STAGES = ["load", "series_write", "seg_write", "finalize"]
+
+_table_ready = False
+
+
+def _jobs():
+    global _table_ready
+    conn = _connect()
+    if not _table_ready:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                study_id TEXT NOT NULL,
+                study_uid TEXT,
+                status TEXT NOT NULL,
+                stage TEXT,
+                error TEXT,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            )
+        """)
+        _table_ready = True
+    return conn
+
+
+def create_job(job_id: str, study_id: str, study_uid: str):
+    now = datetime.now().isoformat()
+    _jobs().execute(
+        """INSERT INTO jobs (job_id, study_id, study_uid, status, stage, created_at, updated_at)
+           VALUES (?, ?, ?, 'queued', NULL, ?, ?)""",
+        (job_id, study_id, study_uid, now, now),
+    )
+
+
+def update_job(job_id: str, status: Optional[str] = None, stage: Optional[str] = None,
+               error: Optional[str] = None):
+    _jobs().execute(
+        """UPDATE jobs SET status = COALESCE(?, status), stage = COALESCE(?, stage),
+                  error = COALESCE(?, error), updated_at = ?
+           WHERE job_id = ?""",
+        (status, stage, error, datetime.now().isoformat(), job_id),
+    )
+
+
+def get_job(job_id: str) -> Optional[dict]:
+    row = _jobs().execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+    if not row:
+        return None
+
+    job = dict(row)
+    if job["status"] == "done":
+        reached = len(STAGES)
+    elif job["stage"] in STAGES:
+        reached = STAGES.index(job["stage"])
+    else:
+        reached = 0
+
+    stages = {}
+    for i, name in enumerate(STAGES):
+        if i < reached:
+            stages[name] = "done"
+        elif i == reached and job["status"] == "running":
+            stages[name] = "running"
+        elif i == reached and job["status"] == "failed":
+            stages[name] = "failed"
+        else:
+            stages[name] = "pending"
+    job["stages"] = stages
+    job["progress"] = reached / len(STAGES)
+    return job
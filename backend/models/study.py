@@ -1,33 +1,343 @@
 import json
+import os
+import re
+import sqlite3
+import threading
 from datetime import datetime
-from pydantic import BaseModel
-from typing import List
+from pydantic import BaseModel, Field
+from typing import List, Optional
 
 METADATA_FILE = "metadata.json"
+CATALOG_DB = os.environ.get("CATALOG_DB", "catalog.db")
+
+_local = threading.local()
+_schema_ready = False
+
 
 class StudyMetadata(BaseModel):
     study_id: str
     study_uid: str
-    study_datetime: str = datetime.now().isoformat()
+    study_datetime: str = Field(default_factory=lambda: datetime.now().isoformat())
     radiography_type: str
     segmentation_classes: List[str]
+    image_sha256: Optional[str] = None
+    mask_sha256: Optional[str] = None
+    # Source NIfTI file names inside the study directory
+    image_file: Optional[str] = None
+    mask_file: Optional[str] = None
+    # Per-label statistics from conversion (see segment_statistics); stored in segment_stats
+    segments: List[dict] = Field(default_factory=list)
 
 
-def save_metadata(metadata: StudyMetadata):
+def _connect():
+    # One connection per thread (and per process, so forked workers never share one)
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid():
+        return conn
+
+    conn = sqlite3.connect(CATALOG_DB, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    _local.conn = conn
+    _local.pid = os.getpid()
+    _ensure_schema(conn)
+    return conn
+
+
+def _ensure_schema(conn):
+    global _schema_ready
+    if _schema_ready:
+        return
+
+    conn.execute("BEGIN IMMEDIATE")
     try:
-        with open(METADATA_FILE, "r") as f:
-            data = json.load(f)
-    except:
-        data = []
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS studies (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                study_id TEXT NOT NULL UNIQUE,
+                study_uid TEXT NOT NULL,
+                study_datetime TEXT NOT NULL,
+                radiography_type TEXT NOT NULL,
+                segmentation_classes TEXT NOT NULL
+            )
+        """)
+        _add_column(conn, "studies", "image_sha256", "TEXT")
+        _add_column(conn, "studies", "mask_sha256", "TEXT")
+        _add_column(conn, "studies", "image_file", "TEXT")
+        _add_column(conn, "studies", "mask_file", "TEXT")
+        # DICOM DA/TM forms of study_datetime, precomputed for QIDO matching and responses
+        _add_column(conn, "studies", "study_date", "TEXT")
+        _add_column(conn, "studies", "study_time", "TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_studies_study_uid ON studies (study_uid)")
+        # Searches return studies in (study_date, seq) order; each filter's index ends in
+        # that key, so matches are read in order and LIMIT stops the scan without a sort
+        conn.execute("DROP INDEX IF EXISTS idx_studies_study_date")
+        conn.execute("DROP INDEX IF EXISTS idx_studies_radiography_type")
+        conn.execute("DROP INDEX IF EXISTS idx_studies_type_date_seq")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_studies_date_seq ON studies (study_date, seq)")
+        # StudyDescription (radiography_type) matching ignores case
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_studies_nocase_type_date_seq "
+            "ON studies (radiography_type COLLATE NOCASE, study_date, seq)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_studies_content ON studies (image_sha256, mask_sha256)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS study_classes (
+                class_name TEXT NOT NULL,
+                study_id TEXT NOT NULL,
+                PRIMARY KEY (class_name, study_id)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS segment_stats (
+                study_id TEXT NOT NULL,
+                label INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                stats TEXT NOT NULL,
+                PRIMARY KEY (study_id, label)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("CREATE TABLE IF NOT EXISTS catalog_meta (key TEXT PRIMARY KEY, value TEXT)")
+        _migrate_metadata_file(conn)
+        _backfill_search_columns(conn)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    _schema_ready = True
 
-    data.append(metadata.dict())
-    with open(METADATA_FILE, "w") as f:
-        json.dump(data, f, indent=2)
 
+def _add_column(conn, table, column, decl):
+    columns = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _migrate_metadata_file(conn):
+    # One-time import of the legacy metadata.json; runs inside the schema transaction
+    # so concurrent workers starting up cannot import it twice.
+    done = conn.execute(
+        "SELECT value FROM catalog_meta WHERE key = 'metadata_json_imported'"
+    ).fetchone()
+    if done:
+        return
 
-def load_all_metadata():
     try:
         with open(METADATA_FILE, "r") as f:
-            return json.load(f)
-    except:
-        return []
+            legacy = json.load(f)
+    except (OSError, ValueError):
+        legacy = []
+
+    for entry in legacy:
+        try:
+            _insert(conn, StudyMetadata(**entry), ignore_existing=True)
+        except Exception as e:
+            print(f"Skipping legacy metadata entry {entry.get('study_id')}: {e}")
+
+    conn.execute(
+        "INSERT INTO catalog_meta (key, value) VALUES ('metadata_json_imported', ?)",
+        (datetime.now().isoformat(),),
+    )
+    print(f"Imported {len(legacy)} studies from {METADATA_FILE} into {CATALOG_DB}")
+
+
+def _backfill_search_columns(conn):
+    # Rows written before study_date / study_classes existed
+    rows = conn.execute(
+        "SELECT study_id, study_datetime, segmentation_classes FROM studies WHERE study_date IS NULL"
+    ).fetchall()
+    for row in rows:
+        study_date, study_time = _dicom_date_time(row["study_datetime"])
+        conn.execute(
+            "UPDATE studies SET study_date = ?, study_time = ? WHERE study_id = ?",
+            (study_date, study_time, row["study_id"]),
+        )
+        _insert_classes(conn, row["study_id"], json.loads(row["segmentation_classes"]))
+
+
+def _dicom_date_time(study_datetime):
+    try:
+        dt = datetime.fromisoformat(study_datetime)
+    except (TypeError, ValueError):
+        dt = datetime.now()
+    return dt.strftime("%Y%m%d"), dt.strftime("%H%M%S")
+
+
+def _insert_classes(conn, study_id, segmentation_classes):
+    conn.executemany(
+        "INSERT OR IGNORE INTO study_classes (class_name, study_id) VALUES (?, ?)",
+        [(name, study_id) for name in segmentation_classes],
+    )
+
+
+def _insert(conn, metadata: StudyMetadata, ignore_existing=False):
+    verb = "INSERT OR IGNORE" if ignore_existing else "INSERT"
+    study_date, study_time = _dicom_date_time(metadata.study_datetime)
+    conn.execute(
+        f"""{verb} INTO studies
+            (study_id, study_uid, study_datetime, radiography_type, segmentation_classes,
+             image_sha256, mask_sha256, study_date, study_time, image_file, mask_file)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (
+            metadata.study_id,
+            metadata.study_uid,
+            metadata.study_datetime,
+            metadata.radiography_type,
+            json.dumps(metadata.segmentation_classes),
+            metadata.image_sha256,
+            metadata.mask_sha256,
+            study_date,
+            study_time,
+            metadata.image_file,
+            metadata.mask_file,
+        ),
+    )
+    _insert_classes(conn, metadata.study_id, metadata.segmentation_classes)
+    _insert_segments(conn, metadata.study_id, metadata.segments)
+
+
+def _insert_segments(conn, study_id, segments):
+    conn.executemany(
+        "INSERT OR REPLACE INTO segment_stats (study_id, label, name, stats) VALUES (?, ?, ?, ?)",
+        [(study_id, segment["label"], segment["name"], json.dumps(segment)) for segment in segments],
+    )
+
+
+def _row_to_dict(row):
+    return {
+        "study_id": row["study_id"],
+        "study_uid": row["study_uid"],
+        "study_datetime": row["study_datetime"],
+        "radiography_type": row["radiography_type"],
+        "segmentation_classes": json.loads(row["segmentation_classes"]),
+        "image_sha256": row["image_sha256"],
+        "mask_sha256": row["mask_sha256"],
+        "study_date": row["study_date"],
+        "study_time": row["study_time"],
+        "image_file": row["image_file"],
+        "mask_file": row["mask_file"],
+    }
+
+
+def save_metadata(metadata: StudyMetadata):
+    conn = _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        _insert(conn, metadata)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def update_segmentation(study_id, mask_sha256, mask_file, segmentation_classes, segments):
+    """Swap in a new mask's classes and statistics; the study keeps its id, UID and series."""
+    conn = _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            """UPDATE studies SET mask_sha256 = ?, mask_file = ?, segmentation_classes = ?
+               WHERE study_id = ?""",
+            (mask_sha256, mask_file, json.dumps(segmentation_classes), study_id),
+        )
+        conn.execute("DELETE FROM study_classes WHERE study_id = ?", (study_id,))
+        conn.execute("DELETE FROM segment_stats WHERE study_id = ?", (study_id,))
+        _insert_classes(conn, study_id, segmentation_classes)
+        _insert_segments(conn, study_id, segments)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def load_all_metadata():
+    rows = _connect().execute("SELECT * FROM studies ORDER BY seq").fetchall()
+    return [_row_to_dict(row) for row in rows]
+
+
+def get_study(study_id: str) -> Optional[dict]:
+    row = _connect().execute(
+        "SELECT * FROM studies WHERE study_id = ?", (study_id,)
+    ).fetchone()
+    return _row_to_dict(row) if row else None
+
+
+def get_study_by_uid(study_uid: str) -> Optional[dict]:
+    row = _connect().execute(
+        "SELECT * FROM studies WHERE study_uid = ? ORDER BY seq LIMIT 1", (study_uid,)
+    ).fetchone()
+    return _row_to_dict(row) if row else None
+
+
+def find_study_by_content(image_sha256: str, mask_sha256: Optional[str] = None) -> Optional[dict]:
+    """The study converted from this exact image, preferring one that also has this mask."""
+    row = _connect().execute(
+        """SELECT * FROM studies WHERE image_sha256 = ?
+           ORDER BY mask_sha256 IS NOT ?, seq LIMIT 1""",
+        (image_sha256, mask_sha256),
+    ).fetchone()
+    return _row_to_dict(row) if row else None
+
+
+def get_segments(study_id: str) -> List[dict]:
+    rows = _connect().execute(
+        "SELECT stats FROM segment_stats WHERE study_id = ? ORDER BY label", (study_id,)
+    ).fetchall()
+    return [json.loads(row["stats"]) for row in rows]
+
+
+def _like_pattern(value):
+    """A DICOM wildcard value (* and ?) as a LIKE pattern escaped with backslash."""
+    escaped = re.sub(r"([\\%_])", r"\\\1", value)
+    return escaped.replace("*", "%").replace("?", "_")
+
+
+def search_studies(study_date=None, radiography_type=None, segmentation_classes=None,
+                   study_uids=None, has_segmentation=False, limit=None, offset=0) -> List[dict]:
+    """QIDO-style study search, oldest study date first, then in upload order.
+
+    study_date is a (first, last) pair of YYYYMMDD strings, either end may be None.
+    radiography_type is matched ignoring case and may use the DICOM wildcards * and ?.
+    segmentation_classes and study_uids match any of the given values; has_segmentation
+    keeps studies with a SEG (any labelled class). Unfiltered, date and plain type
+    searches read an index in result order; a class search starts from study_classes
+    and sorts only its matches.
+    """
+    clauses, params = [], []
+    if study_date:
+        first, last = study_date
+        if first:
+            clauses.append("s.study_date >= ?")
+            params.append(first)
+        if last:
+            clauses.append("s.study_date <= ?")
+            params.append(last)
+    if radiography_type:
+        # A plain value is an equality, which keeps idx_studies_nocase_type_date_seq in date order
+        if "*" in radiography_type or "?" in radiography_type:
+            clauses.append("s.radiography_type LIKE ? ESCAPE '\\'")
+            params.append(_like_pattern(radiography_type))
+        else:
+            clauses.append("s.radiography_type = ? COLLATE NOCASE")
+            params.append(radiography_type)
+    if study_uids:
+        clauses.append(f"s.study_uid IN ({', '.join('?' * len(study_uids))})")
+        params.extend(study_uids)
+    if segmentation_classes:
+        # Looked up by study_classes' primary key, however rare the classes are
+        clauses.append(
+            "s.study_id IN (SELECT c.study_id FROM study_classes c "
+            f"WHERE c.class_name IN ({', '.join('?' * len(segmentation_classes))}))"
+        )
+        params.extend(segmentation_classes)
+    if has_segmentation:
+        clauses.append("s.segmentation_classes != '[]'")
+
+    sql = "SELECT s.* FROM studies s"
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    sql += " ORDER BY s.study_date, s.seq LIMIT ? OFFSET ?"
+    params.extend([-1 if limit is None else limit, offset])
+    return [_row_to_dict(row) for row in _connect().execute(sql, params)]
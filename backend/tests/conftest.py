@@ -0,0 +1,77 @@
+import gzip
+import os
+import sys
+import time
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+
+@pytest.fixture(scope="session")
+def workdir(tmp_path_factory):
+    """The backend keeps uploads/, catalog.db and its caches relative to the working directory."""
+    path = tmp_path_factory.mktemp("backend")
+    previous = os.getcwd()
+    os.chdir(path)
+    yield path
+    os.chdir(previous)
+
+
+@pytest.fixture(scope="session")
+def client(workdir):
+    from fastapi.testclient import TestClient
+
+    import main
+
+    return TestClient(main.app)
+
+
+def nifti_gz(volume, affine=None):
+    """A gzipped NIfTI file's bytes, as a client would upload it."""
+    import nibabel as nib
+    import numpy as np
+
+    return gzip.compress(nib.Nifti1Image(volume, np.eye(4) if affine is None else affine).to_bytes())
+
+
+@pytest.fixture(scope="session")
+def volumes():
+    """A small synthetic image and two masks on its grid (labels from label_dict)."""
+    import numpy as np
+
+    image = np.arange(6 * 8 * 10, dtype=np.int16).reshape(6, 8, 10)
+    mask = np.zeros(image.shape, dtype=np.uint8)
+    mask[1:4, 2:6, 3:7] = 1
+    mask[4, 1:3, 1:3] = 11
+    revised = mask.copy()
+    revised[revised == 11] = 0
+    return {"image": nifti_gz(image), "mask": nifti_gz(mask), "revised_mask": nifti_gz(revised)}
+
+
+def wait_for_job(client, status_url, timeout=120):
+    deadline = time.monotonic() + timeout
+    while True:
+        job = client.get(status_url).json()
+        if job["status"] not in ("queued", "running"):
+            return job
+        assert time.monotonic() < deadline, job
+        time.sleep(0.05)
+
+
+@pytest.fixture(scope="session")
+def upload(client):
+    """POST /upload a pair and wait for its conversion; returns the upload response and body."""
+    def upload(image, mask, radiography_type="CBCT", image_name="image.nii.gz", mask_name="mask.nii.gz"):
+        response = client.post(
+            "/upload",
+            files={"image_file": (image_name, image), "mask_file": (mask_name, mask)},
+            data={"radiography_type": radiography_type},
+        )
+        body = response.json()
+        if response.status_code == 202:
+            body["job"] = wait_for_job(client, body["status_url"])
+        return response, body
+
+    return upload
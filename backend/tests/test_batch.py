@@ -0,0 +1,86 @@
+import hashlib
+import io
+import json
+import os
+import tarfile
+
+import numpy as np
+
+from conftest import nifti_gz, wait_for_job
+from utils.objects import OBJECTS_DIR, object_path
+
+SHAPE = (5, 6, 7)
+
+
+def pair(seed):
+    image = np.full(SHAPE, seed, dtype=np.int16)
+    mask = np.zeros(SHAPE, dtype=np.uint8)
+    mask[1:3, 1:3, 1:3] = 1
+    mask[0, 0, 0] = seed  # keeps every mask's content (and object) distinct
+    return nifti_gz(image), nifti_gz(mask)
+
+
+def post_batch(client, files, data=None):
+    response = client.post("/upload/batch", files=files, data=data or {})
+    assert response.status_code == 200, response.text
+    *results, summary = [json.loads(line) for line in response.text.splitlines()]
+    return sorted(results, key=lambda result: result["index"]), summary
+
+
+def test_a_bad_file_in_the_lists_rejects_only_its_pair(client):
+    good_image, good_mask = pair(101)
+    _, orphan_mask = pair(102)
+    files = [
+        ("image_files", ("good.nii.gz", good_image)),
+        ("image_files", ("bad.nii.gz", b"not a volume" * 100)),
+        ("mask_files", ("good_mask.nii.gz", good_mask)),
+        ("mask_files", ("bad_mask.nii.gz", orphan_mask)),
+    ]
+
+    results, summary = post_batch(client, files, {"radiography_type": "batch-lists"})
+
+    good, bad = results
+    assert good["status"] == "done", good
+    assert good["name"] == "good.nii.gz"
+    assert wait_for_job(client, f"/jobs/{good['job_id']}")["status"] == "done"
+    assert (bad["status"], bad["name"]) == ("rejected", "image_files[1]")
+    assert "bad.nii.gz: not a NIfTI file" in bad["error"]
+    assert summary == {"summary": True, "total": 2, "done": 1, "failed": 0, "rejected": 1}
+    # The rejected pair's mask was stored as it arrived, then released
+    assert not os.path.exists(object_path(hashlib.sha256(orphan_mask).hexdigest(), "bad_mask.nii.gz"))
+
+
+def tar_archive(members):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def test_an_archive_pair_missing_its_mask_is_rejected_and_the_rest_converted(client):
+    image, mask = pair(103)
+    lonely_image, _ = pair(104)
+    archive = tar_archive([
+        ("a/image.nii.gz", image), ("a/mask.nii.gz", mask), ("b/image.nii.gz", lonely_image),
+    ])
+
+    results, summary = post_batch(client, {"archive": ("batch.tar.gz", archive)}, {"concurrency": "1"})
+
+    converted, incomplete = results
+    assert (converted["name"], converted["status"]) == ("a", "done")
+    assert (incomplete["name"], incomplete["status"]) == ("b", "rejected")
+    assert incomplete["error"] == "no mask found for this pair"
+    assert summary == {"summary": True, "total": 2, "done": 1, "failed": 0, "rejected": 1}
+    # Neither the archive's temporary copy nor the unpaired image is left behind
+    assert os.listdir(os.path.join(OBJECTS_DIR, "tmp")) == []
+    assert not os.path.exists(object_path(hashlib.sha256(lonely_image).hexdigest(), "image.nii.gz"))
+
+
+def test_a_batch_without_pairs_is_refused(client):
+    response = client.post("/upload/batch", files={"radiography_type": (None, "CBCT")})
+
+    assert response.status_code == 400
+    assert "archive or image_files" in response.json()["error"]
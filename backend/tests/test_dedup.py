@@ -0,0 +1,54 @@
+import os
+
+import pydicom
+import pytest
+
+from utils.instance_index import load_instance_index
+from utils.storage import dicom_dir, segmentation_path
+
+
+@pytest.fixture(scope="module")
+def original(upload, volumes):
+    response, body = upload(volumes["image"], volumes["mask"])
+    assert response.status_code == 202
+    assert body["job"]["status"] == "done", body["job"]
+    return body
+
+
+def first_instance(study_id):
+    path = dicom_dir(study_id)
+    index = load_instance_index(path)
+    return index, pydicom.dcmread(os.path.join(path, index["instances"][0]["file"]), stop_before_pixels=True)
+
+
+def test_identical_upload_returns_the_existing_study(upload, volumes, original):
+    response, body = upload(volumes["image"], volumes["mask"], image_name="again.nii.gz")
+
+    assert response.status_code == 200
+    assert body["deduplicated"] is True
+    assert (body["study_id"], body["study_uid"]) == (original["study_id"], original["study_uid"])
+    assert "status_url" not in body
+
+
+def test_new_mask_for_a_known_image_becomes_a_study_with_its_own_uids(client, upload, volumes, original):
+    response, body = upload(volumes["image"], volumes["revised_mask"], radiography_type="PANO")
+
+    assert response.status_code == 202
+    assert body["reused_series_of"] == original["study_id"]
+    assert body["job"]["status"] == "done", body["job"]
+
+    new_index, new_header = first_instance(body["study_id"])
+    old_index, old_header = first_instance(original["study_id"])
+    # The files on disk say what the catalog and DICOMweb metadata say
+    assert new_header.StudyInstanceUID == new_index["study_uid"] == body["study_uid"]
+    assert new_header.SeriesInstanceUID == new_index["series_uid"] != old_index["series_uid"]
+    assert new_header.SOPInstanceUID == new_index["instances"][0]["sop_instance_uid"]
+    assert new_header.SOPInstanceUID != old_header.SOPInstanceUID
+    assert pydicom.dcmread(segmentation_path(body["study_id"])).StudyInstanceUID == body["study_uid"]
+
+    # The existing study keeps its mask, classes and SEG
+    old = client.get(f"/studies/{original['study_uid']}/segments").json()
+    new = client.get(f"/studies/{body['study_uid']}/segments").json()
+    assert [s["label"] for s in old] == [1, 11]
+    assert [s["label"] for s in new] == [1]
+    assert old_header.StudyInstanceUID == original["study_uid"]
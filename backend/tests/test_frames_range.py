@@ -0,0 +1,127 @@
+from itertools import accumulate
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from utils.frames import FileSpan, LazyPart, body_response, frames_response, multipart_body
+
+FRAME_LENGTH = 300
+
+
+@pytest.fixture
+def frames_file(tmp_path):
+    """Three 300-byte frames at offset 100 of a file, like pixel data after a DICOM header."""
+    path = tmp_path / "frames.bin"
+    path.write_bytes(bytes(range(256)) * 4)
+    return str(path)
+
+
+@pytest.fixture
+def parts(frames_file):
+    spans = [FileSpan(frames_file, 100 + i * FRAME_LENGTH, FRAME_LENGTH) for i in range(3)]
+    body = multipart_body(spans, "frame-boundary")
+    # A lazily produced part, as volume masks are streamed
+    body.insert(-1, LazyPart(4, lambda: b"lazy"))
+    return body
+
+
+@pytest.fixture
+def full_body(frames_file, parts):
+    with open(frames_file, "rb") as f:
+        data = f.read()
+    return b"".join(
+        data[p.offset:p.offset + p.length] if isinstance(p, FileSpan)
+        else p.produce() if isinstance(p, LazyPart) else p
+        for p in parts
+    )
+
+
+@pytest.fixture
+def client(parts, frames_file):
+    app = FastAPI()
+
+    @app.get("/body")
+    def body(request: Request):
+        return body_response(request, parts, "application/octet-stream")
+
+    @app.get("/frames")
+    def frames(request: Request):
+        return frames_response(request, [FileSpan(frames_file, 100, FRAME_LENGTH), FileSpan(frames_file, 700, 10)])
+
+    return TestClient(app)
+
+
+def get(client, byte_range=None, path="/body"):
+    return client.get(path, headers={"Range": byte_range} if byte_range else {})
+
+
+def test_without_range_the_whole_body_is_served(client, full_body):
+    response = get(client)
+
+    assert response.status_code == 200
+    assert response.content == full_body
+    assert response.headers["accept-ranges"] == "bytes"
+    assert response.headers["content-length"] == str(len(full_body))
+
+
+@pytest.mark.parametrize("byte_range, expected", [
+    ("bytes=0-0", lambda n: (0, 1)),
+    ("bytes=10-99", lambda n: (10, 100)),
+    ("bytes=250-", lambda n: (250, n)),
+    ("bytes=-20", lambda n: (n - 20, n)),          # suffix: the last 20 bytes
+    ("bytes=-100000", lambda n: (0, n)),           # suffix longer than the body
+    ("bytes=100-100000", lambda n: (100, n)),      # last byte past the end is clamped
+])
+def test_satisfiable_ranges_get_206(client, full_body, byte_range, expected):
+    start, end = expected(len(full_body))
+
+    response = get(client, byte_range)
+
+    assert response.status_code == 206
+    assert response.content == full_body[start:end]
+    assert response.headers["content-range"] == f"bytes {start}-{end - 1}/{len(full_body)}"
+    assert response.headers["content-length"] == str(end - start)
+
+
+@pytest.mark.parametrize("byte_range", ["bytes={n}-", "bytes={n}-{m}", "bytes=50-10", "bytes=-0"])
+def test_unsatisfiable_ranges_get_416(client, full_body, byte_range):
+    n = len(full_body)
+
+    response = get(client, byte_range.format(n=n, m=n + 10))
+
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{n}"
+
+
+@pytest.mark.parametrize("byte_range", ["bytes=0-1,5-6", "items=0-10", "bytes=-"])
+def test_unsupported_ranges_are_ignored(client, full_body, byte_range):
+    response = get(client, byte_range)
+
+    assert response.status_code == 200
+    assert response.content == full_body
+
+
+def test_ranges_crossing_part_boundaries(client, parts, full_body):
+    lengths = [p.length if isinstance(p, (FileSpan, LazyPart)) else len(p) for p in parts]
+    for boundary in accumulate(lengths[:-1]):
+        # From inside one part to inside the next, and from inside one part across the following two
+        for start, end in ((boundary - 3, boundary + 3), (boundary - 1, boundary + FRAME_LENGTH + 10)):
+            end = min(end, len(full_body))
+            response = get(client, f"bytes={start}-{end - 1}")
+
+            assert response.status_code == 206
+            assert response.content == full_body[start:end], (start, end)
+
+
+def test_multipart_frames_honour_ranges_across_requests(client):
+    # The boundary comes from the frames, so a later Range request slices the same body
+    whole = get(client, path="/frames")
+    boundary = whole.headers["content-type"].rsplit("boundary=", 1)[1]
+
+    response = get(client, "bytes=-40", path="/frames")
+
+    assert whole.status_code == 200
+    assert whole.content.endswith(f"--{boundary}--\r\n".encode())
+    assert response.status_code == 206
+    assert response.content == whole.content[-40:]
@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+import pytest
+
+from conftest import nifti_gz
+from utils import jobs, storage
+
+
+@pytest.fixture
+def converted_study(upload):
+    """A study converted in the default (eager) storage, so lazy storage has nothing cached for it."""
+    image = np.full((6, 8, 10), 7, dtype=np.int16)
+    mask = np.zeros(image.shape, dtype=np.uint8)
+    mask[2:4, 2:4, 2:4] = 1
+    response, body = upload(nifti_gz(image), nifti_gz(mask), "lazy-cold-read")
+    assert body["job"]["status"] == "done", body["job"]
+    return body
+
+
+@pytest.fixture
+def lazy_storage(monkeypatch):
+    """Lazy storage in this process and in freshly spawned regeneration workers."""
+    monkeypatch.setattr(storage, "STORAGE_MODE", "lazy")
+    monkeypatch.setenv("STORAGE_MODE", "lazy")
+    monkeypatch.setattr(jobs, "_regeneration_pool", None)
+    yield
+    if jobs._regeneration_pool is not None:
+        jobs._regeneration_pool.shutdown()
+
+
+def test_a_cold_read_regenerates_the_study_files(client, converted_study, lazy_storage, monkeypatch):
+    study_id, study_uid = converted_study["study_id"], converted_study["study_uid"]
+    metadata_url = f"/studies/{study_uid}/series/{study_uid}.1/metadata"
+    derived = storage.derived_dir(study_id)
+    assert not os.path.exists(derived)
+
+    # A read that cannot wait is sent away while the regeneration carries on
+    monkeypatch.setattr(storage, "REGENERATION_TIMEOUT", 0)
+    pending = client.get(metadata_url)
+    assert pending.status_code == 503
+    assert pending.headers["retry-after"] == str(storage.REGENERATION_RETRY_AFTER)
+
+    monkeypatch.setattr(storage, "REGENERATION_TIMEOUT", 120)
+    response = client.get(metadata_url)
+
+    assert response.status_code == 200
+    assert {instance["0020000D"]["Value"][0] for instance in response.json()} == {study_uid}
+    assert storage.derived_available(study_id)
+    assert sorted(os.listdir(derived)) == [storage.COMPLETE_MARKER, "dicom_series", "segmentation"]
+    assert client.get(f"/segmentation/{study_id}/segmentation.dcm").status_code == 200
@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+from utils import metrics
+
+TOKEN = "test-profiling-token"
+AUTHORIZED = {"Authorization": f"Bearer {TOKEN}"}
+
+
+@pytest.fixture
+def profiling(client, tmp_path, monkeypatch):
+    """Profiling switched on with a token and a private, empty PROFILE_DIR."""
+    monkeypatch.setattr(metrics, "PROFILING_TOKEN", TOKEN)
+    monkeypatch.setattr(metrics, "PROFILE_DIR", str(tmp_path / "profiles"))
+    monkeypatch.setattr(metrics, "_profile_store", None)
+    monkeypatch.setitem(metrics._profiling, "enabled", True)
+    monkeypatch.setitem(metrics._profiling, "sample_rate", 0.0)
+    return tmp_path / "profiles"
+
+
+def test_metrics_count_requests_by_route_template(client):
+    client.get("/metrics/profiling")
+
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == metrics.PROMETHEUS_CONTENT_TYPE
+    assert 'http_request_duration_seconds_count{method="GET",route="/metrics/profiling",status="200"}' in response.text
+    assert "# TYPE cache_requests_total counter" in response.text
+
+
+def test_profiling_cannot_be_switched_without_the_token(client, monkeypatch):
+    assert client.post("/metrics/profiling?enabled=true").status_code == 403
+
+    monkeypatch.setattr(metrics, "PROFILING_TOKEN", TOKEN)
+    monkeypatch.setitem(metrics._profiling, "enabled", False)
+    wrong = client.post("/metrics/profiling?enabled=true", headers={"Authorization": "Bearer nope"})
+    assert wrong.status_code == 403
+    assert metrics.profiling_settings()["enabled"] is False
+
+    response = client.post("/metrics/profiling?enabled=true&sample_rate=2", headers=AUTHORIZED)
+    assert response.status_code == 200
+    assert response.json() == {"enabled": True, "sample_rate": 1.0}
+
+
+def test_x_profile_needs_the_token(client, profiling):
+    assert "x-profile-file" not in client.get("/metrics/profiling", headers={"X-Profile": "1"}).headers
+
+    response = client.get("/metrics/profiling", headers={"X-Profile": "1", **AUTHORIZED})
+
+    path = response.headers["x-profile-file"]
+    assert os.path.dirname(path) == str(profiling)
+    assert os.path.getsize(path) > 0
+
+
+def test_only_one_request_is_profiled_at_a_time(client, profiling):
+    with metrics._profile_lock:
+        response = client.get("/metrics/profiling", headers={"X-Profile": "1", **AUTHORIZED})
+
+    assert response.status_code == 200
+    assert "x-profile-file" not in response.headers
+    assert not metrics._profile_lock.locked()
+
+
+def test_profile_dir_is_bounded(client, profiling, monkeypatch):
+    monkeypatch.setattr(metrics, "PROFILE_DIR_BYTES", 10 * 1024 ** 2)
+    profiling.mkdir()
+    old = []
+    for age in (3, 2, 1):
+        path = profiling / f"old-{age}.prof"
+        with open(path, "wb") as f:
+            f.truncate(4 * 1024 ** 2)
+        os.utime(path, (10 ** 9 - age, 10 ** 9 - age))
+        old.append(path)
+
+    response = client.get("/metrics/profiling", headers={"X-Profile": "1", **AUTHORIZED})
+
+    # The oldest profile goes to make room; the new one stays
+    assert not old[0].exists()
+    assert old[1].exists() and old[2].exists()
+    assert os.path.exists(response.headers["x-profile-file"])
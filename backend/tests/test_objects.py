@@ -0,0 +1,34 @@
+import os
+
+import numpy as np
+
+from conftest import nifti_gz
+from utils.objects import OBJECTS_DIR
+from utils.storage import UPLOAD_DIR
+
+
+def stored_objects():
+    return sorted(
+        name for directory, _, names in os.walk(OBJECTS_DIR) for name in names
+        if os.path.basename(directory) != "tmp"
+    )
+
+
+def test_objects_are_not_served_with_the_study_files(client, upload, volumes):
+    response, body = upload(volumes["image"], volumes["mask"])
+    assert response.status_code in (200, 202)
+
+    assert os.path.commonpath([os.path.abspath(OBJECTS_DIR), os.path.abspath(UPLOAD_DIR)]) != os.path.abspath(UPLOAD_DIR)
+    for name in stored_objects():
+        assert client.get(f"/dicom/objects/{name[:2]}/{name}").status_code == 404
+
+
+def test_rejected_uploads_leave_no_objects_behind(upload, volumes):
+    upload(volumes["image"], volumes["mask"])
+    before = stored_objects()
+
+    # A mask off the known image's grid is refused once both files are stored
+    response, body = upload(volumes["image"], nifti_gz(np.zeros((2, 3, 4), dtype=np.uint8)))
+
+    assert response.status_code == 400, body
+    assert stored_objects() == before
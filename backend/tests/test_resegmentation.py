@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from conftest import nifti_gz, wait_for_job
+
+SHAPE = (6, 7, 8)
+
+
+@pytest.fixture(scope="module")
+def masks():
+    first = np.zeros(SHAPE, dtype=np.uint8)
+    first[1:4, 2:5, 3:6] = 1
+    first[5, 0:2, 0:2] = 11
+    revised = first.copy()
+    revised[revised == 11] = 0
+    revised[1:3, 2:6, 3:7] = 1
+    return first, revised
+
+
+@pytest.fixture(scope="module")
+def study(upload, masks):
+    image = np.arange(np.prod(SHAPE), dtype=np.int16).reshape(SHAPE) % 200
+    response, body = upload(nifti_gz(image), nifti_gz(masks[0]), "resegmentation")
+    assert body["job"]["status"] == "done", body["job"]
+    return body
+
+
+def get(client, url, etag=None):
+    return client.get(url, headers={"If-None-Match": etag} if etag else {})
+
+
+def test_cached_responses_revalidate_until_the_mask_changes(client, study, masks):
+    study_uid = study["study_uid"]
+    urls = [
+        f"/segmentation/{study['study_id']}/segmentation.dcm",
+        f"/studies/{study_uid}/segments",
+        f"/studies/{study_uid}/volume?component=mask",
+    ]
+    etags = {}
+    for url in urls:
+        response = get(client, url)
+        assert response.status_code == 200, url
+        etags[url] = response.headers["etag"]
+        unchanged = get(client, url, etags[url])
+        assert (unchanged.status_code, unchanged.content) == (304, b""), url
+
+    response = client.post(
+        f"/studies/{study['study_id']}/segmentation", files={"mask_file": ("revised_mask.nii.gz", nifti_gz(masks[1]))},
+    )
+    assert response.status_code == 202, response.text
+    assert wait_for_job(client, response.json()["status_url"])["status"] == "done"
+
+    for url in urls:
+        response = get(client, url, etags[url])
+        assert response.status_code == 200, url
+        assert response.headers["etag"] != etags[url], url
+    segments = client.get(f"/studies/{study_uid}/segments").json()
+    assert [segment["label"] for segment in segments] == [1]
+    assert segments[0]["voxel_count"] == int((masks[1] == 1).sum())
+    mask = get(client, f"/studies/{study_uid}/volume?component=mask").content
+    assert np.array_equal(np.frombuffer(mask, dtype=np.uint8).reshape(SHAPE), masks[1])
+
+
+def test_a_mask_off_the_image_grid_is_refused(client, study):
+    response = client.post(
+        f"/studies/{study['study_id']}/segmentation",
+        files={"mask_file": ("mask.nii.gz", nifti_gz(np.zeros((2, 3, 4), dtype=np.uint8)))},
+    )
+
+    assert response.status_code == 400
+    assert "does not match" in response.json()["error"]
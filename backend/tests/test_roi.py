@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from conftest import nifti_gz
+
+SHAPE = (6, 7, 8)
+
+
+@pytest.fixture(scope="module")
+def study(upload):
+    image = np.arange(np.prod(SHAPE), dtype=np.int16).reshape(SHAPE) % 150
+    mask = np.zeros(SHAPE, dtype=np.uint8)
+    mask[1:4, 2:5, 3:6] = 1
+    mask[5, 0:2, 0:2] = 11
+    response, body = upload(nifti_gz(image), nifti_gz(mask), "roi")
+    assert body["job"]["status"] == "done", body["job"]
+    return body, image, mask
+
+
+def roi(client, study_uid, label, **params):
+    return client.get(f"/studies/{study_uid}/segments/{label}/roi", params={"format": "raw", **params})
+
+
+def crop(response):
+    shape = tuple(int(v) for v in response.headers["x-volume-shape"].split(","))
+    return np.frombuffer(response.content, dtype=response.headers["x-volume-dtype"]).reshape(shape)
+
+
+def test_roi_is_cropped_to_the_label_box_plus_margin(client, study):
+    body, image, mask = study
+
+    response = roi(client, body["study_uid"], 1, component="mask", margin=1)
+
+    assert response.status_code == 200
+    assert response.headers["x-volume-offset"] == "0,1,2"
+    assert np.array_equal(crop(response), mask[0:5, 1:6, 2:7])
+    # Labels are found by class name too, and margins stop at the volume edge
+    by_name = roi(client, body["study_uid"], "Lower Jawbone", margin=3)
+    assert np.array_equal(crop(by_name), image[0:6, 0:7, 0:8])
+
+
+def test_repeat_requests_revalidate_and_unknown_labels_are_404(client, study):
+    body, _, _ = study
+    first = roi(client, body["study_uid"], 11)
+
+    again = client.get(
+        f"/studies/{body['study_uid']}/segments/11/roi", params={"format": "raw"},
+        headers={"If-None-Match": first.headers["etag"]},
+    )
+
+    assert first.status_code == 200
+    assert again.status_code == 304
+    assert roi(client, body["study_uid"], "Nothing").status_code == 404
+    assert roi(client, body["study_uid"], 1, margin=-1).status_code == 400
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from highdicom.seg import segread
+
+from utils.conversion import _pack_bits, create_dicom_segmentation, nifti_to_dicom_series, slice_label_counts
+
+
+@pytest.mark.parametrize("shape", [(1, 1), (3, 5), (7, 9), (8, 8)])
+def test_pack_bits_is_one_continuous_stream(shape):
+    rng = np.random.default_rng(0)
+    frames = [rng.random(shape) > 0.5 for _ in range(5)]
+
+    packed = b"".join(_pack_bits(iter(frames)))
+
+    assert packed == np.packbits(np.concatenate([f.ravel() for f in frames]), bitorder="little").tobytes()
+
+
+def test_seg_round_trips_through_highdicom(tmp_path):
+    # 5 x 7 = 35 bits per frame: every frame after the first starts mid-byte
+    depth, rows, columns = 6, 5, 7
+    image = np.arange(depth * rows * columns, dtype=np.uint8).reshape(depth, rows, columns)
+    mask = np.zeros((depth, rows, columns), dtype=np.uint8)
+    mask[1:4, 1:4, 2:6] = 1
+    mask[2, 0, :] = 11
+    mask[4, 3:, 5:] = 11
+    dicom_dir = tmp_path / "dicom_series"
+    nifti_to_dicom_series(image, str(dicom_dir), study_uid="2.25.1234", workers=1)
+    output_path = str(tmp_path / "segmentation.dcm")
+
+    labels = create_dicom_segmentation(mask, str(dicom_dir), output_path, slice_label_counts(mask), mask_sha256="ab")
+
+    seg = segread(output_path)
+    assert labels == [1, 11]
+    assert list(seg.get_segment_numbers()) == [1, 2]
+    assert seg.StudyInstanceUID == "2.25.1234"
+    # Only slices holding a segment get a frame: 1, 2, 3 for label 1 and 2, 4 for label 11
+    frames = [
+        (frame.SegmentIdentificationSequence[0].ReferencedSegmentNumber,
+         frame.FrameContentSequence[0].DimensionIndexValues[1] - 1)
+        for frame in seg.PerFrameFunctionalGroupsSequence
+    ]
+    assert sorted(frames) == [(1, 1), (1, 2), (1, 3), (2, 2), (2, 4)]
+    pixels = seg.pixel_array.reshape(len(frames), rows, columns)
+    for (segment_number, z), frame_pixels in zip(frames, pixels):
+        assert np.array_equal(frame_pixels, mask[z] == labels[segment_number - 1]), (segment_number, z)
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from conftest import nifti_gz
+
+AFFINE = np.array([
+    [0.5, 0.0, 0.0, 10.0],
+    [0.0, 0.8, 0.0, 20.0],
+    [0.0, 0.0, 1.2, 30.0],
+    [0.0, 0.0, 0.0, 1.0],
+])
+
+
+@pytest.fixture(scope="module")
+def scaled_study(upload):
+    """A study whose NIfTI affine has anisotropic spacing and an offset origin."""
+    image = np.arange(4 * 5 * 6, dtype=np.int16).reshape(4, 5, 6)
+    mask = np.zeros(image.shape, dtype=np.uint8)
+    mask[1:3, 2:4, 3:5] = 1
+    response, body = upload(nifti_gz(image, AFFINE), nifti_gz(mask, AFFINE), "volume-geometry")
+    assert body["job"]["status"] == "done", body["job"]
+    return body["study_uid"], image, mask
+
+
+def floats(header):
+    return [float(v) for v in header.split(",")]
+
+
+def test_volume_geometry_comes_from_the_nifti_affine(client, scaled_study):
+    study_uid, image, _ = scaled_study
+
+    response = client.get(f"/studies/{study_uid}/volume")
+
+    assert response.status_code == 200
+    assert response.headers["x-volume-shape"] == "4,5,6"
+    assert np.array_equal(np.frombuffer(response.content, dtype=response.headers["x-volume-dtype"]).reshape(4, 5, 6), image)
+    # Columns, rows and slices are NIfTI k, j and i, in LPS (the header stores float32)
+    assert floats(response.headers["x-volume-spacing"]) == pytest.approx([1.2, 0.8, 0.5])
+    assert floats(response.headers["x-volume-origin"]) == pytest.approx([-10.0, -20.0, 30.0])
+    assert floats(response.headers["x-volume-direction"]) == [0, 0, 1, 0, -1, 0, -1, 0, 0]
+    assert floats(response.headers["x-volume-affine"]) == pytest.approx(AFFINE.ravel().tolist())
+
+
+def test_volume_geometry_agrees_with_segment_statistics(client, scaled_study):
+    study_uid, _, mask = scaled_study
+    headers = client.get(f"/studies/{study_uid}/volume?component=mask&format=nrrd").headers
+    segment = client.get(f"/studies/{study_uid}/segments").json()[0]
+
+    spacing, origin = floats(headers["x-volume-spacing"]), np.array(floats(headers["x-volume-origin"]))
+    direction = np.array(floats(headers["x-volume-direction"])).reshape(3, 3)
+    # The corner of the segment's first voxel, placed with the volume headers and flipped back to RAS
+    slice_, row, column = np.array(segment["bounding_box"]["min"]) - 0.5
+    lps = origin + column * spacing[0] * direction[0] + row * spacing[1] * direction[1] + slice_ * spacing[2] * direction[2]
+
+    assert np.allclose(lps * [-1, -1, 1], segment["bounding_box_mm"]["min"])
+    assert segment["volume_mm3"] == pytest.approx(int(mask.sum()) * np.prod(spacing))
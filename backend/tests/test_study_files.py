@@ -0,0 +1,25 @@
+import pytest
+
+
+@pytest.mark.parametrize("path", [
+    "/dicom/%2E%2E/catalog.db",
+    "/dicom/%2e%2e/secret.txt",
+    "/dicom/uploads/..%2Fsecret.txt",
+    "/dicom/%2E%2E/dicom_series/secret.txt",
+])
+def test_encoded_parent_paths_are_not_served(client, workdir, path):
+    (workdir / "secret.txt").write_text("not for clients")
+
+    response = client.get(path)
+
+    assert response.status_code == 404
+    assert b"not for clients" not in response.content
+    assert b"SQLite" not in response.content
+
+
+def test_files_of_unknown_studies_are_not_served(client, workdir):
+    study_dir = workdir / "uploads" / "not-catalogued"
+    study_dir.mkdir(parents=True)
+    (study_dir / "image.nii").write_bytes(b"\0" * 16)
+
+    assert client.get("/dicom/not-catalogued/image.nii").status_code == 404
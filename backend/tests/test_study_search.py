@@ -0,0 +1,113 @@
+import json
+
+import pytest
+
+FIXTURE_UIDS = {f"2.25.{i}" for i in range(5)}
+
+
+@pytest.fixture
+def catalog(workdir):
+    from models import study
+
+    conn = study._connect()
+    conn.execute("BEGIN")
+    for i, (date, radiography_type, class_name) in enumerate([
+        ("20240301", "CBCT", "Lower Jawbone"),
+        ("20240101", "PANO", "Lower Jawbone"),
+        ("20240201", "CBCT", "Upper Jawbone"),
+        ("20240101", "CBCT", "Upper Jawbone"),
+        ("20240401", "cbct", None),  # an empty mask: no SEG series
+    ]):
+        conn.execute(
+            """INSERT INTO studies (study_id, study_uid, study_datetime, radiography_type,
+                                    segmentation_classes, study_date, study_time)
+               VALUES (?, ?, ?, ?, ?, ?, '000000')""",
+            (f"search-{i}", f"2.25.{i}", f"{date}T00:00:00", radiography_type,
+             json.dumps([class_name] if class_name else []), date),
+        )
+        if class_name:
+            conn.execute("INSERT INTO study_classes VALUES (?, ?)", (class_name, f"search-{i}"))
+    conn.execute("COMMIT")
+    yield study
+    conn.execute("DELETE FROM study_classes WHERE study_id LIKE 'search-%'")
+    conn.execute("DELETE FROM studies WHERE study_id LIKE 'search-%'")
+
+
+def query_plan(study, **filters):
+    """EXPLAIN QUERY PLAN of the statement search_studies runs for these filters."""
+    conn = study._connect()
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        study.search_studies(**filters, limit=10)
+    finally:
+        conn.set_trace_callback(None)
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + statements[-1])]
+
+
+def ids(studies):
+    return [s["study_id"] for s in studies if s["study_id"].startswith("search-")]
+
+
+def test_results_come_in_study_date_then_upload_order(catalog):
+    assert ids(catalog.search_studies()) == ["search-1", "search-3", "search-2", "search-0", "search-4"]
+    assert ids(catalog.search_studies(radiography_type="CBCT")) == ["search-3", "search-2", "search-0", "search-4"]
+    assert ids(catalog.search_studies(radiography_type="P*")) == ["search-1"]
+    assert ids(catalog.search_studies(radiography_type="c?c*")) == ["search-3", "search-2", "search-0", "search-4"]
+    assert ids(catalog.search_studies(radiography_type="%")) == []
+    assert ids(catalog.search_studies(segmentation_classes=["Upper Jawbone"])) == ["search-3", "search-2"]
+    assert ids(catalog.search_studies(
+        segmentation_classes=["Lower Jawbone", "Upper Jawbone"], study_date=("20240201", None),
+    )) == ["search-2", "search-0"]
+    assert ids(catalog.search_studies(study_date=("20240201", None))) == ["search-2", "search-0", "search-4"]
+    assert ids(catalog.search_studies(has_segmentation=True)) == ["search-1", "search-3", "search-2", "search-0"]
+
+
+@pytest.mark.parametrize("filters", [
+    {},
+    {"study_date": ("20240101", "20240201")},
+    {"radiography_type": "CBCT"},
+    {"radiography_type": "cbct", "study_date": ("20240201", None)},
+])
+def test_searches_read_an_index_in_result_order(catalog, filters):
+    plan = query_plan(catalog, **filters)
+
+    assert not any(step.startswith("SCAN s") and "USING INDEX" not in step for step in plan), plan
+    assert not any("TEMP B-TREE" in step for step in plan), plan
+
+
+def test_class_searches_start_from_the_class_index(catalog):
+    plan = query_plan(catalog, segmentation_classes=["Lower Jawbone", "Upper Jawbone"])
+
+    assert any(step.startswith("SEARCH c USING PRIMARY KEY (class_name=?)") for step in plan), plan
+    assert not any(step.startswith("SCAN") for step in plan), plan
+
+
+def search(client, **params):
+    return [s for s in client.get("/studies", params=params).json() if s["0020000D"]["Value"][0] in FIXTURE_UIDS]
+
+
+def test_studies_report_their_ct_and_seg_series(catalog, client):
+    studies = search(client, includefield="ModalitiesInStudy,NumberOfStudyRelatedSeries")
+
+    reported = {s["0020000D"]["Value"][0]: (s["00080061"]["Value"], s["00201206"]["Value"]) for s in studies}
+    assert reported == {
+        **{f"2.25.{i}": (["CT", "SEG"], [2]) for i in range(4)},
+        "2.25.4": (["CT"], [1]),
+    }
+
+
+@pytest.mark.parametrize("modalities, expected", [
+    ("CT", 5),
+    ("SEG", 4),
+    ("CT,SEG", 5),
+    ("MR", 0),
+    ("MR,SEG", 4),
+])
+def test_modalities_in_study_match_ct_and_seg(catalog, client, modalities, expected):
+    assert len(search(client, ModalitiesInStudy=modalities)) == expected
+
+
+def test_study_description_ignores_case(catalog, client):
+    assert len(search(client, StudyDescription="cbct")) == 4
+    assert len(search(client, StudyDescription="Pa*")) == 1
@@ -0,0 +1,118 @@
+import asyncio
+import gzip
+import hashlib
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+from fastapi import HTTPException
+
+from utils.upload import stream_form
+
+BOUNDARY = "test-boundary"
+
+
+class StreamedRequest:
+    """Just enough of a Starlette request for stream_form; records how much body was read."""
+
+    def __init__(self, chunks):
+        self.headers = {"content-type": f"multipart/form-data; boundary={BOUNDARY}"}
+        self.chunks = chunks
+        self.read = 0
+
+    async def stream(self):
+        for chunk in self.chunks:
+            self.read += 1
+            yield chunk
+
+
+def part(name, data, filename=None):
+    disposition = f'form-data; name="{name}"' + (f'; filename="{filename}"' if filename else "")
+    return f"--{BOUNDARY}\r\nContent-Disposition: {disposition}\r\n\r\n".encode() + data + b"\r\n"
+
+
+def nifti_bytes(offset=0):
+    volume = np.arange(offset, offset + 4 * 5 * 6, dtype=np.int16).reshape(4, 5, 6)
+    return gzip.compress(nib.Nifti1Image(volume, np.eye(4)).to_bytes())
+
+
+def split(body, size):
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+
+def parse(request, tmp_path):
+    paths = iter(range(100))
+    return asyncio.run(
+        stream_form(request, ("image_file", "mask_file"), lambda name: str(tmp_path / f"{next(paths)}-{name}"))
+    )
+
+
+def test_files_are_hashed_and_written_as_they_arrive(tmp_path):
+    image, mask = nifti_bytes(), nifti_bytes(offset=1)
+    body = (
+        part("image_file", image, "image.nii.gz")
+        + part("radiography_type", b"CBCT")
+        + part("mask_file", mask, "../mask.nii.gz")
+        + f"--{BOUNDARY}--\r\n".encode()
+    )
+    # Small chunks make headers, boundaries and file data straddle reads
+    fields, files = parse(StreamedRequest(split(body, 7)), tmp_path)
+
+    assert fields == {"radiography_type": "CBCT"}
+    filename, path, sha256, size = files["mask_file"]
+    assert filename == "mask.nii.gz"
+    assert os.path.dirname(path) == str(tmp_path)
+    assert (sha256, size) == (hashlib.sha256(mask).hexdigest(), len(mask))
+    with open(files["image_file"][1], "rb") as f:
+        assert f.read() == image
+
+
+def test_bad_header_is_rejected_before_the_rest_of_the_body_is_read(tmp_path, monkeypatch):
+    monkeypatch.setattr("utils.upload.UPLOAD_CHUNK_SIZE", 1024)
+    body = part("image_file", b"not a volume" * 1000, "image.nii.gz") + part("mask_file", nifti_bytes(), "mask.nii.gz")
+    request = StreamedRequest(split(body, 512))
+
+    with pytest.raises(HTTPException) as error:
+        parse(request, tmp_path)
+
+    assert error.value.status_code == 400
+    assert "not a NIfTI file" in error.value.detail
+    assert request.read < len(request.chunks) // 2
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize("body, status", [
+    (part("image_file", nifti_bytes(), "image.nii.gz"), 400),  # no mask_file
+    (part("image_file", b"", "image.nii.gz") + part("mask_file", b"x", "mask.nii.gz"), 400),  # empty file
+    (part("other", nifti_bytes(), "other.nii.gz"), 400),  # unexpected file field
+    (part("radiography_type", b"x" * 100_000), 413),
+])
+def test_malformed_forms_are_rejected_and_cleaned_up(tmp_path, body, status):
+    with pytest.raises(HTTPException) as error:
+        parse(StreamedRequest([body + f"--{BOUNDARY}--\r\n".encode()]), tmp_path)
+
+    assert error.value.status_code == status
+    assert os.listdir(tmp_path) == []
+
+
+def test_a_bad_file_of_a_repeated_field_only_loses_that_file(tmp_path):
+    first, third = nifti_bytes(), nifti_bytes(offset=2)
+    body = (
+        part("image_files", first, "first.nii.gz")
+        + part("image_files", b"not a volume", "second.nii.gz")
+        + part("image_files", third, "third.nii.gz")
+        + f"--{BOUNDARY}--\r\n".encode()
+    )
+    paths = iter(range(100))
+
+    fields, files = asyncio.run(stream_form(
+        StreamedRequest(split(body, 64)), (), lambda name: str(tmp_path / f"{next(paths)}-{name}"),
+        multiple=("image_files",),
+    ))
+
+    first_entry, rejected, third_entry = files["image_files"]
+    assert isinstance(rejected, HTTPException) and "second.nii.gz: not a NIfTI file" in rejected.detail
+    assert (first_entry[0], first_entry[2]) == ("first.nii.gz", hashlib.sha256(first).hexdigest())
+    assert (third_entry[0], third_entry[2]) == ("third.nii.gz", hashlib.sha256(third).hexdigest())
+    assert sorted(os.listdir(tmp_path)) == ["0-first.nii.gz", "2-third.nii.gz"]
@@ -0,0 +1,42 @@
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from utils import volumes
+
+
+@pytest.fixture
+def volume_cache(tmp_path, monkeypatch):
+    cache = volumes._VolumeCache("volume", str(tmp_path / "volume_cache"), 10 ** 9)
+    monkeypatch.setattr(volumes, "_cache", cache)
+    return cache
+
+
+def cached_files(cache):
+    return sorted(os.path.join(d, f) for d, _, names in os.walk(cache.directory) for f in names)
+
+
+def test_compressed_volumes_are_decoded_into_the_bounded_cache(tmp_path, volume_cache):
+    source = tmp_path / "study" / "mask.nii.gz"
+    source.parent.mkdir()
+    expected = np.arange(3 * 4 * 5, dtype=np.uint8).reshape(3, 4, 5)
+    nib.save(nib.Nifti1Image(expected, np.diag([2.0, 2.0, 3.0, 1.0])), source)
+
+    data, affine, zooms = volumes.open_volume(str(source))
+
+    assert np.array_equal(data, expected)
+    assert zooms == (2.0, 2.0, 3.0)
+    assert os.listdir(source.parent) == ["mask.nii.gz"]
+    assert [os.path.splitext(f)[1] for f in cached_files(volume_cache)] == [".json", ".npy"]
+
+    # Over quota, both files of an entry go; the next open decodes the source again
+    volume_cache.max_bytes = 1
+    volume_cache.added(0)
+    assert cached_files(volume_cache) == []
+    assert np.array_equal(volumes.open_volume(str(source))[0], expected)
+
+    volumes.discard_volume(str(source))
+    assert cached_files(volume_cache) == []
+    assert not source.exists()
@@ -0,0 +1,301 @@
+import asyncio
+import json
+import os
+import posixpath
+import tarfile
+import zipfile
+
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+
+from utils.jobs import CONVERSION_WORKERS, submit_upload
+from utils.metrics import upload_bytes
+from utils.objects import release_objects, store_stream
+from utils.upload import is_mask_filename, is_nifti_filename
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", CONVERSION_WORKERS))
+BATCH_MEDIA_TYPE = "application/x-ndjson"
+MANIFEST_NAME = "manifest.json"
+
+
+def parse_manifest(text, require_files=False):
+    """Manifest entries as dicts; an entry may be just a radiography_type string.
+
+    Archive manifests pair files by path, so they need "image" and "mask" keys.
+    """
+    try:
+        entries = json.loads(text)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"manifest is not valid JSON: {e}")
+    if isinstance(entries, dict):
+        entries = entries.get("pairs")
+    if not isinstance(entries, list):
+        raise HTTPException(status_code=400, detail="manifest must be a list of pairs")
+
+    parsed = []
+    for i, entry in enumerate(entries):
+        if isinstance(entry, str):
+            entry = {"radiography_type": entry}
+        if not isinstance(entry, dict):
+            raise HTTPException(status_code=400, detail=f"manifest entry {i} must be an object")
+        if require_files and not (entry.get("image") and entry.get("mask")):
+            raise HTTPException(status_code=400, detail=f"manifest entry {i} needs image and mask paths")
+        parsed.append(entry)
+    return parsed
+
+
+def _member_path(name):
+    return posixpath.normpath(name.lstrip("/"))
+
+
+def _skipped_member(path):
+    # macOS resource forks carry the .nii.gz name but are not volumes
+    return path.startswith("__MACOSX/") or posixpath.basename(path).startswith("._")
+
+
+def open_archive(fileobj):
+    """A ZipFile or a streaming TarFile (any compression) over the uploaded archive."""
+    fileobj.seek(0)
+    if zipfile.is_zipfile(fileobj):
+        fileobj.seek(0)
+        return zipfile.ZipFile(fileobj)
+    fileobj.seek(0)
+    try:
+        return tarfile.open(fileobj=fileobj, mode="r|*")
+    except tarfile.TarError:
+        raise HTTPException(status_code=400, detail="archive must be a zip or tar file")
+
+
+def archive_members(archive):
+    """(path, file object) of each regular file, manifest.json first when a zip has one.
+
+    Tar archives are read strictly in order, one member at a time.
+    """
+    if isinstance(archive, zipfile.ZipFile):
+        infos = [info for info in archive.infolist() if not info.is_dir()]
+        infos.sort(key=lambda info: _member_path(info.filename) != MANIFEST_NAME)
+        for info in infos:
+            with archive.open(info) as stream:
+                yield _member_path(info.filename), stream
+        return
+    for member in archive:
+        if member.isfile():
+            yield _member_path(member.name), archive.extractfile(member)
+
+
+class BatchRunner:
+    """Feeds pairs to the conversion pool at most `concurrency` at a time and
+    reports each outcome as soon as it is known.
+
+    Pairs may be added from any thread. Submitting a pair blocks (it hashes and
+    links files), so it runs in the threadpool; the bookkeeping stays on the event loop.
+    """
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self._loop = asyncio.get_running_loop()
+        self._results = asyncio.Queue()
+        self._pending = []
+        self._in_flight = 0
+        self._tasks = set()
+        self._closed = False
+        self.counts = {"done": 0, "failed": 0, "rejected": 0}
+
+    def add(self, pair):
+        self._loop.call_soon_threadsafe(self._add, pair)
+
+    def reject(self, index, name, error):
+        self._loop.call_soon_threadsafe(self._report, {
+            "index": index, "name": name, "status": "rejected", "error": error,
+        })
+
+    def close(self):
+        """No more pairs are coming."""
+        self._loop.call_soon_threadsafe(self._close)
+
+    async def results(self):
+        while True:
+            result = await self._results.get()
+            if result is None:
+                return
+            yield result
+
+    def summary(self):
+        return {"summary": True, "total": sum(self.counts.values()), **self.counts}
+
+    def _add(self, pair):
+        self._pending.append(pair)
+        self._pump()
+
+    def _close(self):
+        self._closed = True
+        self._pump()
+
+    def _report(self, result):
+        self.counts[result["status"]] += 1
+        self._results.put_nowait(result)
+
+    def _pump(self):
+        while self._pending and self._in_flight < self.concurrency:
+            self._in_flight += 1
+            task = asyncio.ensure_future(self._dispatch(self._pending.pop(0)))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        if self._closed and not self._pending and self._in_flight == 0:
+            self._results.put_nowait(None)
+
+    async def _dispatch(self, pair):
+        result = {"index": pair["index"], "name": pair["name"]}
+        try:
+            submitted, future = await run_in_threadpool(
+                submit_upload, pair["image"], pair["mask"], pair["radiography_type"]
+            )
+        except Exception as e:
+            release_objects(pair["image"][1], pair["mask"][1])
+            self._done({**result, "status": "failed", "error": str(e)})
+            return
+        result.update(submitted)
+        if future is None:
+            # Already converted from identical files
+            self._done({**result, "status": "done"})
+            return
+        future.add_done_callback(
+            lambda f: self._loop.call_soon_threadsafe(self._finished, result, f)
+        )
+
+    def _finished(self, result, future):
+        error = future.exception()
+        if error is None:
+            result.update(status="done", segmentation_classes=future.result()["segmentation_classes"])
+        else:
+            result.update(status="failed", error=str(error) or type(error).__name__)
+        self._done(result)
+
+    def _done(self, result):
+        self._in_flight -= 1
+        self._report(result)
+        self._pump()
+
+
+class _ArchivePair:
+    def __init__(self, index, name, radiography_type):
+        self.index = index
+        self.name = name
+        self.radiography_type = radiography_type
+        self.files = {}
+        self.error = None
+
+    def save(self, role, path, stream):
+        sha256, size, stored = store_stream(stream, path)
+        upload_bytes.inc(size)
+        self.files[role] = (sha256, stored, posixpath.basename(path))
+
+    def as_job(self):
+        return {
+            "index": self.index, "name": self.name, "radiography_type": self.radiography_type,
+            "image": self.files["image"], "mask": self.files["mask"],
+        }
+
+    def fail(self, error):
+        self.error = error
+        release_objects(*(stored for _, stored, _ in self.files.values()))
+
+
+def ingest_archive(runner, archive, manifest, radiography_type):
+    """Extract an archive entry by entry and hand each pair to the runner once both files are on disk.
+
+    With a manifest (form field or manifest.json at the archive root, ahead of the
+    volumes), pairs are the listed image/mask paths. Without one, every directory
+    holding one image and one mask (told apart by name) is a pair.
+    """
+    pairs = []
+    by_path = {}
+    by_directory = {}
+
+    def use_manifest(entries):
+        for entry in entries:
+            pair = _ArchivePair(len(pairs), entry.get("name") or _member_path(entry["image"]),
+                                entry.get("radiography_type") or radiography_type)
+            pairs.append(pair)
+            by_path[_member_path(entry["image"])] = (pair, "image")
+            by_path[_member_path(entry["mask"])] = (pair, "mask")
+
+    if manifest is not None:
+        use_manifest(manifest)
+
+    try:
+        for path, stream in archive_members(archive):
+            if _skipped_member(path):
+                continue
+            if path == MANIFEST_NAME and manifest is None and not pairs:
+                manifest = parse_manifest(stream.read().decode("utf-8"), require_files=True)
+                use_manifest(manifest)
+                continue
+            if not is_nifti_filename(path):
+                continue
+
+            if manifest is not None:
+                if path not in by_path:
+                    continue
+                pair, role = by_path[path]
+            else:
+                directory = posixpath.dirname(path)
+                pair = by_directory.get(directory)
+                if pair is None or pair.error is None and len(pair.files) == 2:
+                    pair = by_directory[directory] = _ArchivePair(len(pairs), directory or path, radiography_type)
+                    pairs.append(pair)
+                role = "mask" if is_mask_filename(path) else "image"
+                if role in pair.files:
+                    pair.fail(f"{path}: more than one {role} in {directory or 'the archive root'}")
+                    runner.reject(pair.index, pair.name, pair.error)
+
+            if pair.error is not None:
+                continue
+            try:
+                pair.save(role, path, stream)
+            except HTTPException as e:
+                pair.fail(e.detail)
+                runner.reject(pair.index, pair.name, pair.error)
+                continue
+            if len(pair.files) == 2:
+                runner.add(pair.as_job())
+    finally:
+        archive.close()
+
+    for pair in pairs:
+        if pair.error is None and len(pair.files) < 2:
+            missing = "mask" if "image" in pair.files else "image"
+            pair.fail(f"no {missing} found for this pair")
+            runner.reject(pair.index, pair.name, pair.error)
+
+
+def ingest_uploads(runner, images, masks, manifest, radiography_type):
+    """Pairs sent as parallel image_files/mask_files lists, matched by position.
+
+    Entries are as store_form returns them: a stored file, or the HTTPException that
+    rejected it. A pair with a rejected file is reported and its other file released.
+    """
+    for index, (image, mask) in enumerate(zip(images, masks)):
+        entry = manifest[index] if manifest else {}
+        rejected = [f for f in (image, mask) if isinstance(f, HTTPException)]
+        name = entry.get("name") or (f"image_files[{index}]" if isinstance(image, HTTPException) else image[3])
+        if rejected:
+            release_objects(*(f[2] for f in (image, mask) if not isinstance(f, HTTPException)))
+            runner.reject(index, name, rejected[0].detail)
+            continue
+        upload_bytes.inc(image[1] + mask[1])
+        runner.add({
+            "index": index, "name": name,
+            "radiography_type": entry.get("radiography_type") or radiography_type,
+            "image": (image[0], image[2], image[3]),
+            "mask": (mask[0], mask[2], mask[3]),
+        })
+
+
+def discard_batch_files(files):
+    """Remove what store_form kept of a batch request that is rejected as a whole."""
+    if "archive" in files:
+        os.remove(files["archive"][1])
+    release_objects(*(
+        entry[2] for name in ("image_files", "mask_files") for entry in files.get(name, [])
+        if not isinstance(entry, HTTPException)
+    ))
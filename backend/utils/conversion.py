@@ -1,6 +1,9 @@
 import os
+import shutil
+import struct
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import nibabel as nib
 import SimpleITK as sitk
@@ -9,153 +12,766 @@ from datetime import datetime
 from pydicom.uid import generate_uid
 
 from utils.label_dict import label_dict
-from highdicom.seg.sop import Segmentation
-from highdicom.content import AlgorithmIdentificationSequence
+from utils.instance_index import index_entry, load_instance_index, write_instance_index
+from utils.dicomweb import write_dicomweb_json
+from utils.render import render_thumbnail
+from utils.storage import derived_available, derived_dir, dicom_dir, segmentation_path
+from highdicom.seg import SegmentAlgorithmTypeValues
 from highdicom.seg.content import SegmentDescription
+from pydicom.sr.codedict import codes
 
 
-def writeSlices(series_tag_values, new_img, i, out_dir):
-    image_slice = sitk.Cast(new_img[:, :, i], sitk.sitkUInt16)
+SERIES_WRITER_WORKERS = int(os.environ.get("SERIES_WRITER_WORKERS", os.cpu_count() or 1))
+CONVERSION_SLAB_SLICES = int(os.environ.get("CONVERSION_SLAB_SLICES", 64))
+# "single": one sliceNNNN.dcm per slice; "enhanced": one Enhanced CT multi-frame volume.dcm
+DICOM_OUTPUT_MODE = os.environ.get("DICOM_OUTPUT_MODE", "single")
 
+ENHANCED_CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2.1"
+ENHANCED_FILENAME = "volume.dcm"
+SEGMENTATION_STORAGE = "1.2.840.10008.5.1.4.1.1.66.4"
+
+
+def derived_uid(*parts):
+    """A UID that is the same every time it is derived from the same parts.
+
+    Regenerated series (lazy storage) must keep the UIDs clients already hold.
+    """
+    return generate_uid(entropy_srcs=[str(part) for part in parts])
+
+
+def writeSlices(tag_values, image_slice, i, position, out_dir, sop_uid=None):
     writer = sitk.ImageFileWriter()
     writer.KeepOriginalImageUIDOn()
 
-    # Series-level tags
-    for tag, value in series_tag_values:
+    # Series-level and constant per-slice tags, prepared once per series
+    for tag, value in tag_values:
         image_slice.SetMetaData(tag, value)
+    if sop_uid:
+        image_slice.SetMetaData("0008|0018", sop_uid)  # SOP Instance UID
 
-    # Slice-specific tags
-    image_slice.SetMetaData("0008|0012", time.strftime("%Y%m%d"))  # Creation Date
-    image_slice.SetMetaData("0008|0013", time.strftime("%H%M%S"))  # Creation Time
-    image_slice.SetMetaData("0008|0060", "CT")                     # Modality
-    image_slice.SetMetaData(
-        "0020|0032",
-        "\\".join(map(str, new_img.TransformIndexToPhysicalPoint((0, 0, i))))
-    )  # Image Position
+    image_slice.SetMetaData("0020|0032", position)  # Image Position
     image_slice.SetMetaData("0020|0013", str(i))  # Instance Number
 
     filename = os.path.join(out_dir, f"slice{i:04d}.dcm")
     writer.SetFileName(filename)
     writer.Execute(image_slice)
 
+    return index_entry(filename)
 
-def nifti_to_dicom_series(image_data, output_dir):
-    os.makedirs(output_dir, exist_ok=True)
 
-    new_img = sitk.GetImageFromArray(image_data)
-    new_img = sitk.Cast(new_img, sitk.sitkUInt8)
-
-    modification_time = time.strftime("%H%M%S")
-    modification_date = time.strftime("%Y%m%d")
-    direction = new_img.GetDirection()
-
-    series_uid = f"1.2.826.0.1.3680043.2.1125.{modification_date}.1{modification_time}"
-    study_uid = f"1.2.826.0.1.3680043.2.1125.{modification_date}{modification_time}"
-
-    series_tag_values = [
-        ("0008|0031", modification_time),
-        ("0008|0021", modification_date),
-        ("0008|0008", "DERIVED\\SECONDARY"),
-        ("0020|000e", series_uid),
-        ("0020|000d", study_uid),
-        ("0020|0037", "\\".join(map(str, [
-            direction[0], direction[3], direction[6],
-            direction[1], direction[4], direction[7],
-        ]))),
-        ("0008|103e", "Created-MediImagePro"),
-    ]
+def slice_positions(img, depth):
+    """Physical origin of every slice, computed in one vectorized pass.
+
+    Same arithmetic as TransformIndexToPhysicalPoint((0, 0, k)): origin + (D * S)[:, 2] * k.
+    """
+    origin = np.array(img.GetOrigin())
+    step = np.array(img.GetDirection()).reshape(3, 3)[:, 2] * img.GetSpacing()[2]
+    return (origin + np.arange(depth)[:, None] * step).tolist()
+
+
+def series_geometry(shape):
+    """Reference image carrying the series geometry, and the position of every slice.
+
+    Matches what nifti_to_dicom_series gets from sitk.GetImageFromArray for this shape.
+    """
+    depth, rows, columns = shape[:3]
+    reference = sitk.GetImageFromArray(np.zeros((1, rows, columns), dtype=np.uint8))
+    return reference, slice_positions(reference, depth)
+
+
+def load_volume(path):
+    """Open a NIfTI volume without decoding it to float64.
 
-    for i in range(new_img.GetDepth()):
-        writeSlices(series_tag_values, new_img, i, output_dir)
+    Uncompressed .nii data comes back as a read-only memmap and compressed data is
+    read once in its stored dtype; only scaled (scl_slope) images become floats.
+    """
+    img = nib.load(path, mmap="r")
+    return img, np.asanyarray(img.dataobj)
+
+
+def iter_slabs(data, slab_slices=CONVERSION_SLAB_SLICES):
+    """Yield (first_slice, contiguous copy of the slab) along the DICOM slice axis."""
+    for z0 in range(0, data.shape[0], slab_slices):
+        yield z0, np.ascontiguousarray(data[z0:z0 + slab_slices])
+
+
+def _series_uids(study_uid, created):
+    """(study_uid, series_uid, frame_of_reference_uid, date, time) of a new series.
+
+    Given a study UID, everything is derived from it, so a regenerated series is identical.
+    """
+    created = created or datetime.now()
+    modification_date, modification_time = created.strftime("%Y%m%d"), created.strftime("%H%M%S")
+    if study_uid is None:
+        study_uid = f"1.2.826.0.1.3680043.2.1125.{modification_date}{modification_time}"
+        return study_uid, generate_uid(), generate_uid(), modification_date, modification_time
+    return (
+        study_uid, derived_uid(study_uid, "series"), derived_uid(study_uid, "frame-of-reference"),
+        modification_date, modification_time,
+    )
+
+
+def nifti_to_dicom_series(image_data, output_dir, study_uid=None, workers=SERIES_WRITER_WORKERS,
+                          slab_slices=CONVERSION_SLAB_SLICES, created=None):
+    os.makedirs(output_dir, exist_ok=True)
+
+    study_uid, series_uid, frame_of_reference_uid, modification_date, modification_time = (
+        _series_uids(study_uid, created)
+    )
+
+    depth = image_data.shape[0]
+    entries = []
+    tag_values = positions = None
+
+    # SimpleITK releases the GIL while encoding/writing, so threads scale across cores
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for z0, slab in iter_slabs(image_data, slab_slices):
+            new_img = sitk.GetImageFromArray(slab)
+
+            if positions is None:
+                # Series geometry comes from the first slab, which starts at the volume origin
+                direction = new_img.GetDirection()
+                positions = slice_positions(new_img, depth)
+                series_tag_values = [
+                    ("0008|0020", modification_date),  # Study Date, or ITK stamps the write time
+                    ("0008|0030", modification_time),
+                    ("0008|0031", modification_time),
+                    ("0008|0021", modification_date),
+                    ("0008|0008", "DERIVED\\SECONDARY"),
+                    ("0020|000e", series_uid),
+                    ("0020|000d", study_uid),
+                    ("0020|0052", frame_of_reference_uid),
+                    ("0020|0037", "\\".join(map(str, [
+                        direction[0], direction[3], direction[6],
+                        direction[1], direction[4], direction[7],
+                    ]))),
+                    ("0008|103e", "Created-MediImagePro"),
+                ]
+                tag_values = series_tag_values + [
+                    ("0008|0012", modification_date),  # Creation Date
+                    ("0008|0013", modification_time),  # Creation Time
+                    ("0008|0060", "CT"),                     # Modality
+                ]
+
+            new_img.SetOrigin(positions[z0])
+            volume = sitk.Cast(sitk.Cast(new_img, sitk.sitkUInt8), sitk.sitkUInt16)
+            entries.extend(pool.map(
+                lambda k: writeSlices(
+                    tag_values, volume[:, :, k], z0 + k, "\\".join(map(str, positions[z0 + k])), output_dir,
+                    derived_uid(series_uid, "instance", z0 + k),
+                ),
+                range(volume.GetDepth()),
+            ))
+
+    write_instance_index(output_dir, study_uid, series_uid, entries)
 
     print(f"DICOM series saved to {output_dir}")
     return study_uid, series_uid
 
-def create_dicom_segmentation(mask_data, reference_dicom_path, output_path):
-    import pydicom
-    from pydicom.dataset import Dataset, FileDataset
-    import datetime
-    import uuid
 
-    # Read the reference DICOM slice (first slice)
-    ref_ds = pydicom.dcmread(reference_dicom_path)
+def _write_pixel_data(f, chunks, length, vr=b"OB"):
+    """Append an explicit VR little endian PixelData element, one chunk at a time."""
+    padded = length + (length % 2)
+    f.write(struct.pack("<HH2sHI", 0x7FE0, 0x0010, vr, 0, padded))
+    for chunk in chunks:
+        f.write(chunk)
+    if padded != length:
+        f.write(b"\0")
+
+
+def nifti_to_enhanced_dicom(image_data, output_dir, study_uid=None, slab_slices=CONVERSION_SLAB_SLICES,
+                            created=None):
+    """Write the volume as a single Enhanced CT multi-frame instance (volume.dcm).
+
+    Pixel values and per-frame geometry match the single-frame series written by
+    nifti_to_dicom_series; frames are streamed to disk one slab at a time.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    study_uid, series_uid, frame_of_reference_uid, modification_date, modification_time = (
+        _series_uids(study_uid, created)
+    )
+
+    depth, rows, columns = image_data.shape[:3]
+    reference, positions = series_geometry(image_data.shape)
+    direction = reference.GetDirection()
+
+    file_meta = pydicom.Dataset()
+    file_meta.MediaStorageSOPClassUID = ENHANCED_CT_IMAGE_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = derived_uid(series_uid, "instance", 0)
+    file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    file_meta.ImplementationClassUID = pydicom.uid.PYDICOM_IMPLEMENTATION_UID
+
+    output_path = os.path.join(output_dir, ENHANCED_FILENAME)
+    ds = pydicom.dataset.FileDataset(output_path, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.FrameOfReferenceUID = frame_of_reference_uid
+    ds.Modality = "CT"
+    ds.ImageType = ["DERIVED", "SECONDARY", "VOLUME", "NONE"]
+    ds.SeriesDescription = "Created-MediImagePro"
+    ds.StudyDate = ds.SeriesDate = ds.ContentDate = modification_date
+    ds.StudyTime = ds.SeriesTime = ds.ContentTime = modification_time
+    ds.AcquisitionDateTime = modification_date + modification_time
+    ds.PatientName = ""
+    ds.PatientID = ""
+    ds.InstanceNumber = 1
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.Rows, ds.Columns = rows, columns
+    ds.NumberOfFrames = depth
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+
+    dimension_uid = derived_uid(series_uid, "dimension-organization")
+    ds.DimensionOrganizationSequence = [pydicom.Dataset()]
+    ds.DimensionOrganizationSequence[0].DimensionOrganizationUID = dimension_uid
+    ds.DimensionIndexSequence = []
+    for pointer in ("StackID", "InStackPositionNumber"):
+        dimension = pydicom.Dataset()
+        dimension.DimensionOrganizationUID = dimension_uid
+        dimension.DimensionIndexPointer = pydicom.tag.Tag(pointer)
+        dimension.FunctionalGroupPointer = pydicom.tag.Tag("FrameContentSequence")
+        ds.DimensionIndexSequence.append(dimension)
+
+    shared = pydicom.Dataset()
+    shared.PixelMeasuresSequence = [pydicom.Dataset()]
+    shared.PixelMeasuresSequence[0].PixelSpacing = list(reference.GetSpacing()[:2])
+    shared.PixelMeasuresSequence[0].SliceThickness = reference.GetSpacing()[2]
+    shared.PlaneOrientationSequence = [pydicom.Dataset()]
+    shared.PlaneOrientationSequence[0].ImageOrientationPatient = [
+        direction[0], direction[3], direction[6],
+        direction[1], direction[4], direction[7],
+    ]
+    shared.PixelValueTransformationSequence = [pydicom.Dataset()]
+    shared.PixelValueTransformationSequence[0].RescaleIntercept = 0
+    shared.PixelValueTransformationSequence[0].RescaleSlope = 1
+    shared.PixelValueTransformationSequence[0].RescaleType = "US"
+    shared.CTImageFrameTypeSequence = [pydicom.Dataset()]
+    shared.CTImageFrameTypeSequence[0].FrameType = ["DERIVED", "SECONDARY", "VOLUME", "NONE"]
+    ds.SharedFunctionalGroupsSequence = [shared]
+
+    per_frame = []
+    for k, position in enumerate(positions):
+        frame = pydicom.Dataset()
+        frame.PlanePositionSequence = [pydicom.Dataset()]
+        frame.PlanePositionSequence[0].ImagePositionPatient = position
+        frame.FrameContentSequence = [pydicom.Dataset()]
+        frame.FrameContentSequence[0].StackID = "1"
+        frame.FrameContentSequence[0].InStackPositionNumber = k + 1
+        frame.FrameContentSequence[0].DimensionIndexValues = [1, k + 1]
+        per_frame.append(frame)
+    ds.PerFrameFunctionalGroupsSequence = per_frame
+
+    def frames():
+        # Same UInt8 -> UInt16 casts as the single-frame series
+        for _, slab in iter_slabs(image_data, slab_slices):
+            cast = sitk.Cast(sitk.GetImageFromArray(slab), sitk.sitkUInt8)
+            yield sitk.GetArrayViewFromImage(cast).astype("<u2").tobytes()
+
+    ds.save_as(output_path, enforce_file_format=True)
+    with open(output_path, "ab") as f:
+        _write_pixel_data(f, frames(), depth * rows * columns * 2, vr=b"OW")
+
+    entry = index_entry(output_path)
+    write_instance_index(output_dir, study_uid, series_uid, [entry])
+
+    print(f"Enhanced multi-frame DICOM saved to {output_path}")
+    return study_uid, series_uid
+
+
+def scan_labels(mask_data, slab_slices=CONVERSION_SLAB_SLICES):
+    """One pass over the mask: per-slice label counts plus per-row / per-column label presence.
+
+    Returns (counts, rows, columns): a (depth, 256) voxel count matrix and boolean
+    (256, n_rows) / (256, n_columns) matrices telling which labels occur on each row and column.
+    """
+    depth, n_rows, n_columns = mask_data.shape[:3]
+    counts = np.zeros((depth, 256), dtype=np.int64)
+    rows = np.zeros(256 * n_rows, dtype=bool)
+    columns = np.zeros(256 * n_columns, dtype=bool)
+    row_offsets = np.arange(n_rows, dtype=np.int64)[:, None]
+    column_offsets = np.arange(n_columns, dtype=np.int64)[None, :]
+    for z0, slab in iter_slabs(mask_data, slab_slices):
+        for k, labels in enumerate(slab.astype(np.uint8, copy=False)):
+            counts[z0 + k] = np.bincount(labels.ravel(), minlength=256)
+            # (label, row) and (label, column) pairs encoded as one index each
+            labels = labels.astype(np.int64)
+            rows |= np.bincount((labels * n_rows + row_offsets).ravel(), minlength=rows.size) > 0
+            columns |= np.bincount((labels * n_columns + column_offsets).ravel(), minlength=columns.size) > 0
+    return counts, rows.reshape(256, n_rows), columns.reshape(256, n_columns)
+
+
+def slice_label_counts(mask_data, slab_slices=CONVERSION_SLAB_SLICES):
+    """Voxel count of every (uint8) label on every slice: a (depth, 256) matrix from one pass."""
+    counts = np.zeros((mask_data.shape[0], 256), dtype=np.int64)
+    for z0, slab in iter_slabs(mask_data, slab_slices):
+        for k, labels in enumerate(slab.astype(np.uint8, copy=False)):
+            counts[z0 + k] = np.bincount(labels.ravel(), minlength=256)
+    return counts
+
+
+def segment_statistics(counts, rows, columns, affine):
+    """Per-label voxel count, physical volume, bounding box and slice range (label_dict labels only).
+
+    Indices are (slice, row, column) of the stored volume, i.e. NIfTI (i, j, k); the slice
+    index is also the InstanceNumber of the DICOM slice. Physical values use the NIfTI affine.
+    """
+    affine = np.asarray(affine, dtype=np.float64)
+    voxel_volume = abs(float(np.linalg.det(affine[:3, :3])))
+    totals = counts.sum(axis=0)
+
+    segments = []
+    for number, label in enumerate((label for label in sorted(label_dict) if totals[label]), start=1):
+        slices = np.flatnonzero(counts[:, label])
+        label_rows = np.flatnonzero(rows[label])
+        label_columns = np.flatnonzero(columns[label])
+        first = np.array([slices[0], label_rows[0], label_columns[0]])
+        last = np.array([slices[-1], label_rows[-1], label_columns[-1]])
+
+        # Physical extent of the voxel-corner box, via the affine
+        corners = np.array([[a, b, c] for a in (first[0], last[0] + 1)
+                            for b in (first[1], last[1] + 1)
+                            for c in (first[2], last[2] + 1)], dtype=np.float64) - 0.5
+        world = corners @ affine[:3, :3].T + affine[:3, 3]
+
+        segments.append({
+            "label": int(label),
+            "name": label_dict[label],
+            "segment_number": number,
+            "voxel_count": int(totals[label]),
+            "volume_mm3": round(int(totals[label]) * voxel_volume, 3),
+            "bounding_box": {"min": first.tolist(), "max": last.tolist()},
+            "bounding_box_mm": {
+                "min": np.round(world.min(axis=0), 3).tolist(),
+                "max": np.round(world.max(axis=0), 3).tolist(),
+            },
+            "slice_range": [int(slices[0]), int(slices[-1])],
+        })
+    return segments
+
+
+def _segment_property_type(label):
+    if label == 1:
+        return codes.SCT.BoneStructureOfMandible
+    if label == 2:
+        return codes.SCT.BoneStructureOfMaxilla
+    if label >= 11:
+        return codes.SCT.Tooth
+    return codes.SCT.AnatomicalStructure
+
+
+def _pack_bits(frames):
+    """Pack boolean frames into one continuous little-endian bit stream (DICOM 1-bit pixel data)."""
+    carry = np.zeros(0, dtype=bool)
+    for frame in frames:
+        bits = frame.ravel()
+        if carry.size:
+            bits = np.concatenate([carry, bits])
+        whole = bits.size - bits.size % 8
+        if whole:
+            yield np.packbits(bits[:whole], bitorder="little").tobytes()
+        carry = bits[whole:]
+    if carry.size:
+        yield np.packbits(carry, bitorder="little").tobytes()
+
+
+def create_dicom_segmentation(mask_data, dicom_dir, output_path, label_counts=None, mask_sha256=None):
+    """Write a BINARY DICOM SEG with one segment per label_dict label present in the mask.
+
+    Frames are bit-packed and only written for (slice, segment) pairs that contain
+    the segment, so mostly-background masks produce small files. label_counts is the
+    slice_label_counts() matrix, when the caller already has it. With the mask's
+    content hash, the SEG UIDs are derived from it and stay the same on regeneration.
+    """
+    if label_counts is None:
+        label_counts = slice_label_counts(mask_data)
+
+    depth, rows, columns = mask_data.shape[:3]
+    segment_labels = [label for label in sorted(label_dict) if label_counts[:, label].any()]
+    if not segment_labels:
+        print(f"No labelled voxels in mask, skipping DICOM SEG: {output_path}")
+        return None
+    segment_numbers = {label: n for n, label in enumerate(segment_labels, start=1)}
+    frames = [
+        (z, label)
+        for z in range(depth)
+        for label in segment_labels
+        if label_counts[z, label]
+    ]
+
+    source = load_instance_index(dicom_dir)
+    source_instances = source["instances"]
+    ref_ds = pydicom.dcmread(os.path.join(dicom_dir, source_instances[0]["file"]), stop_before_pixels=True)
+    study_uid = ref_ds.StudyInstanceUID
+    reference, positions = series_geometry(mask_data.shape)
+    direction = reference.GetDirection()
+
+    if mask_sha256:
+        seg_series_uid = derived_uid(study_uid, mask_sha256, "seg-series")
+        seg_instance_uid = derived_uid(seg_series_uid, "instance")
+        dimension_uid = derived_uid(seg_series_uid, "dimension-organization")
+    else:
+        seg_series_uid, seg_instance_uid, dimension_uid = generate_uid(), generate_uid(), generate_uid()
 
-    # Prepare metadata
     file_meta = pydicom.Dataset()
-    file_meta.MediaStorageSOPClassUID = pydicom.uid.generate_uid()
-    file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+    file_meta.MediaStorageSOPClassUID = SEGMENTATION_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = seg_instance_uid
     file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
     file_meta.ImplementationClassUID = pydicom.uid.PYDICOM_IMPLEMENTATION_UID
 
-    # Create FileDataset instance
-    ds = FileDataset(output_path, {}, file_meta=file_meta, preamble=b"\0" * 128)
-    dt = datetime.datetime.now()
-    ds.ContentDate = dt.strftime('%Y%m%d')
-    ds.ContentTime = dt.strftime('%H%M%S')
+    ds = pydicom.dataset.FileDataset(output_path, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    dt = datetime.now()
     ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
     ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
     ds.Modality = "SEG"
     ds.PatientName = ref_ds.PatientName if 'PatientName' in ref_ds else "Anon"
     ds.PatientID = ref_ds.PatientID if 'PatientID' in ref_ds else "000000"
-    ds.StudyInstanceUID = ref_ds.StudyInstanceUID
-    ds.SeriesInstanceUID = pydicom.uid.generate_uid()
-    ds.Rows, ds.Columns = mask_data.shape[1], mask_data.shape[2]
-    ds.NumberOfFrames = mask_data.shape[0]
-    ds.BitsAllocated = 8
-    ds.BitsStored = 8
-    ds.HighBit = 7
-    ds.PixelRepresentation = 0
+    ds.StudyInstanceUID = study_uid
+    ds.StudyDate = ref_ds.get("StudyDate", dt.strftime('%Y%m%d'))
+    ds.StudyTime = ref_ds.get("StudyTime", dt.strftime('%H%M%S'))
+    ds.SeriesInstanceUID = seg_series_uid
+    ds.SeriesNumber = 2
+    ds.InstanceNumber = 1
+    ds.FrameOfReferenceUID = ref_ds.get("FrameOfReferenceUID") or generate_uid()
+    if mask_sha256:
+        # Taken from the series like the UIDs above, so a regenerated SEG is byte-identical
+        ds.ContentDate = ref_ds.get("SeriesDate", dt.strftime('%Y%m%d'))
+        ds.ContentTime = ref_ds.get("SeriesTime", dt.strftime('%H%M%S'))
+    else:
+        ds.ContentDate = dt.strftime('%Y%m%d')
+        ds.ContentTime = dt.strftime('%H%M%S')
+    ds.ContentLabel = "SEGMENTATION"
+    ds.ContentDescription = "Created-MediImagePro"
+    ds.ContentCreatorName = "MediImagePro"
+    ds.Manufacturer = "MediImagePro"
+    ds.ManufacturerModelName = "MediImagePro"
+    ds.DeviceSerialNumber = "1"
+    ds.SoftwareVersions = "1"
+    ds.ImageType = ['DERIVED', 'PRIMARY']
     ds.SamplesPerPixel = 1
     ds.PhotometricInterpretation = "MONOCHROME2"
-    ds.ImageType = ['DERIVED', 'PRIMARY', 'SEGMENTATION']
-    ds.SegmentSequence = pydicom.Sequence([])
-
-    # Add dummy pixel data (binary mask)
-    ds.PixelData = (mask_data.astype(np.uint8)).tobytes()
+    ds.Rows, ds.Columns = rows, columns
+    ds.NumberOfFrames = len(frames)
+    ds.BitsAllocated = 1
+    ds.BitsStored = 1
+    ds.HighBit = 0
+    ds.PixelRepresentation = 0
+    ds.LossyImageCompression = "00"
+    ds.SegmentationType = "BINARY"
+    ds.SegmentsOverlap = "NO"
+
+    ds.SegmentSequence = [
+        SegmentDescription(
+            segment_number=segment_numbers[label],
+            segment_label=label_dict[label],
+            segmented_property_category=codes.SCT.AnatomicalStructure,
+            segmented_property_type=_segment_property_type(label),
+            algorithm_type=SegmentAlgorithmTypeValues.MANUAL,
+        )
+        for label in segment_labels
+    ]
 
-    # Save the file
-    ds.save_as(output_path)
-    print(f"✅ Fallback DICOM SEG saved at: {output_path}")
+    referenced_series = pydicom.Dataset()
+    referenced_series.SeriesInstanceUID = source["series_uid"] or ref_ds.SeriesInstanceUID
+    referenced_series.ReferencedInstanceSequence = []
+    for instance in source_instances:
+        item = pydicom.Dataset()
+        item.ReferencedSOPClassUID = instance["sop_class_uid"]
+        item.ReferencedSOPInstanceUID = instance["sop_instance_uid"]
+        referenced_series.ReferencedInstanceSequence.append(item)
+    ds.ReferencedSeriesSequence = [referenced_series]
+
+    ds.DimensionOrganizationSequence = [pydicom.Dataset()]
+    ds.DimensionOrganizationSequence[0].DimensionOrganizationUID = dimension_uid
+    ds.DimensionIndexSequence = []
+    for pointer, group in (("ReferencedSegmentNumber", "SegmentIdentificationSequence"),
+                           ("ImagePositionPatient", "PlanePositionSequence")):
+        dimension = pydicom.Dataset()
+        dimension.DimensionOrganizationUID = dimension_uid
+        dimension.DimensionIndexPointer = pydicom.tag.Tag(pointer)
+        dimension.FunctionalGroupPointer = pydicom.tag.Tag(group)
+        ds.DimensionIndexSequence.append(dimension)
+
+    shared = pydicom.Dataset()
+    shared.PixelMeasuresSequence = [pydicom.Dataset()]
+    shared.PixelMeasuresSequence[0].PixelSpacing = list(reference.GetSpacing()[:2])
+    shared.PixelMeasuresSequence[0].SliceThickness = reference.GetSpacing()[2]
+    shared.PixelMeasuresSequence[0].SpacingBetweenSlices = reference.GetSpacing()[2]
+    shared.PlaneOrientationSequence = [pydicom.Dataset()]
+    shared.PlaneOrientationSequence[0].ImageOrientationPatient = [
+        direction[0], direction[3], direction[6],
+        direction[1], direction[4], direction[7],
+    ]
+    ds.SharedFunctionalGroupsSequence = [shared]
+
+    per_frame = []
+    for z, label in frames:
+        if len(source_instances) == 1:
+            instance, source_frame = source_instances[0], z + 1
+        else:
+            instance, source_frame = source_instances[z], None
+
+        source_image = pydicom.Dataset()
+        source_image.ReferencedSOPClassUID = instance["sop_class_uid"]
+        source_image.ReferencedSOPInstanceUID = instance["sop_instance_uid"]
+        if source_frame is not None:
+            source_image.ReferencedFrameNumber = source_frame
+        source_image.PurposeOfReferenceCodeSequence = [pydicom.Dataset()]
+        purpose = source_image.PurposeOfReferenceCodeSequence[0]
+        purpose.CodeValue, purpose.CodingSchemeDesignator = "121322", "DCM"
+        purpose.CodeMeaning = "Source image for image processing operation"
+
+        frame = pydicom.Dataset()
+        frame.DerivationImageSequence = [pydicom.Dataset()]
+        frame.DerivationImageSequence[0].SourceImageSequence = [source_image]
+        frame.DerivationImageSequence[0].DerivationCodeSequence = [pydicom.Dataset()]
+        derivation = frame.DerivationImageSequence[0].DerivationCodeSequence[0]
+        derivation.CodeValue, derivation.CodingSchemeDesignator = "113076", "DCM"
+        derivation.CodeMeaning = "Segmentation"
+        frame.FrameContentSequence = [pydicom.Dataset()]
+        frame.FrameContentSequence[0].DimensionIndexValues = [segment_numbers[label], z + 1]
+        frame.PlanePositionSequence = [pydicom.Dataset()]
+        frame.PlanePositionSequence[0].ImagePositionPatient = positions[z]
+        frame.SegmentIdentificationSequence = [pydicom.Dataset()]
+        frame.SegmentIdentificationSequence[0].ReferencedSegmentNumber = segment_numbers[label]
+        per_frame.append(frame)
+    ds.PerFrameFunctionalGroupsSequence = per_frame
+
+    def binary_frames():
+        # Split each slab by label: one comparison per non-empty (slice, segment) pair
+        for z0, slab in iter_slabs(mask_data):
+            slab = slab.astype(np.uint8, copy=False)
+            for k in range(slab.shape[0]):
+                for label in segment_labels:
+                    if label_counts[z0 + k, label]:
+                        yield slab[k] == label
+
+    # Save the header, then stream the bit-packed frames slab by slab
+    ds.save_as(output_path, enforce_file_format=True)
+    with open(output_path, "ab") as f:
+        _write_pixel_data(f, _pack_bits(binary_frames()), (len(frames) * rows * columns + 7) // 8)
+    print(f"DICOM SEG with {len(segment_labels)} segments / {len(frames)} frames saved at: {output_path}")
+    return segment_labels
+
+
+def series_shape(dicom_dir):
+    """(depth, rows, columns) of a stored series, from its index and first header."""
+    index = load_instance_index(dicom_dir)
+    first = pydicom.dcmread(os.path.join(dicom_dir, index["instances"][0]["file"]), stop_before_pixels=True)
+    depth = sum(instance["number_of_frames"] for instance in index["instances"])
+    return depth, int(first.Rows), int(first.Columns)
+
+
+def resegment_study(study_id, mask_path, mask_sha256=None, progress=None):
+    """Replace a study's SEG from a new mask, referencing the DICOM series already on disk.
+
+    In lazy storage an evicted study has no series to write against; only the
+    statistics are computed and the SEG is regenerated from the new mask on next access.
+    Returns (segmentation_classes, segments) for the catalog.
+    """
+    if progress is None:
+        progress = lambda stage: None
+
+    progress("load")
+    print(f"Loading mask from: {mask_path}")
+    mask, mask_data = load_volume(mask_path)
+    label_counts, label_rows, label_columns = scan_labels(mask_data)
+
+    progress("seg_write")
+    if derived_available(study_id):
+        _replace_segmentation(study_id, mask_data, label_counts, mask_sha256)
+
+    segments = segment_statistics(label_counts, label_rows, label_columns, mask.affine)
+    segmentation_classes = [segment["name"] for segment in segments]
+    progress("finalize")
+    print(f"Re-segmented {study_id}: {segmentation_classes}")
+    return segmentation_classes, segments
+
+
+def _replace_segmentation(study_id, mask_data, label_counts, mask_sha256=None):
+    dicom_path = dicom_dir(study_id)
+    expected = series_shape(dicom_path)
+    if tuple(mask_data.shape[:3]) != expected:
+        raise ValueError(f"Mask shape {mask_data.shape[:3]} does not match the stored series {expected}")
+
+    seg_file_path = segmentation_path(study_id)
+    os.makedirs(os.path.dirname(seg_file_path), exist_ok=True)
+    # Readers keep seeing the previous SEG until the new one is complete
+    tmp_path = f"{seg_file_path}.{os.getpid()}.tmp"
+    if create_dicom_segmentation(mask_data, dicom_path, tmp_path, label_counts, mask_sha256) is None:
+        if os.path.exists(seg_file_path):
+            os.remove(seg_file_path)
+    else:
+        os.replace(tmp_path, seg_file_path)
+
+
+def _copy_instance(source_file, dest_file, pixel_offset, uids):
+    """Copy one instance with new header values; the pixel data element is copied as raw bytes."""
+    ds = pydicom.dcmread(source_file, stop_before_pixels=True)
+    for keyword, value in uids.items():
+        if keyword in ds:
+            setattr(ds, keyword, value)
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    for keyword in ("DimensionOrganizationSequence", "DimensionIndexSequence"):
+        for item in ds.get(keyword, []):
+            item.DimensionOrganizationUID = uids["DimensionOrganizationUID"]
+
+    # Tag and length (plus VR and reserved bytes when explicit) precede the value
+    element_start = pixel_offset - (8 if ds.file_meta.TransferSyntaxUID.is_implicit_VR else 12)
+    tmp_path = f"{dest_file}.{os.getpid()}.tmp"
+    ds.save_as(tmp_path, enforce_file_format=True)
+    with open(source_file, "rb") as src, open(tmp_path, "ab") as dst:
+        src.seek(element_start)
+        shutil.copyfileobj(src, dst)
+    os.replace(tmp_path, dest_file)
+    return index_entry(dest_file)
+
+
+def copy_series(source_study_id, study_id, study_uid, created=None):
+    """Give a study its own copy of another study's DICOM series, without decoding the volume.
+
+    Pixel data is copied as stored; the study, series, frame of reference and instance
+    UIDs (and dates) are rewritten to the ones nifti_to_dicom_series derives for
+    study_uid, so the copy matches what lazy storage regenerates for this study.
+    """
+    source_path, dicom_path = dicom_dir(source_study_id), dicom_dir(study_id)
+    index = load_instance_index(source_path)
+    _, series_uid, frame_of_reference_uid, date, time_ = _series_uids(study_uid, created)
+    os.makedirs(dicom_path, exist_ok=True)
+
+    entries = []
+    for position, entry in enumerate(index["instances"]):
+        uids = {
+            "StudyInstanceUID": study_uid,
+            "SeriesInstanceUID": series_uid,
+            "FrameOfReferenceUID": frame_of_reference_uid,
+            "SOPInstanceUID": derived_uid(series_uid, "instance", position),
+            "DimensionOrganizationUID": derived_uid(series_uid, "dimension-organization"),
+            "StudyDate": date, "SeriesDate": date, "ContentDate": date, "InstanceCreationDate": date,
+            "StudyTime": time_, "SeriesTime": time_, "ContentTime": time_, "InstanceCreationTime": time_,
+            "AcquisitionDateTime": date + time_,
+        }
+        entries.append(_copy_instance(
+            os.path.join(source_path, entry["file"]), os.path.join(dicom_path, entry["file"]), entry["offset"], uids,
+        ))
+    write_instance_index(dicom_path, study_uid, series_uid, entries)
+    return series_uid
+
+
+def process_shared_upload(study_id, study_uid, source_study_id, mask_path, mask_sha256=None, progress=None,
+                          created=None):
+    """process_upload for an image another study already converted: a new study with its
+    own series UIDs, SEG, statistics and catalog row, whose series is copied from the
+    other study's (see copy_series) rather than converted from the NIfTI again.
+
+    In lazy storage nothing is copied; the study's series is generated on first access.
+    Returns (segmentation_classes, segments).
+    """
+    if progress is None:
+        progress = lambda stage: None
+
+    progress("load")
+    print(f"Loading mask from: {mask_path}")
+    mask, mask_data = load_volume(mask_path)
+
+    progress("series_write")
+    derived = derived_available(study_id)
+    if derived:
+        copy_series(source_study_id, study_id, study_uid, created)
+
+    progress("seg_write")
+    label_counts, label_rows, label_columns = scan_labels(mask_data)
+    if derived:
+        _replace_segmentation(study_id, mask_data, label_counts, mask_sha256)
+
+    segments = segment_statistics(label_counts, label_rows, label_columns, mask.affine)
+    segmentation_classes = [segment["name"] for segment in segments]
+
+    progress("finalize")
+    if derived:
+        write_dicomweb_json(study_id, dicom_dir(study_id))
+    print(f"Converted {study_id} reusing the series of {source_study_id}: {segmentation_classes}")
+    return segmentation_classes, segments
+
+
+def _write_series(image_data, dicom_path, study_uid, created, output_mode):
+    if output_mode == "enhanced":
+        return nifti_to_enhanced_dicom(image_data, dicom_path, study_uid, created=created)
+    return nifti_to_dicom_series(image_data, dicom_path, study_uid, created=created)
+
+
+def regenerate_derived(study_id, study_uid, image_path, mask_path, mask_sha256=None, created=None,
+                       output_mode=DICOM_OUTPUT_MODE):
+    """Rebuild an evicted study's DICOM series and SEG from its source volumes (lazy storage).
+
+    UIDs are derived from the study UID and mask hash, so the result matches what
+    clients were served before eviction. The caller holds the study's derived_lock.
+    """
+    start = time.perf_counter()
+    # Leftovers of an interrupted generation
+    shutil.rmtree(derived_dir(study_id), ignore_errors=True)
+    dicom_path = dicom_dir(study_id)
+    seg_file_path = segmentation_path(study_id)
+    os.makedirs(os.path.dirname(seg_file_path), exist_ok=True)
+
+    _, image_data = load_volume(image_path)
+    _, mask_data = load_volume(mask_path)
+    _write_series(image_data, dicom_path, study_uid, created, output_mode)
+    create_dicom_segmentation(mask_data, dicom_path, seg_file_path, mask_sha256=mask_sha256)
+    write_dicomweb_json(study_id, dicom_path)
+    print(f"span=regenerate study_id={study_id} seconds={time.perf_counter() - start:.3f}")
+
+
+def process_upload(study_id, image_path, mask_path, study_uid=None, progress=None,
+                   output_mode=DICOM_OUTPUT_MODE, mask_sha256=None, created=None):
+    if progress is None:
+        progress = lambda stage: None
 
-def process_upload(study_id, image_path, mask_path):
     try:
-        dicom_path = f"uploads/{study_id}/dicom_series"
-        seg_path = f"uploads/{study_id}/segmentation"
+        dicom_path = dicom_dir(study_id)
+        seg_file_path = segmentation_path(study_id)
         os.makedirs(dicom_path, exist_ok=True)
-        os.makedirs(seg_path, exist_ok=True)
+        os.makedirs(os.path.dirname(seg_file_path), exist_ok=True)
 
+        progress("load")
         print(f"Loading image from: {image_path}")
-        image = nib.load(image_path)
+        image, image_data = load_volume(image_path)
         print(f"Loading mask from: {mask_path}")
-        mask = nib.load(mask_path)
-
-        image_data = image.get_fdata()
-        mask_data = mask.get_fdata()
+        mask, mask_data = load_volume(mask_path)
 
-        print(f"Image shape: {image_data.shape}")
-        print(f"Mask shape: {mask_data.shape}")
-        print(f"Unique labels in mask: {np.unique(mask_data)}")
+        print(f"Image shape: {image_data.shape} ({image_data.dtype})")
+        print(f"Mask shape: {mask_data.shape} ({mask_data.dtype})")
 
-        study_uid, series_uid = nifti_to_dicom_series(image_data, dicom_path)
+        progress("series_write")
+        study_uid, series_uid = _write_series(image_data, dicom_path, study_uid, created, output_mode)
 
-        seg_file_path = os.path.join(seg_path, "segmentation.dcm")
-        reference_dicom_path = os.path.join(dicom_path, "slice0000.dcm")
+        progress("seg_write")
+        label_counts, label_rows, label_columns = scan_labels(mask_data)
+        create_dicom_segmentation(mask_data, dicom_path, seg_file_path, label_counts, mask_sha256)
 
-        create_dicom_segmentation(mask_data, reference_dicom_path, seg_file_path)
+        present_labels = np.flatnonzero(label_counts[:, 1:].any(axis=0)) + 1
+        print(f"Unique labels in mask: {present_labels}")
 
-        present_labels = np.unique(mask_data.astype(np.uint8))
-        present_labels = present_labels[present_labels != 0]
+        segments = segment_statistics(label_counts, label_rows, label_columns, mask.affine)
+        segmentation_classes = [segment["name"] for segment in segments]
 
-        segmentation_classes = [
-            label_dict.get(label, f"Class-{label}")
-            for label in present_labels
-            if label in label_dict
-        ]
+        progress("finalize")
+        write_dicomweb_json(study_id, dicom_path)
+        try:
+            # Warm the render cache so the study list never waits on a thumbnail
+            render_thumbnail(dicom_path)
+        except Exception as e:
+            print(f"Thumbnail rendering failed for {study_id}: {e}")
 
         print(f"Processed successfully. Study UID: {study_uid}")
         print(f"Segmentation classes: {segmentation_classes}")
 
-        return study_uid, segmentation_classes
+        return study_uid, segmentation_classes, segments
 
     except Exception as e:
         print(f"Error in process_upload: {str(e)}")
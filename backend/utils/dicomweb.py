@@ -0,0 +1,73 @@
+import json
+import os
+from functools import lru_cache
+
+from utils.http_cache import compress
+from utils.instance_index import load_instance_index
+
+DICOMWEB_BASE_URL = os.environ.get("DICOMWEB_BASE_URL", "http://localhost:9999")
+SERIES_METADATA_FILENAME = "series_metadata.json"
+INSTANCES_FILENAME = "instances.json"
+
+
+def build_series_metadata(study_id, index):
+    metadata = []
+    for entry in index["instances"]:
+        instance = {
+            "00080018": {"Value": [entry["sop_instance_uid"]]},  # SOPInstanceUID
+            "0020000D": {"Value": [index["study_uid"]]},  # StudyInstanceUID
+            "0020000E": {"Value": [index["series_uid"]]},  # SeriesInstanceUID
+            "00081190": {"Value": [f"{DICOMWEB_BASE_URL}/dicom/{study_id}/dicom_series/{entry['file']}"]},
+        }
+        if entry.get("instance_number") is not None:
+            instance["00200013"] = {"Value": [entry["instance_number"]]}
+        if entry.get("number_of_frames", 1) > 1:
+            instance["00280008"] = {"vr": "IS", "Value": [entry["number_of_frames"]]}  # NumberOfFrames
+        metadata.append(instance)
+    return metadata
+
+
+def build_instances(study_id, index):
+    instances = []
+    for entry in index["instances"]:
+        instance = {
+            "00080018": {"vr": "UI", "Value": [entry["sop_instance_uid"]]},
+            "00080016": {"vr": "UI", "Value": [entry["sop_class_uid"]]},
+            "0020000D": {"vr": "UI", "Value": [index["study_uid"]]},
+            "0020000E": {"vr": "UI", "Value": [index["series_uid"]]},
+            "00081190": {
+                "vr": "UR",
+                "Value": [f"wadouri:{DICOMWEB_BASE_URL}/dicom/{study_id}/dicom_series/{entry['file']}"],
+            },
+        }
+        if entry.get("number_of_frames", 1) > 1:
+            instance["00280008"] = {"vr": "IS", "Value": [entry["number_of_frames"]]}
+        instances.append(instance)
+    return instances
+
+
+def _write_json(path, payload):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(json.dumps(payload, separators=(",", ":")).encode())
+    os.replace(tmp_path, path)
+
+
+def write_dicomweb_json(study_id, dicom_dir):
+    """Pre-serialize the series metadata and instance list served by the QIDO/WADO routes."""
+    index = load_instance_index(dicom_dir)
+    _write_json(os.path.join(dicom_dir, SERIES_METADATA_FILENAME), build_series_metadata(study_id, index))
+    _write_json(os.path.join(dicom_dir, INSTANCES_FILENAME), build_instances(study_id, index))
+
+
+@lru_cache(maxsize=128)
+def load_dicomweb_json(study_id, dicom_dir, filename, encoding="identity"):
+    """Pre-serialized JSON bytes, optionally gzip/br encoded; each variant is cached."""
+    if encoding != "identity":
+        return compress(load_dicomweb_json(study_id, dicom_dir, filename), encoding)
+
+    path = os.path.join(dicom_dir, filename)
+    if not os.path.exists(path):
+        write_dicomweb_json(study_id, dicom_dir)
+    with open(path, "rb") as f:
+        return f.read()
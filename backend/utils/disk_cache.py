@@ -0,0 +1,92 @@
+import hashlib
+import os
+import threading
+
+from utils.metrics import cache_requests
+
+
+class DiskCache:
+    """Size-bounded directory of derived files, evicted least recently used first.
+
+    Entries are addressed by a key string; every hit bumps the file mtime, and
+    eviction removes the oldest mtimes until the cache is back under 90% of max_bytes.
+    Several processes may share the directory.
+    """
+
+    def __init__(self, name, directory, max_bytes):
+        self.name = name
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._bytes = None
+
+    def path(self, key, extension):
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], f"{digest}.{extension}")
+
+    def get(self, key, extension):
+        path = self.path(key, extension)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            cache_requests.inc(cache=self.name, result="miss")
+            return None
+        cache_requests.inc(cache=self.name, result="hit")
+        self.touch(path)
+        return data
+
+    def put(self, key, extension, data):
+        path = self.path(key, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.added(len(data))
+        return path
+
+    def touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def scan(self):
+        files = []
+        for directory, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def added(self, size):
+        """Account for size new bytes in the cache and evict if it is over quota."""
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = sum(size for _, size, _ in self.scan())
+            self._bytes += size
+            if self._bytes <= self.max_bytes:
+                return
+
+            # Other processes write here too, so re-measure before evicting
+            files = sorted(self.scan())
+            self._bytes = sum(size for _, size, _ in files)
+            target = self.max_bytes * 0.9
+            for _, size, path in files:
+                if self._bytes <= target:
+                    break
+                if self.evict(path):
+                    self._bytes -= size
+
+    def evict(self, path):
+        """Remove one entry; False when it cannot go right now."""
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return True
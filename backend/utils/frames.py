@@ -0,0 +1,149 @@
+import hashlib
+import mmap
+import re
+
+from fastapi.responses import Response, StreamingResponse
+
+FRAME_CHUNK_SIZE = 1024 * 1024
+FRAME_MEDIA_TYPE = "application/octet-stream"
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class FileSpan:
+    """A byte range of a file on disk, served through mmap without copying it in Python."""
+
+    def __init__(self, path, offset, length):
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+
+class LazyPart:
+    """A body part of known length whose bytes are only produced when it is streamed."""
+
+    def __init__(self, length, produce):
+        self.length = length
+        self.produce = produce
+
+
+def parse_frame_list(frame_list):
+    """'1,5,9' -> [1, 5, 9]; frame numbers are 1-based as in WADO-RS."""
+    try:
+        frames = [int(part) for part in frame_list.split(",") if part.strip()]
+    except ValueError:
+        raise ValueError(f"Invalid frame list: {frame_list}")
+    if not frames or min(frames) < 1:
+        raise ValueError(f"Invalid frame list: {frame_list}")
+    return frames
+
+
+def part_boundary(parts):
+    """A multipart boundary derived from what the parts hold, so every response for the
+    same frames has the same bytes and a Range request can resume an earlier one."""
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, FileSpan):
+            digest.update(f"{part.path}:{part.offset}:{part.length}\n".encode())
+        else:
+            digest.update(part)
+    return digest.hexdigest()
+
+
+def multipart_body(spans, boundary, content_locations=None, media_type=FRAME_MEDIA_TYPE):
+    """Interleave multipart/related part headers (bytes) with the frame spans (or encoded bytes)."""
+    parts = []
+    for i, span in enumerate(spans):
+        header = f"--{boundary}\r\nContent-Type: {media_type}\r\nContent-Length: {_part_length(span)}\r\n"
+        if content_locations:
+            header += f"Content-Location: {content_locations[i]}\r\n"
+        parts.append((header + "\r\n").encode())
+        parts.append(span)
+        parts.append(b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return parts
+
+
+def _part_length(part):
+    return part.length if isinstance(part, (FileSpan, LazyPart)) else len(part)
+
+
+def _iter_span(span, start, end):
+    # Slices of the mapping are handed to the server as-is; the mapping is released
+    # when the last memoryview referencing it goes away.
+    with open(span.path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    for chunk_start in range(span.offset + start, span.offset + end, FRAME_CHUNK_SIZE):
+        yield view[chunk_start:min(chunk_start + FRAME_CHUNK_SIZE, span.offset + end)]
+
+
+def iter_body(parts, start, end):
+    """Yield the bytes of parts[start:end] as if the parts were one contiguous body."""
+    position = 0
+    for part in parts:
+        length = _part_length(part)
+        part_start, part_end = max(start - position, 0), min(end - position, length)
+        if part_start < part_end:
+            if isinstance(part, FileSpan):
+                yield from _iter_span(part, part_start, part_end)
+            elif isinstance(part, LazyPart):
+                yield memoryview(part.produce())[part_start:part_end]
+            else:
+                yield part[part_start:part_end]
+        position += length
+        if position >= end:
+            break
+
+
+def parse_range(range_header, total):
+    """Return (start, end) for a single 'bytes=' range, None to serve everything.
+
+    Raises ValueError when the range cannot be satisfied.
+    """
+    match = _RANGE_RE.match(range_header.strip()) if range_header else None
+    if not match or match.groups() == ("", ""):
+        return None
+
+    first, last = match.groups()
+    if first == "":
+        start, end = max(total - int(last), 0), total
+    else:
+        start = int(first)
+        end = min(int(last) + 1, total) if last else total
+    if start >= total or start >= end:
+        raise ValueError(f"Range {range_header} not satisfiable for {total} bytes")
+    return start, end
+
+
+def body_response(request, parts, media_type, headers=None):
+    """Stream a body made of bytes, FileSpans and LazyParts, honouring single HTTP Range requests."""
+    total = sum(_part_length(part) for part in parts)
+    headers = {"Accept-Ranges": "bytes", **(headers or {})}
+
+    try:
+        byte_range = parse_range(request.headers.get("range"), total)
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{total}"})
+
+    if byte_range is None:
+        start, end, status_code = 0, total, 200
+    else:
+        (start, end), status_code = byte_range, 206
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{total}"
+    headers["Content-Length"] = str(end - start)
+
+    return StreamingResponse(
+        iter_body(parts, start, end), status_code=status_code, media_type=media_type, headers=headers
+    )
+
+
+def frames_response(request, spans, content_locations=None):
+    """A single frame is returned bare (as before); several frames as multipart/related."""
+    accept = request.headers.get("accept", "")
+    if len(spans) == 1 and "multipart/related" not in accept:
+        return body_response(request, spans, FRAME_MEDIA_TYPE)
+
+    boundary = part_boundary(spans)
+    media_type = f'multipart/related; type="{FRAME_MEDIA_TYPE}"; boundary={boundary}'
+    return body_response(request, multipart_body(spans, boundary, content_locations), media_type)
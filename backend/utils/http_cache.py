@@ -0,0 +1,99 @@
+import gzip
+import hashlib
+import os
+
+from fastapi.responses import FileResponse, Response
+from fastapi.staticfiles import StaticFiles
+
+try:
+    import brotli
+except ImportError:  # optional: gzip is always available
+    brotli = None
+
+# Uploaded studies never change, so anything addressed by study content can be cached forever
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# except a study's SEG and what is derived from the mask, which re-segmentation replaces
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+
+def study_etag(study, resource):
+    """Strong ETag for one resource of a study, derived from the uploaded content hashes."""
+    basis = ":".join([
+        study["study_id"],
+        study.get("image_sha256") or study["study_datetime"],
+        study.get("mask_sha256") or "",
+        resource,
+    ])
+    return '"' + hashlib.sha256(basis.encode()).hexdigest()[:32] + '"'
+
+
+def cache_headers(etag, cache_control=IMMUTABLE_CACHE_CONTROL):
+    return {"ETag": etag, "Cache-Control": cache_control}
+
+
+def encoded_etag(etag, encoding):
+    # Each content-coding is a different representation, so it gets its own strong ETag
+    return etag if encoding == "identity" else f'{etag[:-1]}-{encoding}"'
+
+
+def not_modified(request, etag, cache_control=IMMUTABLE_CACHE_CONTROL):
+    """A 304 response when If-None-Match names this ETag (any encoding), otherwise None."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return None
+    for tag in header.split(","):
+        tag = tag.strip().removeprefix("W/")
+        if tag == "*" or tag == etag or tag.startswith(etag[:-1] + "-"):
+            matched = etag if tag == "*" else tag
+            return Response(status_code=304, headers={**cache_headers(matched, cache_control), "Vary": "Accept-Encoding"})
+    return None
+
+
+def negotiate_encoding(request):
+    """Pick br (if the brotli package is installed) or gzip from Accept-Encoding."""
+    accepted = {}
+    for item in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.lower()] = quality
+
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return "identity"
+
+
+def compress(payload, encoding):
+    if encoding == "br":
+        return brotli.compress(payload)
+    if encoding == "gzip":
+        return gzip.compress(payload, compresslevel=6, mtime=0)
+    return payload
+
+
+def encoded_response(body, encoding, etag, media_type="application/json"):
+    headers = {**cache_headers(encoded_etag(etag, encoding)), "Vary": "Accept-Encoding"}
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+def immutable_file_response(path, etag, media_type=None, cache_control=IMMUTABLE_CACHE_CONTROL):
+    return FileResponse(path, media_type=media_type, headers=cache_headers(etag, cache_control))
+
+
+class ImmutableStaticFiles(StaticFiles):
+    """StaticFiles (which already answers If-None-Match with 304) plus immutable caching."""
+
+    def file_response(self, full_path, *args, **kwargs):
+        response = super().file_response(full_path, *args, **kwargs)
+        segmentation = os.path.basename(os.path.dirname(full_path)) == "segmentation"
+        response.headers["Cache-Control"] = REVALIDATE_CACHE_CONTROL if segmentation else IMMUTABLE_CACHE_CONTROL
+        return response
@@ -0,0 +1,107 @@
+import json
+import os
+import struct
+from functools import lru_cache
+
+INDEX_FILENAME = "instance_index.json"
+PIXEL_DATA_TAG = (0x7FE0, 0x0010)
+
+
+def pixel_data_span(file_path):
+    """Return the header dataset and the (offset, length) of the PixelData value."""
+    # pydicom is only needed to write indexes; serving reads the JSON index alone
+    import pydicom
+
+    with open(file_path, "rb") as f:
+        ds = pydicom.dcmread(f, stop_before_pixels=True)
+        element_start = f.tell()
+        header = f.read(12)
+
+    transfer_syntax = ds.file_meta.TransferSyntaxUID
+    endian = "<" if transfer_syntax.is_little_endian else ">"
+    group, element = struct.unpack(f"{endian}HH", header[:4])
+    if (group, element) != PIXEL_DATA_TAG:
+        raise ValueError(f"PixelData not found in {file_path}")
+
+    if transfer_syntax.is_implicit_VR:
+        (length,) = struct.unpack(f"{endian}I", header[4:8])
+        offset = element_start + 8
+    else:
+        # OB/OW: tag, VR, two reserved bytes, 4-byte length
+        (length,) = struct.unpack(f"{endian}I", header[8:12])
+        offset = element_start + 12
+
+    if length == 0xFFFFFFFF:
+        raise ValueError(f"Encapsulated PixelData is not indexable: {file_path}")
+
+    return ds, offset, length
+
+
+def index_entry(file_path):
+    ds, offset, length = pixel_data_span(file_path)
+    number_of_frames = int(ds.get("NumberOfFrames") or 1)
+    return {
+        "sop_instance_uid": str(ds.SOPInstanceUID),
+        "sop_class_uid": str(ds.SOPClassUID),
+        "file": os.path.basename(file_path),
+        "instance_number": int(ds.InstanceNumber) if "InstanceNumber" in ds else None,
+        "offset": offset,
+        "length": length,
+        "number_of_frames": number_of_frames,
+        "frame_length": length // number_of_frames,
+    }
+
+
+def write_instance_index(dicom_dir, study_uid, series_uid, entries):
+    index = {
+        "study_uid": study_uid,
+        "series_uid": series_uid,
+        "instances": entries,
+    }
+    tmp_path = os.path.join(dicom_dir, f".{INDEX_FILENAME}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, separators=(",", ":"))
+    os.replace(tmp_path, os.path.join(dicom_dir, INDEX_FILENAME))
+    return index
+
+
+def build_instance_index(dicom_dir):
+    """Index an existing series on disk (studies uploaded before indexes existed)."""
+    import pydicom
+
+    files = sorted(f for f in os.listdir(dicom_dir) if f.endswith(".dcm"))
+    entries = [index_entry(os.path.join(dicom_dir, f)) for f in files]
+    study_uid = series_uid = None
+    if files:
+        ds = pydicom.dcmread(os.path.join(dicom_dir, files[0]), stop_before_pixels=True)
+        study_uid, series_uid = str(ds.StudyInstanceUID), str(ds.SeriesInstanceUID)
+    return write_instance_index(dicom_dir, study_uid, series_uid, entries)
+
+
+@lru_cache(maxsize=256)
+def load_instance_index(dicom_dir):
+    index_path = os.path.join(dicom_dir, INDEX_FILENAME)
+    try:
+        with open(index_path, "r") as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        index = build_instance_index(dicom_dir)
+
+    index["by_uid"] = {entry["sop_instance_uid"]: entry for entry in index["instances"]}
+    return index
+
+
+def frame_span(entry, frame_number):
+    """(offset, length) of a 1-based frame; indexes written before multi-frame support have one frame."""
+    number_of_frames = entry.get("number_of_frames", 1)
+    if not 1 <= frame_number <= number_of_frames:
+        raise IndexError(f"Frame {frame_number} out of range 1..{number_of_frames}")
+    frame_length = entry.get("frame_length", entry["length"])
+    return entry["offset"] + (frame_number - 1) * frame_length, frame_length
+
+
+def read_pixel_data(dicom_dir, entry, frame_number=1):
+    offset, length = frame_span(entry, frame_number)
+    with open(os.path.join(dicom_dir, entry["file"]), "rb") as f:
+        f.seek(offset)
+        return f.read(length)
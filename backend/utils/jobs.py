@@ -0,0 +1,310 @@
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from uuid import uuid4
+
+from models.job import create_job, update_job
+from models.study import (
+    StudyMetadata, find_study_by_content, get_study, save_metadata, update_segmentation,
+)
+from utils.objects import link_object, object_path, release_objects
+from utils.storage import (
+    STORAGE_MODE, derived_available, derived_dir, derived_lock, dicom_dir, directory_bytes, mark_derived,
+    study_dir,
+)
+from utils.metrics import (
+    conversion_bytes_written, conversion_stage_duration, conversions, conversions_in_flight,
+)
+
+CONVERSION_WORKERS = int(os.environ.get("CONVERSION_WORKERS", 2))
+# Lazy-storage regenerations get their own workers so reads never queue behind uploads
+REGENERATION_WORKERS = int(os.environ.get("REGENERATION_WORKERS", 1))
+
+_pool = None
+_regeneration_pool = None
+
+
+def _spawn_pool(workers):
+    # Spawned (not forked) workers: the API process runs threads, and only the
+    # workers need to import the conversion stack.
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = _spawn_pool(CONVERSION_WORKERS)
+    return _pool
+
+
+def get_regeneration_pool():
+    global _regeneration_pool
+    if _regeneration_pool is None:
+        _regeneration_pool = _spawn_pool(REGENERATION_WORKERS)
+    return _regeneration_pool
+
+
+class StageTimer:
+    """Progress callback that also times each stage (a stage ends when the next one starts)."""
+
+    def __init__(self, job_id, study_id):
+        self.job_id = job_id
+        self.study_id = study_id
+        self.seconds = {}
+        self._stage = None
+        self._start = None
+
+    def __call__(self, stage):
+        self.finish()
+        self._stage, self._start = stage, time.perf_counter()
+        update_job(self.job_id, stage=stage)
+
+    def finish(self):
+        if self._stage is None:
+            return
+        elapsed = time.perf_counter() - self._start
+        self.seconds[self._stage] = elapsed
+        print(f"span=conversion_stage stage={self._stage} study_id={self.study_id} seconds={elapsed:.3f}")
+        self._stage = None
+
+
+def run_conversion_job(job_id, study_id, study_uid, image_path, mask_path, radiography_type,
+                       image_sha256=None, mask_sha256=None, series_study_id=None):
+    """Worker-side body of an upload job; the study is only catalogued once fully written.
+
+    With series_study_id the image is already converted there, and its series is reused.
+    """
+    from utils.conversion import process_shared_upload, process_upload
+
+    timer = StageTimer(job_id, study_id)
+    try:
+        update_job(job_id, status="running")
+        output_dir = derived_dir(study_id)
+        bytes_before = directory_bytes(output_dir)
+        # The series carries the catalogued study time, so a regenerated copy is identical
+        created = datetime.now()
+        if series_study_id:
+            segmentation_classes, segments = process_shared_upload(
+                study_id, study_uid, series_study_id, mask_path, mask_sha256, progress=timer, created=created,
+            )
+        else:
+            study_uid, segmentation_classes, segments = process_upload(
+                study_id, image_path, mask_path,
+                study_uid=study_uid,
+                progress=timer,
+                mask_sha256=mask_sha256,
+                created=created,
+            )
+        timer.finish()
+        bytes_written = directory_bytes(output_dir) - bytes_before
+        if os.path.isdir(output_dir):
+            # A lazily stored study reusing a series has nothing derived until first access
+            mark_derived(study_id)
+        save_metadata(StudyMetadata(
+            study_id=study_id,
+            study_uid=study_uid,
+            study_datetime=created.isoformat(),
+            radiography_type=radiography_type,
+            segmentation_classes=segmentation_classes,
+            image_sha256=image_sha256,
+            mask_sha256=mask_sha256,
+            image_file=os.path.basename(image_path),
+            mask_file=os.path.basename(mask_path),
+            segments=segments,
+        ))
+        update_job(job_id, status="done")
+        return {
+            "study_id": study_id,
+            "study_uid": study_uid,
+            "segmentation_classes": segmentation_classes,
+            "stage_seconds": timer.seconds,
+            "bytes_written": bytes_written,
+        }
+    except Exception as e:
+        update_job(job_id, status="failed", error=str(e))
+        # Never catalogued: drop what was written and the volumes only this study used
+        shutil.rmtree(derived_dir(study_id), ignore_errors=True)
+        shutil.rmtree(study_dir(study_id), ignore_errors=True)
+        release_objects(*(
+            object_path(sha256, path) for sha256, path in ((image_sha256, image_path), (mask_sha256, mask_path))
+            if sha256
+        ))
+        raise
+
+
+def run_resegmentation_job(job_id, study_id, mask_path, mask_sha256):
+    """Worker-side body of a mask-only job: a new SEG against the study's stored series."""
+    from utils.conversion import resegment_study
+    from utils.volumes import discard_volume
+
+    timer = StageTimer(job_id, study_id)
+    try:
+        update_job(job_id, status="running")
+        # Held until the catalog has the new mask, so concurrent masks for one study apply
+        # one after the other and a lazy regeneration never mixes SEG and catalog
+        with derived_lock(study_id):
+            previous_mask_file = get_study(study_id)["mask_file"]
+            segmentation_classes, segments = resegment_study(study_id, mask_path, mask_sha256, progress=timer)
+            timer.finish()
+            update_segmentation(study_id, mask_sha256, os.path.basename(mask_path), segmentation_classes, segments)
+        previous_mask_path = previous_mask_file and os.path.join(study_dir(study_id), previous_mask_file)
+        if previous_mask_path and previous_mask_path != mask_path:
+            discard_volume(previous_mask_path)
+        update_job(job_id, status="done")
+        return {
+            "study_id": study_id,
+            "segmentation_classes": segmentation_classes,
+            "stage_seconds": timer.seconds,
+            "bytes_written": directory_bytes(os.path.join(derived_dir(study_id), "segmentation")),
+        }
+    except Exception as e:
+        update_job(job_id, status="failed", error=str(e))
+        if get_study(study_id)["mask_file"] != os.path.basename(mask_path):
+            # The study keeps its current mask; the rejected one goes
+            discard_volume(mask_path)
+            release_objects(object_path(mask_sha256, mask_path))
+        raise
+
+
+def run_regeneration(study_id):
+    """Worker-side body of a lazy-storage regeneration (see storage.ensure_derived)."""
+    from utils.conversion import regenerate_derived
+    from utils.volumes import source_paths
+
+    with derived_lock(study_id):
+        if derived_available(study_id):
+            # Another process regenerated it while this one waited
+            return
+        study = get_study(study_id)
+        image_path, mask_path = source_paths(study)
+        try:
+            created = datetime.fromisoformat(study["study_datetime"])
+        except ValueError:
+            created = None
+        regenerate_derived(study_id, study["study_uid"], image_path, mask_path, study["mask_sha256"], created)
+        mark_derived(study_id)
+
+
+def submit_conversion(job_id, study_id, study_uid, image_path, mask_path, radiography_type,
+                      image_sha256=None, mask_sha256=None, series_study_id=None):
+    return _submit(
+        job_id, study_id, study_uid, run_conversion_job, job_id, study_id, study_uid,
+        image_path, mask_path, radiography_type, image_sha256, mask_sha256, series_study_id,
+    )
+
+
+def submit_resegmentation(job_id, study, mask_path, mask_sha256):
+    return _submit(
+        job_id, study["study_id"], study["study_uid"], run_resegmentation_job,
+        job_id, study["study_id"], mask_path, mask_sha256,
+    )
+
+
+def submit_upload(image, mask, radiography_type):
+    """Queue an uploaded pair, reusing what the catalog already has for the same content.
+
+    image and mask are (sha256, object path, original filename) from the object store.
+    Returns (response fields, future). An identical pair returns the existing study and
+    no future. The same image with a new mask becomes a new study whose series is
+    copied from the existing study's under its own UIDs, with its own SEG; the existing
+    study is left alone (submit_mask is what replaces a study's mask). Anything else
+    is converted.
+    """
+    image_sha256, image_object, image_filename = image
+    mask_sha256, mask_object, mask_filename = mask
+
+    existing = find_study_by_content(image_sha256, mask_sha256)
+    if existing and existing["mask_sha256"] == mask_sha256:
+        return {
+            "study_id": existing["study_id"], "study_uid": existing["study_uid"],
+            "segmentation_classes": existing["segmentation_classes"], "deduplicated": True,
+        }, None
+
+    series_study_id = None
+    if existing:
+        from utils.volumes import check_mask_geometry, source_paths
+
+        try:
+            image_path, _ = source_paths(existing)
+        except FileNotFoundError:
+            image_path = None
+        if image_path:
+            check_mask_geometry(image_path, mask_object)
+            # Lazy storage copies nothing (see process_shared_upload); eager needs the series on disk
+            if STORAGE_MODE == "lazy" or os.path.isdir(dicom_dir(existing["study_id"])):
+                series_study_id = existing["study_id"]
+
+    job_id = str(uuid4())
+    study_id, study_uid = str(uuid4()), f"2.25.{uuid4().int}"
+    source_dir = study_dir(study_id)
+    os.makedirs(source_dir, exist_ok=True)
+    image_path = link_object(image_object, os.path.join(source_dir, os.path.basename(image_filename)))
+    mask_path = link_object(mask_object, os.path.join(source_dir, os.path.basename(mask_filename)))
+    future = submit_conversion(
+        job_id, study_id, study_uid, image_path, mask_path, radiography_type, image_sha256, mask_sha256,
+        series_study_id,
+    )
+    fields = {"job_id": job_id, "study_id": study_id, "study_uid": study_uid}
+    if series_study_id:
+        fields["reused_series_of"] = series_study_id
+    return fields, future
+
+
+def submit_mask(study, mask):
+    """Queue a new mask for an existing study: a new SEG against its stored series.
+
+    mask is (sha256, object path, original filename). Raises ValueError when the mask's
+    voxel grid differs from the study image. Returns (response fields, future); the
+    future is None when the study already has this exact mask.
+    """
+    from utils.volumes import check_mask_geometry, source_paths
+
+    mask_sha256, mask_object, mask_filename = mask
+    fields = {"study_id": study["study_id"], "study_uid": study["study_uid"]}
+    if study["mask_sha256"] == mask_sha256:
+        return {**fields, "segmentation_classes": study["segmentation_classes"], "deduplicated": True}, None
+
+    try:
+        image_path, _ = source_paths(study)
+    except FileNotFoundError:
+        image_path = None
+    if image_path:
+        check_mask_geometry(image_path, mask_object)
+
+    source_dir = study_dir(study["study_id"])
+    mask_name = os.path.basename(mask_filename)
+    if mask_name in (study["image_file"], study["mask_file"]):
+        # The old mask stays readable until the new SEG and statistics are in
+        mask_name = f"{mask_sha256[:12]}-{mask_name}"
+    mask_path = link_object(mask_object, os.path.join(source_dir, mask_name))
+    job_id = str(uuid4())
+    future = submit_resegmentation(job_id, study, mask_path, mask_sha256)
+    return {"job_id": job_id, **fields, "reused_series": True}, future
+
+
+def _submit(job_id, study_id, study_uid, job, *args):
+    create_job(job_id, study_id, study_uid)
+    conversions_in_flight.inc()
+    future = get_pool().submit(job, *args)
+
+    def _on_done(f):
+        conversions_in_flight.dec()
+        # A crashed worker never gets to record its own failure
+        error = f.exception()
+        if error is not None:
+            conversions.inc(status="failed")
+            update_job(job_id, status="failed", error=str(error) or type(error).__name__)
+            return
+
+        # Stage timings are measured in the worker and reported back with the result
+        result = f.result()
+        conversions.inc(status="done")
+        for stage, seconds in result["stage_seconds"].items():
+            conversion_stage_duration.observe(seconds, stage=stage)
+        conversion_bytes_written.inc(result["bytes_written"])
+
+    future.add_done_callback(_on_done)
+    return future
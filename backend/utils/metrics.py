@@ -0,0 +1,271 @@
+import bisect
+import contextvars
+import cProfile
+import hmac
+import inspect
+import os
+import random
+import re
+import threading
+import time
+from functools import wraps
+
+from fastapi.routing import APIRoute
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_DIR_BYTES = int(os.environ.get("PROFILE_DIR_BYTES", 512 * 1024 ** 2))
+# Admin token for switching profiling and for X-Profile; without one neither is honoured
+PROFILING_TOKEN = os.environ.get("PROFILING_TOKEN", "")
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STAGE_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_lock = threading.Lock()
+_metrics = {}
+_collectors = []
+
+
+class _Metric:
+    def __init__(self, name, kind, documentation, buckets=None):
+        self.name = name
+        self.kind = kind
+        self.documentation = documentation
+        self.buckets = buckets
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def inc(self, amount=1, **labels):
+        with _lock:
+            key = self._key(labels)
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with _lock:
+            self.values[self._key(labels)] = value
+
+    def observe(self, value, **labels):
+        with _lock:
+            key = self._key(labels)
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+
+def _register(name, kind, documentation, buckets=None):
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = _Metric(name, kind, documentation, buckets)
+        return _metrics[name]
+
+
+def counter(name, documentation):
+    return _register(name, "counter", documentation)
+
+
+def gauge(name, documentation):
+    return _register(name, "gauge", documentation)
+
+
+def histogram(name, documentation, buckets=LATENCY_BUCKETS):
+    return _register(name, "histogram", documentation, tuple(buckets))
+
+
+def register_collector(collect):
+    """collect() is called at scrape time and returns [(name, kind, documentation, {labels: value})]."""
+    _collectors.append(collect)
+
+
+def register_lru_cache(name, cached_function):
+    """Export the hit/miss counters of a functools.lru_cache."""
+    def collect():
+        info = cached_function.cache_info()
+        return [(
+            "lru_cache_requests_total", "counter", "functools.lru_cache lookups",
+            {(("cache", name), ("result", "hit")): info.hits, (("cache", name), ("result", "miss")): info.misses},
+        )]
+    register_collector(collect)
+
+
+http_request_duration = histogram("http_request_duration_seconds", "HTTP request latency by route")
+http_response_bytes = counter("http_response_bytes_total", "Bytes sent in HTTP response bodies")
+upload_bytes = counter("upload_bytes_total", "Bytes received in uploaded files")
+conversion_stage_duration = histogram(
+    "conversion_stage_duration_seconds", "Conversion pipeline stage latency", STAGE_BUCKETS
+)
+conversion_bytes_written = counter("conversion_bytes_written_total", "Bytes written by conversions")
+conversions_in_flight = gauge("conversions_in_flight", "Conversions queued or running")
+conversions = counter("conversions_total", "Finished conversions by status")
+cache_requests = counter("cache_requests_total", "Disk cache lookups by cache and result")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        snapshot = [
+            (metric.name, metric.kind, metric.documentation, metric.buckets, dict(metric.values))
+            for metric in _metrics.values()
+        ]
+    for collect in _collectors:
+        for name, kind, documentation, values in collect():
+            snapshot.append((name, kind, documentation, None, values))
+
+    seen = set()
+    for name, kind, documentation, buckets, values in snapshot:
+        if name not in seen:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            seen.add(name)
+        for key, value in sorted(values.items()):
+            if kind != "histogram":
+                lines.append(f"{name}{_labels(key)} {_format_value(value)}")
+                continue
+            bucket_counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_labels(key, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(key, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{_labels(key)} {_format_value(total)}")
+            lines.append(f"{name}_count{_labels(key)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+# Per-request profiling, switchable at runtime
+
+_profiling = {"enabled": os.environ.get("PROFILING_ENABLED", "0") == "1", "sample_rate": 0.0}
+_current_profile = contextvars.ContextVar("current_profile", default=None)
+
+
+def profiling_settings():
+    return dict(_profiling)
+
+
+def configure_profiling(enabled=None, sample_rate=None):
+    if enabled is not None:
+        _profiling["enabled"] = enabled
+    if sample_rate is not None:
+        _profiling["sample_rate"] = min(max(sample_rate, 0.0), 1.0)
+    return profiling_settings()
+
+
+def profiling_authorized(request):
+    """Whether the request carries PROFILING_TOKEN as a bearer token."""
+    if not PROFILING_TOKEN:
+        return False
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(token.encode(), PROFILING_TOKEN.encode())
+
+
+# cProfile cannot run two profiles at once (ValueError on Python 3.12+), so
+# a request that comes in while another is being profiled just runs unprofiled
+_profile_lock = threading.Lock()
+_profile_store = None
+
+
+def start_request_profile(request):
+    """A cProfile.Profile for this request when profiling is on and the request asks for it
+    (authorized X-Profile header) or is sampled; the route handler runs under it (see ProfiledRoute).
+
+    Every profile that is started must be handed to finish_request_profile.
+    """
+    if not _profiling["enabled"]:
+        return None
+    asked = "x-profile" in request.headers and profiling_authorized(request)
+    if not asked and random.random() >= _profiling["sample_rate"]:
+        return None
+    if not _profile_lock.acquire(blocking=False):
+        return None
+    profile = cProfile.Profile()
+    _current_profile.set(profile)
+    return profile
+
+
+def _profiles():
+    global _profile_store
+    if _profile_store is None:
+        from utils.disk_cache import DiskCache
+
+        _profile_store = DiskCache("profile", PROFILE_DIR, PROFILE_DIR_BYTES)
+    return _profile_store
+
+
+def finish_request_profile(profile, request):
+    """Save a request's profile to PROFILE_DIR (oldest files go past PROFILE_DIR_BYTES); returns its path."""
+    if profile is None:
+        return None
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = re.sub(r"[^A-Za-z0-9]+", "_", request.url.path).strip("_")[:80]
+        path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{request.method}-{name}.prof")
+        profile.dump_stats(path)
+    finally:
+        _profile_lock.release()
+    _profiles().added(os.path.getsize(path))
+    return path
+
+
+def _profiled(endpoint):
+    if getattr(endpoint, "_profiled", False):
+        # Routes copied by include_router are already wrapped
+        return endpoint
+    if inspect.iscoroutinefunction(endpoint):
+        @wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            profile = _current_profile.get()
+            if profile is None:
+                return await endpoint(*args, **kwargs)
+            profile.enable()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                profile.disable()
+        wrapper._profiled = True
+        return wrapper
+
+    @wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        # Sync handlers run in the threadpool; the context (and the profile) is copied there
+        profile = _current_profile.get()
+        if profile is None:
+            return endpoint(*args, **kwargs)
+        profile.enable()
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            profile.disable()
+    wrapper._profiled = True
+    return wrapper
+
+
+class ProfiledRoute(APIRoute):
+    """APIRoute whose handler can run under the request's profiler."""
+
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, _profiled(endpoint), **kwargs)
@@ -0,0 +1,105 @@
+import os
+import shutil
+from uuid import uuid4
+
+from utils.storage import UPLOAD_DIR
+from utils.upload import save_stream, save_upload, stream_form
+
+# Kept out of UPLOAD_DIR, which is served as static files under /dicom. It must be on
+# the same filesystem for studies to hard-link their volumes instead of copying them.
+OBJECTS_DIR = os.environ.get("OBJECTS_DIR", "objects")
+_LEGACY_OBJECTS_DIR = os.path.join(UPLOAD_DIR, "objects")
+
+if os.path.isdir(_LEGACY_OBJECTS_DIR) and not os.path.exists(OBJECTS_DIR):
+    # Stores from before the move; study directories hold links, so renaming is safe
+    os.rename(_LEGACY_OBJECTS_DIR, OBJECTS_DIR)
+
+
+def _extension(filename):
+    return ".nii.gz" if filename.lower().endswith(".gz") else ".nii"
+
+
+def object_path(sha256, filename):
+    """Where a volume with this content lives in the store; the extension keeps nibabel happy."""
+    return os.path.join(OBJECTS_DIR, sha256[:2], sha256 + _extension(filename))
+
+
+def _temp_path(filename):
+    directory = os.path.join(OBJECTS_DIR, "tmp")
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{uuid4()}{_extension(filename)}")
+
+
+def _commit(temp_path, sha256, filename):
+    path = object_path(sha256, filename)
+    if os.path.exists(path):
+        # Already stored: the new copy is only needed for its hash
+        os.remove(temp_path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+    return path
+
+
+async def store_upload(upload_file):
+    """Stream an upload into the object store, hashing as it goes: (sha256, size, object path)."""
+    temp_path = _temp_path(upload_file.filename)
+    sha256, size = await save_upload(upload_file, temp_path)
+    return sha256, size, _commit(temp_path, sha256, upload_file.filename)
+
+
+async def store_form(request, file_fields, multiple=(), raw=()):
+    """Stream a multipart request's files into the object store as they arrive.
+
+    Returns (form fields, {file field: (sha256, size, object path, filename)}). Fields
+    in multiple map to lists of those, or of the HTTPException that rejected a file;
+    raw fields are not stored but left as (filename, temp path, sha256, size) for the
+    caller to remove (see utils.upload.stream_form).
+    """
+    fields, files = await stream_form(request, file_fields, _temp_path, multiple=multiple, raw=raw)
+
+    def commit(filename, temp_path, sha256, size):
+        return sha256, size, _commit(temp_path, sha256, filename), filename
+
+    stored = {}
+    for name, value in files.items():
+        if name in raw:
+            stored[name] = value
+        elif name in multiple:
+            stored[name] = [entry if isinstance(entry, Exception) else commit(*entry) for entry in value]
+        else:
+            stored[name] = commit(*value)
+    return fields, stored
+
+
+def store_stream(stream, filename):
+    """Blocking store_upload for file-like sources (archive members)."""
+    temp_path = _temp_path(filename)
+    sha256, size = save_stream(stream, temp_path, filename)
+    return sha256, size, _commit(temp_path, sha256, filename)
+
+
+def link_object(path, dest_path):
+    """Put a stored object at dest_path (a study directory) without copying it when possible."""
+    temp_path = f"{dest_path}.{uuid4().hex}.tmp"
+    try:
+        os.link(path, temp_path)
+    except OSError:
+        # Hard links need the same filesystem
+        shutil.copyfile(path, temp_path)
+    os.replace(temp_path, dest_path)
+    return dest_path
+
+
+def release_objects(*paths):
+    """Remove stored objects no study links to, after the upload that stored them failed.
+
+    A study directory holds a hard link to each of its volumes, so an object whose
+    only link is the store's own is unreferenced.
+    """
+    for path in paths:
+        try:
+            if os.stat(path).st_nlink <= 1:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,87 @@
+import os
+import re
+
+from utils.dicomweb import DICOMWEB_BASE_URL
+
+QIDO_MAX_LIMIT = int(os.environ.get("QIDO_MAX_LIMIT", 1000))
+
+# Every catalogued study holds one CT series (see conversion), plus a SEG series
+# whenever its mask labels anything
+STUDY_MODALITY = "CT"
+SEGMENTATION_MODALITY = "SEG"
+
+_DATE_RE = re.compile(r"^\d{8}$")
+
+# QIDO-RS matching keys accepted by keyword or by tag
+STUDY_DATE_KEYS = ("StudyDate", "00080020")
+MODALITIES_KEYS = ("ModalitiesInStudy", "00080061")
+DESCRIPTION_KEYS = ("StudyDescription", "00081030")
+STUDY_UID_KEYS = ("StudyInstanceUID", "0020000D")
+SEGMENTATION_CLASS_KEYS = ("SegmentationClass",)
+
+# includefield attributes on top of the default study attributes
+OPTIONAL_FIELDS = {
+    "ModalitiesInStudy": "00080061",
+    "NumberOfStudyRelatedSeries": "00201206",
+    "RetrieveURL": "00081190",
+}
+
+
+def query_values(params, keys):
+    """All values given for any of the keys; repeated parameters and comma lists are merged."""
+    values = []
+    for key in keys:
+        for value in params.getlist(key):
+            values.extend(part.strip() for part in value.split(",") if part.strip())
+    return values
+
+
+def parse_date_range(value):
+    """DICOM DA range matching: 'YYYYMMDD', 'YYYYMMDD-', '-YYYYMMDD' or 'YYYYMMDD-YYYYMMDD'."""
+    first, separator, last = value.partition("-")
+    if not separator:
+        last = first
+    for part in (first, last):
+        if part and not _DATE_RE.match(part):
+            raise ValueError(f"Invalid StudyDate: {value}")
+    if not first and not last:
+        raise ValueError(f"Invalid StudyDate: {value}")
+    return first or None, last or None
+
+
+def parse_includefields(params):
+    fields = set()
+    for value in query_values(params, ("includefield",)):
+        if value == "all":
+            return set(OPTIONAL_FIELDS)
+        for keyword, tag in OPTIONAL_FIELDS.items():
+            if value in (keyword, tag):
+                fields.add(keyword)
+    return fields
+
+
+def study_modalities(study):
+    if study["segmentation_classes"]:
+        return [STUDY_MODALITY, SEGMENTATION_MODALITY]
+    return [STUDY_MODALITY]
+
+
+def study_json(study, includefields=()):
+    """DICOM JSON for one catalogue row."""
+    result = {
+        "0020000D": {"vr": "UI", "Value": [study["study_uid"]]},
+        "00080020": {"vr": "DA", "Value": [study["study_date"]]},
+        "00080030": {"vr": "TM", "Value": [study["study_time"]]},
+        "00100010": {"vr": "PN", "Value": [{"Alphabetic": "Anonymous"}]},
+        "00100020": {"vr": "LO", "Value": [study["study_uid"]]},
+        "00080060": {"vr": "CS", "Value": [STUDY_MODALITY]},
+        "00081030": {"vr": "LO", "Value": [study.get("radiography_type", "CBCT")]},
+    }
+    modalities = study_modalities(study)
+    if "ModalitiesInStudy" in includefields:
+        result["00080061"] = {"vr": "CS", "Value": modalities}
+    if "NumberOfStudyRelatedSeries" in includefields:
+        result["00201206"] = {"vr": "IS", "Value": [len(modalities)]}
+    if "RetrieveURL" in includefields:
+        result["00081190"] = {"vr": "UR", "Value": [f"{DICOMWEB_BASE_URL}/studies/{study['study_uid']}"]}
+    return result
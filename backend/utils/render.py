@@ -0,0 +1,174 @@
+import io
+import os
+from functools import lru_cache
+
+from utils.disk_cache import DiskCache
+from utils.instance_index import load_instance_index, read_pixel_data
+
+RENDER_CACHE_DIR = os.environ.get("RENDER_CACHE_DIR", "render_cache")
+RENDER_CACHE_BYTES = int(os.environ.get("RENDER_CACHE_BYTES", 512 * 1024 * 1024))
+THUMBNAIL_SIZE = int(os.environ.get("THUMBNAIL_SIZE", 128))
+DEFAULT_QUALITY = 90
+
+RENDERED_MEDIA_TYPES = {"jpeg": "image/jpeg", "png": "image/png"}
+
+_cache = DiskCache("render", RENDER_CACHE_DIR, RENDER_CACHE_BYTES)
+# numpy, pydicom and PIL are imported where pixels are touched, so the API starts without them
+
+
+@lru_cache(maxsize=4096)
+def pixel_format(path):
+    """(rows, columns, numpy dtype, slope, intercept) of the frames stored in a DICOM file."""
+    import numpy as np
+    import pydicom
+
+    ds = pydicom.dcmread(path, stop_before_pixels=True)
+    shared = ds.get("SharedFunctionalGroupsSequence")
+    transform = shared[0].get("PixelValueTransformationSequence") if shared else None
+    source = transform[0] if transform else ds
+
+    dtype = np.dtype(f"{'i' if ds.get('PixelRepresentation', 0) else 'u'}{ds.BitsAllocated // 8}")
+    is_little_endian = ds.file_meta.TransferSyntaxUID.is_little_endian
+    return (
+        int(ds.Rows),
+        int(ds.Columns),
+        dtype.newbyteorder("<" if is_little_endian else ">"),
+        float(source.get("RescaleSlope", 1) or 1),
+        float(source.get("RescaleIntercept", 0) or 0),
+    )
+
+
+def parse_window(window):
+    """'center,width[,function]' (the DICOMweb window parameter) -> (center, width) or None."""
+    if not window:
+        return None
+    try:
+        center, width = (float(part) for part in window.split(",")[:2])
+    except ValueError:
+        raise ValueError(f"Invalid window: {window}")
+    if width < 1:
+        raise ValueError(f"Invalid window width: {width}")
+    return center, width
+
+
+def parse_viewport(viewport, default=None):
+    """'width,height' (or a single size for both) -> (width, height)."""
+    if not viewport:
+        return default
+    try:
+        sizes = [int(part) for part in viewport.split(",") if part.strip()]
+    except ValueError:
+        raise ValueError(f"Invalid viewport: {viewport}")
+    if not 1 <= len(sizes) <= 2 or min(sizes) < 1:
+        raise ValueError(f"Invalid viewport: {viewport}")
+    return sizes[0], sizes[-1]
+
+
+def frame_pixels(dicom_dir, entry, frame_number=1):
+    """Modality values (rescale applied) of one frame, read straight from its byte span."""
+    import numpy as np
+
+    rows, columns, dtype, slope, intercept = pixel_format(os.path.join(dicom_dir, entry["file"]))
+    pixels = np.frombuffer(read_pixel_data(dicom_dir, entry, frame_number), dtype=dtype)
+    pixels = pixels[:rows * columns].reshape(rows, columns).astype(np.float32)
+    if slope != 1 or intercept != 0:
+        pixels = pixels * slope + intercept
+    return pixels
+
+
+def apply_window(pixels, window=None):
+    """Linear VOI LUT to 8 bits; without a window the frame's own range is used."""
+    import numpy as np
+
+    if window is None:
+        low, high = float(pixels.min()), float(pixels.max())
+    else:
+        center, width = window
+        low, high = center - 0.5 - (width - 1) / 2, center - 0.5 + (width - 1) / 2
+    if high <= low:
+        return np.zeros(pixels.shape, dtype=np.uint8)
+    scaled = (pixels - low) * (255.0 / (high - low))
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+
+def pyramid_level(shape, viewport):
+    """Coarsest power-of-two reduction that still covers the viewport."""
+    rows, columns = shape
+    width, height = viewport
+    level = 0
+    while (columns >> (level + 1)) >= width and (rows >> (level + 1)) >= height:
+        level += 1
+    return level
+
+
+def _pyramid_image(dicom_dir, entry, frame_number, window, level):
+    """8-bit windowed frame at a pyramid level; levels >= 1 are cached as PNG and built from the level above."""
+    from PIL import Image
+
+    if level == 0:
+        return Image.fromarray(apply_window(frame_pixels(dicom_dir, entry, frame_number), window))
+
+    key = f"{dicom_dir}:{entry['sop_instance_uid']}:{frame_number}:{window}:level{level}"
+    cached = _cache.get(key, "png")
+    if cached is not None:
+        return Image.open(io.BytesIO(cached))
+
+    image = _pyramid_image(dicom_dir, entry, frame_number, window, level - 1).reduce(2)
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", compress_level=1)
+    _cache.put(key, "png", buffer.getvalue())
+    return image
+
+
+def render_frame(dicom_dir, entry, frame_number=1, window=None, viewport=None,
+                 image_format="jpeg", quality=DEFAULT_QUALITY):
+    """Encoded JPEG/PNG of one frame, scaled to fit the viewport; results are cached on disk."""
+    from PIL import Image
+
+    key = (
+        f"{dicom_dir}:{entry['sop_instance_uid']}:{frame_number}:{window}:{viewport}"
+        f":{image_format}:{quality}"
+    )
+    cached = _cache.get(key, image_format)
+    if cached is not None:
+        return cached
+
+    rows, columns = pixel_format(os.path.join(dicom_dir, entry["file"]))[:2]
+    level = pyramid_level((rows, columns), viewport) if viewport else 0
+    image = _pyramid_image(dicom_dir, entry, frame_number, window, level)
+    if viewport:
+        # Keep the aspect ratio, never upscale
+        image = image.copy()
+        image.thumbnail(viewport, Image.Resampling.LANCZOS)
+
+    buffer = io.BytesIO()
+    if image_format == "png":
+        image.save(buffer, format="PNG")
+    else:
+        image.save(buffer, format="JPEG", quality=quality)
+    data = buffer.getvalue()
+    _cache.put(key, image_format, data)
+    return data
+
+
+def series_frames(index):
+    """(entry, frame_number) for every frame of the series, in instance order."""
+    return [
+        (entry, n)
+        for entry in index["instances"]
+        for n in range(1, entry.get("number_of_frames", 1) + 1)
+    ]
+
+
+def representative_frame(index):
+    """The middle frame of the series stands in for the study and the series."""
+    frames = series_frames(index)
+    if not frames:
+        raise IndexError("Series has no frames")
+    return frames[len(frames) // 2]
+
+
+def render_thumbnail(dicom_dir, entry=None, frame_number=None, size=THUMBNAIL_SIZE):
+    if entry is None:
+        entry, frame_number = representative_frame(load_instance_index(dicom_dir))
+    return render_frame(dicom_dir, entry, frame_number or 1, viewport=(size, size))
@@ -0,0 +1,91 @@
+import gzip
+import json
+import os
+
+from utils.disk_cache import DiskCache
+
+ROI_CACHE_DIR = os.environ.get("ROI_CACHE_DIR", "roi_cache")
+ROI_CACHE_BYTES = int(os.environ.get("ROI_CACHE_BYTES", 1024 * 1024 * 1024))
+ROI_MAX_MARGIN = 256
+
+ROI_FORMATS = {"nifti": ("nii.gz", "application/gzip"), "raw": ("bin", "application/octet-stream")}
+ROI_COMPONENTS = ("image", "mask")
+# Geometry of raw payloads travels in these headers
+ROI_HEADERS = ["X-Volume-Shape", "X-Volume-Dtype", "X-Volume-Affine", "X-Volume-Offset"]
+# numpy and nibabel are imported where crops are made, so the API starts without them
+
+_cache = DiskCache("roi", ROI_CACHE_DIR, ROI_CACHE_BYTES)
+
+
+def find_segment(segments, label):
+    """A segment by label number or by (case-insensitive) label_dict name."""
+    for segment in segments:
+        if str(segment["label"]) == label or segment["name"].lower() == label.lower():
+            return segment
+    return None
+
+
+def roi_box(segment, shape, margin=0):
+    """(first, last) voxel indices (inclusive) of the label's bounding box grown by margin, clipped."""
+    import numpy as np
+
+    first = np.maximum(np.array(segment["bounding_box"]["min"]) - margin, 0)
+    last = np.minimum(np.array(segment["bounding_box"]["max"]) + margin, np.array(shape[:3]) - 1)
+    return first, last
+
+
+def _crop(study, segment, component, margin):
+    import numpy as np
+
+    from utils.volumes import open_volume, source_paths
+
+    image_path, mask_path = source_paths(study)
+    data, affine, _ = open_volume(image_path if component == "image" else mask_path)
+    first, last = roi_box(segment, data.shape, margin)
+    # Only the pages under the box are touched in the memory-mapped volume
+    crop = np.ascontiguousarray(data[first[0]:last[0] + 1, first[1]:last[1] + 1, first[2]:last[2] + 1])
+
+    crop_affine = np.array(affine, dtype=np.float64)
+    crop_affine[:3, 3] = crop_affine[:3, :3] @ first + crop_affine[:3, 3]
+    return crop, crop_affine, first
+
+
+def _nifti_bytes(crop, affine):
+    import nibabel as nib
+
+    img = nib.Nifti1Image(crop, affine)
+    img.header.set_qform(affine, code=1)
+    img.header.set_sform(affine, code=1)
+    img.header.set_xyzt_units("mm")
+    return gzip.compress(img.to_bytes(), compresslevel=6, mtime=0)
+
+
+def roi_payload(study, segment, component="image", margin=0, output_format="nifti"):
+    """(body bytes, geometry headers) of a label's cropped sub-volume; cached on disk."""
+    extension, _ = ROI_FORMATS[output_format]
+    # The mask hash keeps crops of a re-segmented study apart from the previous ones
+    key = f"{study['study_id']}:{study.get('mask_sha256')}:{segment['label']}:{component}:{margin}:{output_format}"
+
+    body = _cache.get(key, extension)
+    meta = _cache.get(key, "json")
+    if body is not None and meta is not None:
+        return body, json.loads(meta)
+
+    crop, affine, first = _crop(study, segment, component, margin)
+    headers = {
+        "X-Volume-Shape": ",".join(map(str, crop.shape)),
+        "X-Volume-Dtype": crop.dtype.str,
+        "X-Volume-Affine": ",".join(repr(float(v)) for v in affine.ravel()),
+        "X-Volume-Offset": ",".join(map(str, first.tolist())),
+    }
+    body = _nifti_bytes(crop, affine) if output_format == "nifti" else crop.tobytes()
+
+    _cache.put(key, "json", json.dumps(headers).encode())
+    _cache.put(key, extension, body)
+    return body, headers
+
+
+def roi_filename(segment, component, output_format):
+    name = segment["name"].lower().replace(" ", "_")
+    return f"{segment['label']}_{name}_{component}.{ROI_FORMATS[output_format][0]}"
+
@@ -0,0 +1,169 @@
+import math
+import os
+from functools import lru_cache
+
+from utils.frames import FileSpan, LazyPart
+from utils.instance_index import load_instance_index
+from utils.render import pixel_format
+
+# Mask slabs are copied out of the source volume this many bytes at a time
+VOLUME_SLAB_BYTES = int(os.environ.get("VOLUME_SLAB_BYTES", 8 * 1024 * 1024))
+
+VOLUME_FORMATS = {"raw": ("raw", "application/octet-stream"), "nrrd": ("nrrd", "application/x-nrrd")}
+VOLUME_COMPONENTS = ("image", "mask")
+# Shape is in array order (slices, rows, columns); spacing, origin and direction in
+# patient x/y/z order along columns, rows and slices, as ITK and volume viewports use them
+# (X-Volume-Affine is the source NIfTI affine itself, as ROI crops report it)
+VOLUME_HEADERS = [
+    "X-Volume-Shape", "X-Volume-Dtype", "X-Volume-Spacing", "X-Volume-Origin",
+    "X-Volume-Direction", "X-Volume-Rescale", "X-Volume-Affine",
+]
+
+NRRD_TYPES = {
+    "i1": "int8", "u1": "uint8", "i2": "short", "u2": "ushort", "i4": "int", "u4": "uint",
+    "i8": "longlong", "u8": "ulonglong", "f4": "float", "f8": "double",
+}
+
+
+# NIfTI world coordinates are RAS; DICOM, NRRD and volume viewports use LPS
+_RAS_TO_LPS = (-1.0, -1.0, 1.0)
+
+
+def affine_geometry(affine):
+    """Spacing, origin and direction (LPS, along columns, rows and slices) of a NIfTI affine.
+
+    The affine's voxel axes (i, j, k) are the stored (slice, row, column), as in
+    segment_statistics and ROI crops, so all three describe the same grid.
+    """
+    import numpy as np
+
+    affine = np.asarray(affine, dtype=np.float64)
+    flip = np.array(_RAS_TO_LPS)
+    axes = [affine[:3, 2] * flip, affine[:3, 1] * flip, affine[:3, 0] * flip]
+    spacing = [float(np.linalg.norm(axis)) for axis in axes]
+    return {
+        "spacing": tuple(spacing),
+        "origin": tuple(float(v) for v in affine[:3, 3] * flip),
+        "direction": tuple(float(v) for axis, step in zip(axes, spacing) for v in axis / step),
+        "affine": tuple(float(v) for v in affine.ravel()),
+    }
+
+
+@lru_cache(maxsize=256)
+def series_volume_geometry(dicom_dir, image_path):
+    """Shape, stored dtype, rescale, spacing, origin and direction of a series stacked into one volume.
+
+    The converted series is written on a unit grid, so the physical geometry comes
+    from the source NIfTI affine (only its header is read).
+    """
+    import nibabel as nib
+
+    index = load_instance_index(dicom_dir)
+    instances = index["instances"]
+    if not instances:
+        raise FileNotFoundError(f"Series has no frames: {dicom_dir}")
+
+    rows, columns, dtype, slope, intercept = pixel_format(os.path.join(dicom_dir, instances[0]["file"]))
+    depth = sum(entry.get("number_of_frames", 1) for entry in instances)
+    image = nib.load(image_path)
+    if tuple(image.shape[:3]) != (depth, rows, columns):
+        raise ValueError(f"image shape {image.shape[:3]} does not match the series {(depth, rows, columns)}")
+
+    return {
+        "shape": (depth, rows, columns),
+        "dtype": dtype,
+        "rescale": (slope, intercept),
+        **affine_geometry(image.affine),
+    }
+
+
+def image_parts(dicom_dir, index):
+    """The series' pixel data as FileSpans, frame after frame: one contiguous volume without copying."""
+    return [
+        FileSpan(
+            os.path.join(dicom_dir, entry["file"]),
+            entry["offset"],
+            entry.get("number_of_frames", 1) * entry.get("frame_length", entry["length"]),
+        )
+        for entry in index["instances"]
+    ]
+
+
+def mask_parts(mask_path, shape):
+    """(dtype, LazyParts) of the source mask laid out like the series, one slab of slices per part.
+
+    The mask is memory-mapped (see open_volume); only the slab being sent is copied.
+    """
+    import numpy as np
+
+    from utils.volumes import open_volume
+
+    data, _, _ = open_volume(mask_path)
+    if tuple(data.shape[:3]) != tuple(shape) or data.size != math.prod(shape):
+        raise ValueError(f"mask shape {data.shape} does not match the series {tuple(shape)}")
+    data = data.reshape(shape)
+
+    slice_bytes = shape[1] * shape[2] * data.dtype.itemsize
+    slab_slices = max(1, VOLUME_SLAB_BYTES // slice_bytes)
+
+    def slab(z0, z1):
+        return LazyPart((z1 - z0) * slice_bytes, lambda: np.ascontiguousarray(data[z0:z1]).tobytes())
+
+    return data.dtype, [slab(z0, min(z0 + slab_slices, shape[0])) for z0 in range(0, shape[0], slab_slices)]
+
+
+def _vector(values):
+    return "(" + ",".join(repr(float(v)) for v in values) + ")"
+
+
+def nrrd_header(geometry, dtype):
+    """Attached NRRD header for a volume in series layout (columns vary fastest)."""
+    depth, rows, columns = geometry["shape"]
+    direction, spacing = geometry["direction"], geometry["spacing"]
+    axes = [[d * spacing[i] for d in direction[3 * i:3 * i + 3]] for i in range(3)]
+    lines = [
+        "NRRD0004",
+        f"type: {NRRD_TYPES[dtype.str[1:]]}",
+        "dimension: 3",
+        "space: left-posterior-superior",
+        f"sizes: {columns} {rows} {depth}",
+        f"space directions: {' '.join(_vector(axis) for axis in axes)}",
+        "kinds: domain domain domain",
+        "encoding: raw",
+        f"space origin: {_vector(geometry['origin'])}",
+    ]
+    if dtype.itemsize > 1:
+        lines.append(f"endian: {'big' if dtype.str[0] == '>' else 'little'}")
+    return ("\n".join(lines) + "\n\n").encode()
+
+
+def volume_headers(geometry, dtype):
+    return {
+        "X-Volume-Shape": ",".join(map(str, geometry["shape"])),
+        "X-Volume-Dtype": dtype.str,
+        "X-Volume-Spacing": ",".join(repr(v) for v in geometry["spacing"]),
+        "X-Volume-Origin": ",".join(repr(v) for v in geometry["origin"]),
+        "X-Volume-Direction": ",".join(repr(float(v)) for v in geometry["direction"]),
+        "X-Volume-Rescale": ",".join(repr(float(v)) for v in geometry["rescale"]),
+        "X-Volume-Affine": ",".join(repr(v) for v in geometry["affine"]),
+    }
+
+
+def volume_payload(study, dicom_dir, index, component="image", output_format="raw"):
+    """(body parts, geometry headers) of the whole series volume or its mask, ready for body_response."""
+    from utils.volumes import source_paths
+
+    image_path, mask_path = source_paths(study)
+    geometry = series_volume_geometry(dicom_dir, image_path)
+    if component == "mask":
+        dtype, parts = mask_parts(mask_path, geometry["shape"])
+        geometry = {**geometry, "rescale": (1.0, 0.0)}
+    else:
+        dtype, parts = geometry["dtype"], image_parts(dicom_dir, index)
+    if output_format == "nrrd":
+        parts = [nrrd_header(geometry, dtype), *parts]
+    return parts, volume_headers(geometry, dtype)
+
+
+def volume_filename(study_uid, component, output_format):
+    return f"{study_uid}_{component}.{VOLUME_FORMATS[output_format][0]}"
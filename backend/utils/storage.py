@@ -0,0 +1,163 @@
+import fcntl
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+
+from utils.disk_cache import DiskCache
+
+UPLOAD_DIR = "uploads"
+DICOM_DIRNAME = "dicom_series"
+SEGMENTATION_DIRNAME = "segmentation"
+SEGMENTATION_FILENAME = "segmentation.dcm"
+
+# "eager": DICOM series and SEG are written next to the source volumes and kept forever.
+# "lazy": only the source volumes are durable; series and SEG live in a quota-bounded
+# cache under DERIVED_DIR and are regenerated from the sources on first access.
+STORAGE_MODE = os.environ.get("STORAGE_MODE", "eager")
+DERIVED_DIR = os.environ.get("DERIVED_DIR", "derived")
+DERIVED_CACHE_BYTES = int(os.environ.get("DERIVED_CACHE_BYTES", 20 * 1024 ** 3))
+# How long a read waits for a regeneration before it is told to come back (503)
+REGENERATION_TIMEOUT = float(os.environ.get("REGENERATION_TIMEOUT", 30))
+REGENERATION_RETRY_AFTER = 5
+COMPLETE_MARKER = ".complete"
+
+_study_locks = {}
+_regenerations = {}
+_study_locks_guard = threading.Lock()
+
+
+def study_dir(study_id):
+    """Durable directory of a study: the uploaded source volumes."""
+    return os.path.join(UPLOAD_DIR, study_id)
+
+
+def derived_dir(study_id):
+    """Directory holding a study's DICOM series and SEG."""
+    if STORAGE_MODE == "lazy":
+        return os.path.join(DERIVED_DIR, study_id)
+    return study_dir(study_id)
+
+
+def dicom_dir(study_id):
+    return os.path.join(derived_dir(study_id), DICOM_DIRNAME)
+
+
+def segmentation_path(study_id):
+    return os.path.join(derived_dir(study_id), SEGMENTATION_DIRNAME, SEGMENTATION_FILENAME)
+
+
+def is_stored_path(path):
+    """Whether path (after resolving symlinks and "..") lies inside the upload or derived directories."""
+    real = os.path.realpath(path)
+    return any(
+        os.path.commonpath([real, os.path.realpath(root)]) == os.path.realpath(root)
+        for root in (UPLOAD_DIR, DERIVED_DIR)
+    )
+
+
+def directory_bytes(path):
+    return sum(
+        os.path.getsize(os.path.join(directory, name))
+        for directory, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def _thread_lock(study_id):
+    with _study_locks_guard:
+        return _study_locks.setdefault(study_id, threading.Lock())
+
+
+@contextmanager
+def derived_lock(study_id, blocking=True):
+    """Exclusive right to write a study's derived files, across threads and processes.
+
+    Taken in both storage modes: a re-segmentation rewrites the SEG of an eager study
+    too. Yields False instead of waiting when blocking is off and someone else holds it.
+    """
+    thread_lock = _thread_lock(study_id)
+    if not thread_lock.acquire(blocking):
+        yield False
+        return
+    try:
+        os.makedirs(DERIVED_DIR, exist_ok=True)
+        with open(os.path.join(DERIVED_DIR, f"{study_id}.lock"), "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+    finally:
+        thread_lock.release()
+
+
+class _DerivedCache(DiskCache):
+    """DiskCache whose entries are whole study directories; recency lives on their marker file."""
+
+    def scan(self):
+        entries = []
+        for study_id in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+            path = os.path.join(self.directory, study_id)
+            try:
+                mtime = os.stat(os.path.join(path, COMPLETE_MARKER)).st_mtime
+            except (FileNotFoundError, NotADirectoryError):
+                continue  # lock files, and studies still being generated
+            entries.append((mtime, directory_bytes(path), path))
+        return entries
+
+    def evict(self, path):
+        with derived_lock(os.path.basename(path), blocking=False) as acquired:
+            if not acquired:
+                return False
+            os.remove(os.path.join(path, COMPLETE_MARKER))
+            shutil.rmtree(path, ignore_errors=True)
+        print(f"Evicted derived files of {os.path.basename(path)}")
+        return True
+
+
+_cache = _DerivedCache("derived", DERIVED_DIR, DERIVED_CACHE_BYTES)
+
+
+def derived_available(study_id):
+    """Whether the study's series and SEG are on disk right now (always, in eager storage)."""
+    return STORAGE_MODE != "lazy" or os.path.exists(os.path.join(derived_dir(study_id), COMPLETE_MARKER))
+
+
+def mark_derived(study_id):
+    """Record a freshly written derived directory in the cache (lazy storage only)."""
+    if STORAGE_MODE != "lazy":
+        return
+    path = derived_dir(study_id)
+    open(os.path.join(path, COMPLETE_MARKER), "w").close()
+    _cache.added(directory_bytes(path))
+
+
+def ensure_derived(study):
+    """Make sure the study's DICOM series and SEG are on disk before they are read.
+
+    A no-op in eager storage. In lazy storage an evicted study is regenerated in
+    the regeneration pool; requests in this process wait on one submission, and the
+    worker takes the study's derived_lock so other processes do not repeat it.
+    Raises TimeoutError when the files are not ready within REGENERATION_TIMEOUT;
+    the regeneration carries on, and a later request picks up its result.
+    """
+    if STORAGE_MODE != "lazy":
+        return
+    study_id = study["study_id"]
+    marker = os.path.join(derived_dir(study_id), COMPLETE_MARKER)
+    if os.path.exists(marker):
+        _cache.touch(marker)
+        return
+
+    with _thread_lock(study_id):
+        future = _regenerations.get(study_id)
+        if future is None:
+            if os.path.exists(marker):
+                return
+            from utils.jobs import get_regeneration_pool, run_regeneration
+
+            future = _regenerations[study_id] = get_regeneration_pool().submit(run_regeneration, study_id)
+            future.add_done_callback(lambda f: _regenerations.pop(study_id, None))
+    future.result(timeout=REGENERATION_TIMEOUT)
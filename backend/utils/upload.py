@@ -0,0 +1,270 @@
+import hashlib
+import os
+import struct
+import zlib
+
+from fastapi import HTTPException
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 8 * 1024 ** 3))
+# Both volumes plus multipart framing and form fields
+MAX_REQUEST_BYTES = 2 * MAX_UPLOAD_BYTES + 1024 * 1024
+MAX_BATCH_REQUEST_BYTES = int(os.environ.get("MAX_BATCH_REQUEST_BYTES", 64 * 1024 ** 3))
+
+# Plain form fields (radiography_type) are small; anything bigger is not one
+MAX_FORM_FIELD_BYTES = 64 * 1024
+
+NIFTI1_HEADER_SIZE = 348
+NIFTI2_HEADER_SIZE = 540
+
+
+def check_nifti_header(head: bytes, filename: str):
+    """Reject anything that does not start with a NIfTI-1/NIfTI-2 header (plain or gzipped)."""
+    if head[:2] == b"\x1f\x8b":
+        try:
+            head = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(head, NIFTI2_HEADER_SIZE)
+        except zlib.error:
+            raise HTTPException(status_code=400, detail=f"{filename}: corrupt gzip stream")
+
+    if len(head) >= NIFTI1_HEADER_SIZE:
+        for endian in "<>":
+            (sizeof_hdr,) = struct.unpack(f"{endian}i", head[:4])
+            if sizeof_hdr == NIFTI1_HEADER_SIZE and head[344:348] in (b"n+1\0", b"ni1\0"):
+                return
+            if sizeof_hdr == NIFTI2_HEADER_SIZE and head[4:8] in (b"n+2\0", b"ni2\0"):
+                return
+
+    raise HTTPException(status_code=400, detail=f"{filename}: not a NIfTI file")
+
+
+def is_mask_filename(filename):
+    """Masks are told apart from images by name when nothing else says which is which."""
+    name = os.path.basename(filename).lower()
+    return any(word in name for word in ("mask", "seg", "label"))
+
+
+def is_nifti_filename(filename):
+    return filename.lower().endswith((".nii", ".nii.gz"))
+
+
+def save_stream(stream, dest_path, filename, max_bytes=MAX_UPLOAD_BYTES):
+    """Blocking counterpart of save_upload for file-like sources (archive members)."""
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(dest_path, "wb") as f:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if size == 0:
+                    check_nifti_header(chunk, filename)
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(status_code=413, detail=f"{filename}: exceeds the {max_bytes} byte upload limit")
+                digest.update(chunk)
+                f.write(chunk)
+        if size == 0:
+            raise HTTPException(status_code=400, detail=f"{filename}: empty upload")
+    except BaseException:
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        raise
+
+    return digest.hexdigest(), size
+
+
+async def save_upload(upload_file, dest_path, max_bytes=MAX_UPLOAD_BYTES):
+    """Copy an upload to disk in fixed-size chunks, returning (sha256 hex digest, size).
+
+    The header is validated on the first chunk, so bad files are rejected before
+    anything else is copied, and memory use stays at one chunk per upload.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(dest_path, "wb") as f:
+            while True:
+                chunk = await upload_file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if size == 0:
+                    check_nifti_header(chunk, upload_file.filename)
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"{upload_file.filename}: exceeds the {max_bytes} byte upload limit",
+                    )
+                digest.update(chunk)
+                f.write(chunk)
+        if size == 0:
+            raise HTTPException(status_code=400, detail=f"{upload_file.filename}: empty upload")
+    except BaseException:
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        raise
+
+    return digest.hexdigest(), size
+
+
+class _FilePart:
+    """One file of a streamed form: hashed, header-checked and written as its bytes arrive."""
+
+    def __init__(self, dest_path, filename, max_bytes, check_header=True):
+        self.dest_path = dest_path
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.head = b"" if check_header else None
+        self.error = None
+        self.file = open(dest_path, "wb")
+
+    def _write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise HTTPException(status_code=413, detail=f"{self.filename}: exceeds the {self.max_bytes} byte upload limit")
+        self.digest.update(chunk)
+        self.file.write(chunk)
+
+    def write(self, data):
+        if self.head is None:
+            self._write(data)
+            return
+        # The header is checked on the first UPLOAD_CHUNK_SIZE bytes, as in save_upload
+        self.head += data
+        if len(self.head) >= UPLOAD_CHUNK_SIZE:
+            self._check_head()
+
+    def _check_head(self):
+        head, self.head = self.head, None
+        check_nifti_header(head, self.filename)
+        self._write(head)
+
+    def finish(self):
+        if self.head:
+            self._check_head()
+        self.file.close()
+        if self.size == 0:
+            raise HTTPException(status_code=400, detail=f"{self.filename}: empty upload")
+        return self.digest.hexdigest(), self.size
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.dest_path):
+            os.remove(self.dest_path)
+
+
+def _reject(part, name, multiple, error):
+    # One bad file of a repeated field only loses that file; anywhere else it fails the form
+    if name not in multiple:
+        raise error
+    part.error = error
+    part.discard()
+
+
+async def stream_form(request, file_fields, temp_path, max_bytes=MAX_UPLOAD_BYTES, multiple=(), raw=()):
+    """Parse a multipart/form-data request body as it arrives off the socket.
+
+    Unlike UploadFile parameters, which Starlette spools in full before the handler
+    runs, each file field is hashed, header-checked and written to temp_path(filename)
+    chunk by chunk, so a bad or oversized file is rejected as soon as its bytes show up.
+    Returns (form fields, {file field: (filename, path, sha256, size)}); the caller owns
+    the written files. Raises HTTPException for malformed, unexpected or missing fields.
+
+    Fields in multiple are optional and may repeat: they map to a list, in which a
+    rejected file is the HTTPException that rejected it and the rest of the form is
+    still read. Fields in raw are optional files of any content, up to MAX_BATCH_REQUEST_BYTES.
+    """
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in options:
+        raise HTTPException(status_code=400, detail="expected a multipart/form-data body")
+
+    # The parser calls back synchronously; events are queued and handled between writes
+    events = []
+    header_field, header_value = [], []
+
+    def on_header_end():
+        events.append(("header", (b"".join(header_field).lower(), b"".join(header_value))))
+        header_field.clear()
+        header_value.clear()
+
+    callbacks = {
+        "on_part_begin": lambda: events.append(("begin", None)),
+        "on_part_data": lambda data, start, end: events.append(("data", data[start:end])),
+        "on_part_end": lambda: events.append(("end", None)),
+        "on_header_field": lambda data, start, end: header_field.append(data[start:end]),
+        "on_header_value": lambda data, start, end: header_value.append(data[start:end]),
+        "on_header_end": on_header_end,
+        "on_headers_finished": lambda: events.append(("headers_done", None)),
+    }
+    parser = MultipartParser(options[b"boundary"], callbacks)
+
+    fields, files = {}, {}
+    written = []
+    part = name = disposition = value = None
+    try:
+        async for chunk in request.stream():
+            try:
+                parser.write(chunk)
+            except MultipartParseError as e:
+                raise HTTPException(status_code=400, detail=f"malformed multipart body: {e}")
+            for kind, data in events:
+                if kind == "begin":
+                    part, name, disposition, value = None, None, {}, b""
+                elif kind == "header" and data[0] == b"content-disposition":
+                    disposition = parse_options_header(data[1])[1]
+                elif kind == "headers_done":
+                    name = disposition.get(b"name", b"").decode()
+                    if name not in multiple and (name in fields or name in files):
+                        raise HTTPException(status_code=400, detail=f"{name}: sent more than once")
+                    if b"filename" in disposition:
+                        if name not in (*file_fields, *multiple, *raw):
+                            raise HTTPException(status_code=400, detail=f"unexpected file field {name!r}")
+                        filename = os.path.basename(disposition[b"filename"].decode())
+                        if name in raw:
+                            part = _FilePart(temp_path(filename), filename, MAX_BATCH_REQUEST_BYTES, check_header=False)
+                        else:
+                            part = _FilePart(temp_path(filename), filename, max_bytes)
+                        written.append(part)
+                elif kind == "data":
+                    if part is not None:
+                        if part.error is None:
+                            try:
+                                part.write(data)
+                            except HTTPException as e:
+                                _reject(part, name, multiple, e)
+                    else:
+                        value += data
+                        if len(value) > MAX_FORM_FIELD_BYTES:
+                            raise HTTPException(status_code=413, detail=f"{name}: form field too large")
+                elif kind == "end":
+                    if part is not None and name in multiple:
+                        entry = part.error
+                        if entry is None:
+                            try:
+                                entry = (part.filename, part.dest_path, *part.finish())
+                            except HTTPException as e:
+                                _reject(part, name, multiple, e)
+                                entry = e
+                        files.setdefault(name, []).append(entry)
+                    elif part is not None:
+                        files[name] = (part.filename, part.dest_path, *part.finish())
+                    else:
+                        fields[name] = value.decode()
+            events.clear()
+        parser.finalize()
+
+        missing = [field for field in file_fields if field not in files]
+        if missing:
+            raise HTTPException(status_code=400, detail=f"missing file field {missing[0]!r}")
+    except BaseException:
+        for part in written:
+            part.discard()
+        raise
+
+    return fields, files
+
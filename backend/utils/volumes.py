@@ -0,0 +1,133 @@
+import json
+import os
+import threading
+
+import nibabel as nib
+import numpy as np
+
+from utils.disk_cache import DiskCache
+from utils.metrics import cache_requests
+from utils.storage import study_dir
+from utils.upload import is_mask_filename, is_nifti_filename
+
+VOLUME_CACHE_DIR = os.environ.get("VOLUME_CACHE_DIR", "volume_cache")
+VOLUME_CACHE_BYTES = int(os.environ.get("VOLUME_CACHE_BYTES", 8 * 1024 ** 3))
+
+_materialize_locks = {}
+_materialize_locks_guard = threading.Lock()
+
+
+def source_paths(study):
+    """(image_path, mask_path) of the NIfTI files a study was converted from."""
+    source_dir = study_dir(study["study_id"])
+    image_file, mask_file = study.get("image_file"), study.get("mask_file")
+    if not (image_file and mask_file):
+        # Studies catalogued before the file names were recorded
+        candidates = sorted(f for f in os.listdir(source_dir) if is_nifti_filename(f))
+        masks = [f for f in candidates if is_mask_filename(f)]
+        images = [f for f in candidates if f not in masks]
+        if not (images and masks):
+            raise FileNotFoundError(f"Source volumes not found for study {study['study_id']}")
+        image_file, mask_file = images[0], masks[0]
+    return os.path.join(source_dir, image_file), os.path.join(source_dir, mask_file)
+
+
+def check_mask_geometry(image_path, mask_path, atol=1e-3):
+    """Raise ValueError unless the mask is on the image's voxel grid (shape and affine).
+
+    Only the NIfTI headers are read.
+    """
+    image, mask = nib.load(image_path), nib.load(mask_path)
+    if image.shape[:3] != mask.shape[:3]:
+        raise ValueError(f"mask shape {mask.shape[:3]} does not match the image {image.shape[:3]}")
+    if not np.allclose(image.affine, mask.affine, atol=atol):
+        raise ValueError("mask affine does not match the image")
+
+
+class _VolumeCache(DiskCache):
+    """DiskCache of decoded volumes: each .npy and its geometry .json go together."""
+
+    def evict(self, path):
+        stem = os.path.splitext(path)[0]
+        for stale in (f"{stem}.npy", f"{stem}.json"):
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                pass
+        return True
+
+
+_cache = _VolumeCache("volume", VOLUME_CACHE_DIR, VOLUME_CACHE_BYTES)
+
+
+def _materialize_lock(path):
+    with _materialize_locks_guard:
+        return _materialize_locks.setdefault(path, threading.Lock())
+
+
+def _materialized_paths(path):
+    # Keyed by the file itself, so the hard links of one stored object share a copy
+    stat = os.stat(path)
+    key = f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+    return _cache.path(key, "npy"), _cache.path(key, "json")
+
+
+def _materialize(path, array_path, geometry_path):
+    """Decode a compressed volume once into a .npy that can be memory-mapped afterwards."""
+    img = nib.load(path)
+    os.makedirs(os.path.dirname(array_path), exist_ok=True)
+    tmp_path = f"{array_path}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, np.asanyarray(img.dataobj))
+    with open(f"{geometry_path}.tmp", "w") as f:
+        json.dump({"affine": img.affine.tolist(), "zooms": [float(z) for z in img.header.get_zooms()[:3]]}, f)
+    os.replace(f"{geometry_path}.tmp", geometry_path)
+    os.replace(tmp_path, array_path)
+
+
+def open_volume(path):
+    """(array, affine, zooms) of a NIfTI volume without reading it into memory.
+
+    Uncompressed, unscaled .nii files are memory-mapped in place. Anything else
+    (.nii.gz, scaled data) is decoded once into a .npy in the quota-bounded volume
+    cache and memory-mapped from there on; an evicted copy is decoded again.
+    """
+    if path.endswith(".nii"):
+        img = nib.load(path, mmap="r")
+        if img.dataobj.slope == 1 and img.dataobj.inter == 0:
+            return np.asanyarray(img.dataobj), img.affine, img.header.get_zooms()[:3]
+
+    array_path, geometry_path = _materialized_paths(path)
+    with _materialize_lock(array_path):
+        try:
+            data, geometry = _load_materialized(array_path, geometry_path)
+        except FileNotFoundError:
+            cache_requests.inc(cache=_cache.name, result="miss")
+            _materialize(path, array_path, geometry_path)
+            data, geometry = _load_materialized(array_path, geometry_path)
+            # Accounted only once mapped, as this may evict the new copy itself
+            _cache.added(os.path.getsize(array_path) + os.path.getsize(geometry_path))
+        else:
+            cache_requests.inc(cache=_cache.name, result="hit")
+            _cache.touch(array_path)
+            _cache.touch(geometry_path)
+    return data, np.array(geometry["affine"]), tuple(geometry["zooms"])
+
+
+def _load_materialized(array_path, geometry_path):
+    # Once mapped, the array stays readable even if eviction removes its file
+    data = np.load(array_path, mmap_mode="r")
+    with open(geometry_path) as f:
+        return data, json.load(f)
+
+
+def discard_volume(path):
+    """Remove a source volume and any materialized copy of it."""
+    try:
+        stale = [*_materialized_paths(path), path]
+    except FileNotFoundError:
+        return
+    for stale_path in stale:
+        try:
+            os.remove(stale_path)
+        except FileNotFoundError:
+            pass
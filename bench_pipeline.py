@@ -0,0 +1,430 @@
+"""Offline benchmark for the upload-to-viewable pipeline and the DICOMweb endpoints.
+
+Generates synthetic CBCT-like image/mask pairs, converts them with process_upload in a
+fresh process (per-stage latency, peak RSS, bytes written), then times the API in-process
+through FastAPI's TestClient. It also times a cold `import main`, which is what every new
+API worker pays before serving, and fails if that import pulls in the conversion stack.
+Results can be stored as a baseline and compared later:
+
+    python bench_pipeline.py --sizes 256 --save-baseline
+    python bench_pipeline.py --sizes 256          # exits 1 on a regression
+    python bench_pipeline.py --sizes 256,512x512x400,800x800x600 --gzip
+    python bench_pipeline.py --import-only        # just the API import check
+"""
+import argparse
+import contextlib
+import gzip
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from uuid import uuid4
+
+import nibabel as nib
+import numpy as np
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend")
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+# Upper and lower arch teeth, patient right to left (FDI numbering as in label_dict)
+UPPER_TEETH = [18, 17, 16, 15, 14, 13, 12, 11, 21, 22, 23, 24, 25, 26, 27, 28]
+LOWER_TEETH = [48, 47, 46, 45, 44, 43, 42, 41, 31, 32, 33, 34, 35, 36, 37, 38]
+
+# Only conversion, rendering and ROI requests need these; importing the API must not load them
+HEAVY_MODULES = ["numpy", "nibabel", "SimpleITK", "pydicom", "highdicom", "PIL"]
+IMPORT_KEY = "api_import"
+IMPORT_PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+import main
+print(json.dumps({
+    "import_s": time.perf_counter() - start,
+    "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "heavy_modules": sorted(set(sys.argv[1:]) & set(sys.modules)),
+}))
+"""
+
+
+def parse_size(text):
+    """'256' -> (256, 256, 256); '800x800x600' -> (800, 800, 600)."""
+    parts = [int(p) for p in text.lower().split("x")]
+    if len(parts) == 1:
+        parts *= 3
+    if len(parts) != 3:
+        raise argparse.ArgumentTypeError(f"Invalid size: {text}")
+    return tuple(parts)
+
+
+def _arch(w):
+    # Dental arch centre line: a parabola opening towards the back of the head
+    return 0.25 + 1.2 * (w - 0.5) ** 2
+
+
+def synthetic_slab(shape, x0, x1, seed=0):
+    """Image (HU, int16) and mask (uint8 labels) for columns x0:x1 of a synthetic CBCT.
+
+    Axis 0 runs head to chin (the DICOM slice axis), axis 1 front to back, axis 2 right to left.
+    """
+    depth, rows, columns = shape
+    u = (np.arange(depth, dtype=np.float32) / depth)[:, None, None]
+    v = (np.arange(rows, dtype=np.float32) / rows)[None, :, None]
+    w = (np.arange(x0, x1, dtype=np.float32) / columns)[None, None, :]
+
+    image = np.full((depth, rows, x1 - x0), -1000, dtype=np.float32)
+    mask = np.zeros(image.shape, dtype=np.uint8)
+
+    head = ((v - 0.5) / 0.45) ** 2 + ((w - 0.5) / 0.42) ** 2 < 1
+    image[np.broadcast_to(head, image.shape)] = 40
+
+    arch_distance = np.abs(v - _arch(w))
+    on_arch = (arch_distance < 0.05) & (np.abs(w - 0.5) < 0.32)
+    for label, (top, bottom) in ((2, (0.22, 0.38)), (1, (0.56, 0.82))):
+        bone = on_arch & (u >= top) & (u < bottom)
+        image[bone] = 1200
+        mask[bone] = label
+
+    # Inferior alveolar canals run inside the mandible on each side
+    for label, side in ((4, w < 0.5), (3, w >= 0.5)):
+        canal = side & (np.abs(w - 0.5) > 0.08) & (arch_distance < 0.012) & (np.abs(u - 0.7) < 0.012)
+        image[canal] = 30
+        mask[canal] = label
+
+    for label, centre in ((6, 0.35), (5, 0.65)):
+        sinus = ((u - 0.2) / 0.07) ** 2 + ((v - 0.45) / 0.08) ** 2 + ((w - centre) / 0.08) ** 2 < 1
+        image[sinus] = -900
+        mask[sinus] = label
+
+    pharynx = ((v - 0.78) / 0.05) ** 2 + ((w - 0.5) / 0.06) ** 2 < 1
+    pharynx = pharynx & (u > 0.2) & (u < 0.9)
+    image[pharynx] = -950
+    mask[pharynx] = 7
+
+    for teeth, z_centre in ((UPPER_TEETH, 0.43), (LOWER_TEETH, 0.51)):
+        for n, label in enumerate(teeth):
+            tw = 0.5 + (n - 7.5) * 0.037
+            tooth = ((u - z_centre) / 0.045) ** 2 + ((v - _arch(tw)) / 0.022) ** 2 + ((w - tw) / 0.016) ** 2 < 1
+            image[tooth] = 2000
+            mask[tooth] = label
+
+    rng = np.random.default_rng(seed + x0)
+    image += rng.normal(0, 25, image.shape).astype(np.float32)
+    return np.clip(image, -1024, 3071).astype(np.int16), mask
+
+
+def _create_nifti(path, shape, dtype, affine):
+    """Write a .nii header and return the data block as a writable memmap (Fortran ordered)."""
+    header = nib.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header.set_qform(affine, code=1)
+    header.set_sform(affine, code=1)
+    header.set_xyzt_units("mm")
+    header["vox_offset"] = 352
+    with open(path, "wb") as f:
+        header.write_to(f)
+        f.write(b"\0" * (352 - f.tell()))
+    return np.memmap(path, dtype=dtype, mode="r+", offset=352, shape=shape, order="F")
+
+
+def generate_pair(directory, shape, spacing=0.3, compress=False, slab_columns=16):
+    """Synthetic image.nii[.gz] / mask.nii[.gz] of the given shape, written slab by slab."""
+    os.makedirs(directory, exist_ok=True)
+    affine = np.diag([spacing, spacing, spacing, 1.0])
+    paths = [os.path.join(directory, "image.nii"), os.path.join(directory, "mask.nii")]
+    image = _create_nifti(paths[0], shape, np.int16, affine)
+    mask = _create_nifti(paths[1], shape, np.uint8, affine)
+    # Column slabs are contiguous in the Fortran-ordered files
+    for x0 in range(0, shape[2], slab_columns):
+        x1 = min(x0 + slab_columns, shape[2])
+        image[:, :, x0:x1], mask[:, :, x0:x1] = synthetic_slab(shape, x0, x1)
+    image.flush()
+    mask.flush()
+    del image, mask
+
+    if compress:
+        for i, path in enumerate(paths):
+            with open(path, "rb") as src, gzip.open(f"{path}.gz", "wb", compresslevel=1) as dst:
+                shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+            os.remove(path)
+            paths[i] = f"{path}.gz"
+    return paths
+
+
+def _directory_bytes(path):
+    return sum(
+        os.path.getsize(os.path.join(directory, name))
+        for directory, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def convert(study_id, image_path, mask_path, quiet=True):
+    """Runs in a fresh process: per-stage timings and peak RSS of one conversion."""
+    from models.study import StudyMetadata, save_metadata
+    from utils.conversion import process_upload
+
+    marks = []
+    start = time.perf_counter()
+    output = open(os.devnull, "w") if quiet else sys.stdout
+    with contextlib.redirect_stdout(output):
+        study_uid, segmentation_classes, segments = process_upload(
+            study_id, image_path, mask_path,
+            study_uid=f"2.25.{uuid4().int}",
+            progress=lambda stage: marks.append((stage, time.perf_counter())),
+        )
+    end = time.perf_counter()
+
+    save_metadata(StudyMetadata(
+        study_id=study_id,
+        study_uid=study_uid,
+        radiography_type="CBCT",
+        segmentation_classes=segmentation_classes,
+        image_file=os.path.basename(image_path),
+        mask_file=os.path.basename(mask_path),
+        segments=segments,
+    ))
+
+    stages = {}
+    for (stage, t0), (_, t1) in zip(marks, marks[1:] + [(None, end)]):
+        stages[stage] = t1 - t0
+    stages["total"] = end - start
+    return {
+        "study_uid": study_uid,
+        "stages_s": stages,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def bench_import(repeat=5):
+    """Cold `import main` in fresh interpreters: best time, peak RSS and any heavy modules loaded."""
+    env = {**os.environ, "PYTHONPATH": BACKEND_DIR}
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_PROBE, *HEAVY_MODULES],
+            env=env, check=True, capture_output=True, text=True,
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        "import_s": min(run["import_s"] for run in runs),
+        "peak_rss_mb": max(run["peak_rss_mb"] for run in runs),
+        "heavy_modules": sorted({name for run in runs for name in run["heavy_modules"]}),
+    }
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(round(q * (len(samples) - 1))))]
+    return {"p50_ms": pick(0.50) * 1000, "p99_ms": pick(0.99) * 1000}
+
+
+def bench_endpoints(study_uid, requests):
+    from fastapi.testclient import TestClient
+
+    import main
+
+    client = TestClient(main.app)
+    metadata = client.get(f"/studies/{study_uid}/series/x/metadata").json()
+    instances = [item["00080018"]["Value"][0] for item in metadata]
+    frame_urls = [
+        f"/dicomweb/studies/{study_uid}/series/x/instances/{uid}/frames/1"
+        for uid in instances
+    ]
+    rng = random.Random(0)
+    endpoints = {
+        "studies": lambda: "/studies?limit=100",
+        "metadata": lambda: f"/studies/{study_uid}/series/x/metadata",
+        "instances": lambda: f"/dicom/studies/{study_uid}/series/x/instances",
+        "frame": lambda: rng.choice(frame_urls),
+        "thumbnail": lambda: f"/dicomweb/studies/{study_uid}/thumbnail",
+    }
+
+    results = {}
+    for name, url in endpoints.items():
+        for _ in range(5):  # warm caches and lazy imports
+            client.get(url())
+        samples = []
+        for _ in range(requests):
+            t0 = time.perf_counter()
+            response = client.get(url())
+            response.content
+            samples.append(time.perf_counter() - t0)
+            if response.status_code != 200:
+                raise RuntimeError(f"{name}: HTTP {response.status_code} for {url()}")
+        results[name] = percentiles(samples)
+    return results
+
+
+def seed_catalog(count):
+    from models.study import StudyMetadata, save_metadata
+
+    for i in range(count):
+        save_metadata(StudyMetadata(
+            study_id=f"bench-{uuid4()}",
+            study_uid=f"2.25.{uuid4().int}",
+            radiography_type="CBCT",
+            segmentation_classes=["Lower Jawbone"],
+        ))
+
+
+def run_size(shape, args):
+    name = "x".join(map(str, shape))
+    data_dir = os.path.join("bench_data", name)
+    t0 = time.perf_counter()
+    image_path, mask_path = generate_pair(data_dir, shape, compress=args.gzip)
+    print(f"[{name}] generated synthetic pair in {time.perf_counter() - t0:.1f}s")
+
+    study_id = str(uuid4())
+    study_dir = os.path.join("uploads", study_id)
+    os.makedirs(study_dir)
+    image_upload = os.path.join(study_dir, os.path.basename(image_path))
+    mask_upload = os.path.join(study_dir, os.path.basename(mask_path))
+    shutil.copyfile(image_path, image_upload)
+    shutil.copyfile(mask_path, mask_upload)
+    input_bytes = _directory_bytes(study_dir)
+
+    # A fresh process per conversion, so peak RSS belongs to this volume alone
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        result = pool.submit(convert, study_id, image_upload, mask_upload, not args.verbose).result()
+
+    result["input_bytes"] = input_bytes
+    result["bytes_written"] = _directory_bytes(study_dir) - input_bytes
+    result["endpoints"] = bench_endpoints(result.pop("study_uid"), args.requests)
+    return name, result
+
+
+def flatten(results):
+    """{'256x256x256.stages_s.load': 1.2, ...}: the comparable metrics of a run."""
+    flat = {}
+    for size, result in results.items():
+        if size == IMPORT_KEY:
+            flat[f"{size}.import_s"] = result["import_s"]
+            flat[f"{size}.peak_rss_mb"] = result["peak_rss_mb"]
+            continue
+        for stage, seconds in result["stages_s"].items():
+            flat[f"{size}.stages_s.{stage}"] = seconds
+        flat[f"{size}.peak_rss_mb"] = result["peak_rss_mb"]
+        flat[f"{size}.bytes_written"] = result["bytes_written"]
+        for endpoint, stats in result["endpoints"].items():
+            for key, value in stats.items():
+                flat[f"{size}.endpoints.{endpoint}.{key}"] = value
+    return flat
+
+
+# Differences below these are noise, whatever the ratio
+NOISE_FLOOR = {
+    "stages_s": 0.05, "peak_rss_mb": 16, "bytes_written": 1024 * 1024, "endpoints": 2.0, "import_s": 0.05,
+}
+
+
+def compare(current, baseline, tolerance):
+    """Print current vs baseline for every shared metric; return the regressions."""
+    current, baseline = flatten(current), flatten(baseline)
+    regressions = []
+    print(f"\n{'metric':<58} {'baseline':>12} {'current':>12} {'change':>8}")
+    for key in sorted(current):
+        if key not in baseline:
+            continue
+        before, after = baseline[key], current[key]
+        change = (after - before) / before if before else 0.0
+        floor = next(value for kind, value in NOISE_FLOOR.items() if f".{kind}" in key)
+        regressed = after > before * (1 + tolerance) and after - before > floor
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{key:<58} {before:>12.3f} {after:>12.3f} {change:>+7.0%}{flag}")
+        if regressed:
+            regressions.append(key)
+    return regressions
+
+
+def report(results):
+    for size, result in results.items():
+        if size == IMPORT_KEY:
+            print("\n== import main ==")
+            print(f"  import time        {result['import_s']:8.2f} s")
+            print(f"  peak RSS           {result['peak_rss_mb']:8.0f} MiB")
+            print(f"  heavy modules      {', '.join(result['heavy_modules']) or 'none'}")
+            continue
+        print(f"\n== {size} ==")
+        for stage, seconds in result["stages_s"].items():
+            print(f"  stage {stage:<14} {seconds:8.2f} s")
+        print(f"  peak RSS           {result['peak_rss_mb']:8.0f} MiB")
+        print(f"  input bytes        {result['input_bytes'] / 2**20:8.1f} MiB")
+        print(f"  bytes written      {result['bytes_written'] / 2**20:8.1f} MiB")
+        for endpoint, stats in result["endpoints"].items():
+            print(f"  {endpoint:<18} p50 {stats['p50_ms']:7.2f} ms   p99 {stats['p99_ms']:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="256", help="comma separated volume sizes, e.g. 256,800x800x600")
+    parser.add_argument("--gzip", action="store_true", help="upload .nii.gz instead of .nii")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+    parser.add_argument("--catalog-size", type=int, default=1000, help="extra studies in the catalog")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown before failing")
+    parser.add_argument("--output", help="write the results JSON here")
+    parser.add_argument("--workdir", help="keep uploads and data here instead of a temporary directory")
+    parser.add_argument("--verbose", action="store_true", help="show conversion output")
+    parser.add_argument("--import-only", action="store_true", help="only time the API import")
+    args = parser.parse_args()
+
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    baseline_path = os.path.abspath(args.baseline)
+    output_path = os.path.abspath(args.output) if args.output else None
+
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="bench-")
+    os.makedirs(workdir, exist_ok=True)
+    # The backend resolves uploads/, catalog.db and its caches relative to the working directory
+    os.chdir(workdir)
+    sys.path.insert(0, BACKEND_DIR)
+    os.makedirs("uploads", exist_ok=True)
+
+    try:
+        # Before anything is imported here; the probe runs in its own interpreters anyway
+        results = {IMPORT_KEY: bench_import()}
+        if not args.import_only:
+            seed_catalog(args.catalog_size)
+            results.update(run_size(shape, args) for shape in sizes)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report(results)
+    if output_path:
+        with open(output_path, "w") as f:
+            json.dump(results, f, indent=2)
+
+    heavy_modules = results[IMPORT_KEY]["heavy_modules"]
+    if heavy_modules:
+        print(f"\nimport main loaded {', '.join(heavy_modules)}; keep them behind function-level imports")
+        return 1
+
+    if args.save_baseline:
+        with open(baseline_path, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nBaseline saved to {baseline_path}")
+        return 0
+
+    if not os.path.exists(baseline_path):
+        print(f"\nNo baseline at {baseline_path}; run with --save-baseline to create one")
+        return 0
+    with open(baseline_path) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    if regressions:
+        print(f"\n{len(regressions)} metric(s) regressed by more than {args.tolerance:.0%}")
+        return 1
+    print("\nNo regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
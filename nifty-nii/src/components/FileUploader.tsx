@@ -127,12 +127,34 @@ export const FileUploader: React.FC<FileUploaderProps> = ({ onUploadComplete })
         throw new Error('Upload failed');
       }
 
-      const result = await response.json();
+      const accepted = await response.json();
+
+      // An identical upload was already converted: the study is ready, there is no job to poll
+      if (accepted.deduplicated) {
+        setUploadProgress(100);
+        setTimeout(() => {
+          setIsUploading(false);
+          onUploadComplete(accepted.study_uid, accepted.segmentation_classes);
+        }, 500);
+        return;
+      }
+
+      // Conversion runs in the background; poll the job until the study is ready
+      let job = await (await fetch(`http://localhost:9999${accepted.status_url}`)).json();
+      while (job.status === 'queued' || job.status === 'running') {
+        setUploadProgress(Math.max(90, 90 + job.progress * 10));
+        await new Promise(resolve => setTimeout(resolve, 1000));
+        job = await (await fetch(`http://localhost:9999${accepted.status_url}`)).json();
+      }
+
+      if (job.status !== 'done') {
+        throw new Error(job.error || 'Conversion failed');
+      }
       setUploadProgress(100);
 
       setTimeout(() => {
         setIsUploading(false);
-        onUploadComplete(result.study_uid, result.segmentation_classes);
+        onUploadComplete(job.study_uid, job.segmentation_classes);
       }, 500);
 
     } catch (error) {
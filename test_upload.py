@@ -1,5 +1,6 @@
 import requests
 import os
+import time
 
 def test_upload():
     # Test the upload endpoint
@@ -51,6 +52,21 @@ def test_upload():
                 print("✅ Upload successful!")
             except:
                 print("✅ Upload successful (non-JSON response)")
+        elif response.status_code == 202:
+            # Conversion runs in the background; poll the job until it finishes
+            result = response.json()
+            status_url = f"http://localhost:9999{result['status_url']}"
+            print(f"Conversion queued, polling {status_url}")
+            job = requests.get(status_url).json()
+            while job["status"] in ("queued", "running"):
+                time.sleep(1)
+                job = requests.get(status_url).json()
+                print(f"  {job['status']} ({job.get('stage')}, {job.get('progress', 0):.0%})")
+            if job["status"] == "done":
+                print(f"Job: {job}")
+                print("✅ Upload successful!")
+            else:
+                print(f"❌ Conversion failed: {job.get('error')}")
         else:
             print("❌ Upload failed!")
             try: